@@ -0,0 +1,208 @@
+"""
+Time the stages of scoring separately, and compare the results against a baseline.
+
+A single end-to-end timing mixes asset loading, I/O and scoring, so it can't tell us which stage got slower. A
+``BenchmarkSuite`` instead times each stage of the scoring path (e.g. FastText embedding, the tf-idf product, top-k
+ranking) for given batch sizes and worker counts, recording throughput in docs/sec and the peak RSS of the process so
+far. Results are saved as JSON, and ``compare()`` flags stages whose throughput fell by more than a threshold relative
+to a stored baseline.
+
+Import time counts too: every CLI and worker process pays it. ``measure_import()`` times importing a module in a fresh
+interpreter, and records which slow-to-import libraries (``HEAVY_MODULES``) it pulled in. The core scoring modules
+should import none of them until they load a model.
+"""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import timeit
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Union
+
+# Libraries that take a long time to import, which the core scoring modules should import only when they're used
+HEAVY_MODULES = ('fasttext', 'gensim', 'sklearn', 'pandas')
+
+# Core scoring modules, which should import quickly
+CORE_MODULES = ('fos.model', 'fos.vectors', 'fos.bundle', 'fos.entity', 'fos.tfidf', 'fos.topk', 'fos.cache',
+                'fos.store', 'fos.util', 'fos.wordvectors')
+
+# Python code that times an import in a fresh interpreter, reporting the seconds and the top-level modules loaded
+_IMPORT_CODE = """
+import json, sys, timeit
+start_time = timeit.default_timer()
+import {module}
+seconds = timeit.default_timer() - start_time
+print(json.dumps({{'seconds': seconds, 'modules': sorted({{name.split('.')[0] for name in sys.modules}})}}))
+"""
+
+
+def peak_rss_mb(children=False) -> float:
+    """Get the peak resident set size of this process (or of its waited-for children) in MB."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    return usage.ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+class BenchmarkSuite:
+
+    def __init__(self, repeat=3, settings: Optional[dict] = None):
+        """Time the stages of scoring.
+
+        :param repeat: Number of times to run each stage. We record the fastest run, as ``timeit`` suggests.
+        :param settings: Settings of the benchmark run to record with the results, e.g. the input path.
+        """
+        self.repeat = repeat
+        self.settings = settings or {}
+        self.results: List[dict] = []
+
+    def measure(self, stage: str, fn: Callable, docs: int, batch_size: int = 0, workers=1, repeat: int = None):
+        """Time a stage, returning the output of its last run.
+
+        :param stage: Stage name.
+        :param fn: Function that runs the stage once.
+        :param docs: Number of docs processed by a run of the stage, for docs/sec. Zero if not applicable (as for
+            asset loading).
+        :param batch_size: Batch size of the run.
+        :param workers: Number of worker processes.
+        :param repeat: Number of times to run the stage, if not ``self.repeat``.
+        """
+        best = float('inf')
+        output = None
+        for _ in range(repeat or self.repeat):
+            start_time = timeit.default_timer()
+            output = fn()
+            best = min(best, timeit.default_timer() - start_time)
+        self.results.append({
+            'stage': stage,
+            'batch_size': batch_size,
+            'workers': workers,
+            'docs': docs,
+            'seconds': best,
+            'docs_per_sec': docs / best if docs and best else None,
+            'peak_rss_mb': round(max(peak_rss_mb(), peak_rss_mb(children=True)), 1),
+        })
+        print(f"[{dt.now().isoformat()}] {format_result(self.results[-1])}")
+        return output
+
+    def measure_import(self, module: str, repeat: int = None) -> dict:
+        """Time importing a module in a fresh interpreter, as stage 'import {module}', returning the result.
+
+        The result records the heavy modules (see ``HEAVY_MODULES``) that the import loaded.
+        """
+        runs = [import_time(module) for _ in range(repeat or self.repeat)]
+        seconds = min(seconds for seconds, _ in runs)
+        self.results.append({
+            'stage': f'import {module}',
+            'batch_size': 0,
+            'workers': 1,
+            'docs': 0,
+            'seconds': seconds,
+            'docs_per_sec': None,
+            'peak_rss_mb': round(max(peak_rss_mb(), peak_rss_mb(children=True)), 1),
+            'heavy_modules': sorted(set(HEAVY_MODULES) & set(runs[0][1])),
+        })
+        print(f"[{dt.now().isoformat()}] {format_result(self.results[-1])}")
+        return self.results[-1]
+
+    def to_dict(self) -> dict:
+        return {
+            'created': dt.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'settings': self.settings,
+            'results': self.results,
+        }
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Write the results as JSON."""
+        with open(path, 'wt') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def import_time(module: str, python: str = sys.executable) -> tuple:
+    """Import a module in a fresh interpreter, returning the seconds it took, and the top-level modules loaded."""
+    env = dict(os.environ)
+    # Make the fos package importable from any working directory
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(Path(__file__).parent.parent), env.get('PYTHONPATH')]))
+    output = subprocess.run([python, '-c', _IMPORT_CODE.format(module=module)], env=env, capture_output=True,
+                            text=True, check=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    return result['seconds'], result['modules']
+
+
+def check_imports(results: Sequence[dict], budget: float) -> List[str]:
+    """Check import results against a budget in seconds, and for imports of heavy modules.
+
+    :param results: Results of ``BenchmarkSuite.measure_import()``.
+    :param budget: Maximum seconds for an import.
+    :return: A description of each problem; empty if none.
+    """
+    problems = []
+    for result in results:
+        if result['seconds'] > budget:
+            problems.append(f"{result['stage']} took {result['seconds']:.3f}s (budget {budget:.3f}s)")
+        if result.get('heavy_modules'):
+            problems.append(f"{result['stage']} imported {', '.join(result['heavy_modules'])}")
+    return problems
+
+
+def format_result(result: dict) -> str:
+    rate = f"{result['docs_per_sec']:,.0f} docs/sec" if result['docs_per_sec'] else f"{result['seconds']:.3f}s"
+    return (f"{result['stage']} (batch size {result['batch_size']:,}, {result['workers']} worker(s)): {rate}, "
+            f"peak RSS {result['peak_rss_mb']:,.0f} MB")
+
+
+def load_results(path: Union[str, Path]) -> dict:
+    """Read benchmark results, as written by ``BenchmarkSuite.save()``."""
+    with open(path, 'rt') as f:
+        return json.load(f)
+
+
+def _rate(result: dict) -> float:
+    # Throughput, or for stages without a doc count (like asset loading), runs per second
+    return result['docs_per_sec'] if result['docs_per_sec'] else 1.0 / result['seconds']
+
+
+def compare(baseline: dict, current: dict, threshold=0.1) -> List[dict]:
+    """Compare benchmark results against a baseline.
+
+    :param baseline: Baseline results, as from ``load_results()``.
+    :param current: Current results.
+    :param threshold: A stage regressed if its throughput is lower than the baseline's by more than this share.
+    :return: A row for each stage, batch size and worker count in both results, with the baseline and current rates,
+        their ratio, and whether the stage regressed.
+    """
+    def key(result):
+        return result['stage'], result['batch_size'], result['workers']
+
+    baseline_results = {key(result): result for result in baseline['results']}
+    rows = []
+    for result in current['results']:
+        if key(result) not in baseline_results:
+            continue
+        baseline_rate = _rate(baseline_results[key(result)])
+        current_rate = _rate(result)
+        ratio = current_rate / baseline_rate
+        rows.append({
+            'stage': result['stage'],
+            'batch_size': result['batch_size'],
+            'workers': result['workers'],
+            'baseline': baseline_rate,
+            'current': current_rate,
+            'ratio': ratio,
+            'regressed': ratio < 1.0 - threshold,
+        })
+    return rows
+
+
+def format_comparison(rows: List[dict]) -> str:
+    lines = [f"{'stage':<20} {'batch':>8} {'workers':>7} {'baseline':>12} {'current':>12} {'ratio':>7}"]
+    for row in rows:
+        flag = '  REGRESSED' if row['regressed'] else ''
+        lines.append(f"{row['stage']:<20} {row['batch_size']:>8,} {row['workers']:>7} {row['baseline']:>12,.1f} "
+                     f"{row['current']:>12,.1f} {row['ratio']:>7.2f}{flag}")
+    return '\n'.join(lines)
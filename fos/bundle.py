@@ -0,0 +1,226 @@
+"""
+Compile the field model's assets into a bundle that loads quickly.
+
+The original assets are pickled gensim similarity indexes, a pickled tf-idf model, a gensim text dictionary and a
+pickled entity automaton, and every process that loads a FieldModel has to unpickle or parse all of them. A bundle
+holds the same data as ``.npy`` arrays, a vocabulary table and a manifest, in a directory like ``assets/en_bundle``.
+Arrays are loaded with ``mmap_mode='r'``, so startup is fast and processes loading the same bundle share one page-cache
+copy of the field matrices.
+
+The FastText model isn't included in the bundle. Load it as usual with ``load_fasttext()``.
+
+Loading a bundle doesn't unpickle anything, so we import gensim (which is slow to import) only to wrap the arrays in
+the gensim classes that ``FieldModel`` exposes.
+"""
+import json
+import os
+from datetime import datetime as dt
+from pathlib import Path
+from typing import TYPE_CHECKING, Tuple, List, Optional, Union
+
+import ahocorasick
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from fos.entity import load_entities, entity_table, create_id_automaton
+from fos.settings import ASSETS_DIR, EN_TFIDF_PATH, EN_DICT_PATH, EN_ENTITY_PATH, EN_FIELD_FASTTEXT_PATH, \
+    EN_FIELD_TFIDF_PATH, EN_FIELD_ENTITY_PATH, EN_FIELD_KEY_PATH
+from fos.vectors import load_tfidf, load_field_fasttext, load_field_tfidf, load_field_entities, load_field_keys
+
+if TYPE_CHECKING:
+    from gensim.corpora import Dictionary
+    from gensim.similarities import MatrixSimilarity, SparseMatrixSimilarity
+    from gensim.sklearn_api import TfIdfTransformer
+
+# Increment this when the bundle layout changes, so we don't load bundles compiled by an older version
+BUNDLE_VERSION = 1
+
+MANIFEST = 'manifest.json'
+
+
+def bundle_dir(lang="en") -> Path:
+    """Get the default bundle directory for a language."""
+    if lang == "en":
+        return ASSETS_DIR / 'en_bundle'
+    raise ValueError(lang)
+
+
+def source_paths(lang="en") -> dict:
+    """Get the paths of the assets from which we compile a bundle."""
+    if lang == "en":
+        return {
+            'tfidf': EN_TFIDF_PATH,
+            'dictionary': EN_DICT_PATH,
+            'entities': EN_ENTITY_PATH,
+            'field_fasttext': EN_FIELD_FASTTEXT_PATH,
+            'field_tfidf': EN_FIELD_TFIDF_PATH,
+            'field_entities': EN_FIELD_ENTITY_PATH,
+            'field_keys': EN_FIELD_KEY_PATH,
+        }
+    raise ValueError(lang)
+
+
+def compile_bundle(lang="en", output_dir: Optional[Union[str, Path]] = None) -> Path:
+    """Compile a bundle from the pickled assets.
+
+    :param lang: Language, 'en'.
+    :param output_dir: Bundle directory. By default, ``bundle_dir(lang)``.
+    :return: The bundle directory.
+    """
+    from gensim import matutils, utils
+    from gensim.models import TfidfModel
+
+    output_dir = Path(output_dir) if output_dir is not None else bundle_dir(lang)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    arrays = {}
+
+    def save(name, array):
+        np.save(output_dir / f'{name}.npy', array, allow_pickle=False)
+        arrays[name] = {'shape': list(array.shape), 'dtype': str(array.dtype)}
+
+    # Field embeddings. MatrixSimilarity indexes are dense and SparseMatrixSimilarity indexes are CSR
+    save('field_fasttext', np.ascontiguousarray(load_field_fasttext(lang).index))
+    save('field_entities', np.ascontiguousarray(load_field_entities(lang).index))
+    field_tfidf = load_field_tfidf(lang).index.tocsr()
+    field_tfidf.sort_indices()
+    save('field_tfidf.data', field_tfidf.data)
+    save('field_tfidf.indices', field_tfidf.indices)
+    save('field_tfidf.indptr', field_tfidf.indptr)
+    with open(output_dir / 'field_keys.txt', 'wt') as f:
+        f.writelines(f'{key}\n' for key in load_field_keys(lang))
+
+    # The vocabulary table gives the token for each dictionary ID, in ID order, and we store the idf for each token
+    tfidf, dictionary = load_tfidf(lang)
+    model: TfidfModel = tfidf.gensim_model
+    if set(dictionary.keys()) != set(range(len(dictionary))):
+        raise ValueError('Dictionary IDs must be contiguous from zero')
+    # The global weighting is already applied in the idfs we store. A SMART scheme like 'nfc' (the default for
+    # TfIdfTransformer) is otherwise default weighting if it keeps raw term frequencies and normalizes to unit length or
+    # not at all. Without one, TfidfModel replaces normalize=True with unitvec (and False with identity) on first use
+    if model.smartirs is not None:
+        local_scheme, _, norm_scheme = model.smartirs
+        default_weighting = local_scheme == 'n' and norm_scheme in ('n', 'c')
+        normalize = norm_scheme == 'c'
+    else:
+        default_weighting = model.wlocal is utils.identity \
+            and model.normalize in (True, False, matutils.unitvec, utils.identity)
+        normalize = model.normalize in (True, matutils.unitvec)
+    if not default_weighting or model.pivot is not None:
+        raise ValueError('Only tf-idf models with default weighting can be bundled')
+    with open(output_dir / 'vocab.txt', 'wt') as f:
+        f.writelines(f'{dictionary[i]}\n' for i in range(len(dictionary)))
+    save('idfs', np.array([model.idfs.get(i, 0.0) for i in range(len(dictionary))], dtype=np.float64))
+
+    # We store the entity keys and names in a table, and the vectors in the same order
+    entity_keys, entity_names, entity_vectors = entity_table(load_entities(lang))
+    with open(output_dir / 'entities.json', 'wt') as f:
+        json.dump({'keys': entity_keys, 'names': entity_names}, f)
+    save('entity_vectors', entity_vectors)
+
+    manifest = {
+        'version': BUNDLE_VERSION,
+        'lang': lang,
+        'created': dt.now().isoformat(),
+        'sources': {name: {'path': str(path), 'size': os.path.getsize(path), 'mtime': os.path.getmtime(path)}
+                    for name, path in source_paths(lang).items()},
+        'arrays': arrays,
+        'field_tfidf_shape': list(field_tfidf.shape),
+        'tfidf': {'normalize': normalize, 'eps': model.eps},
+    }
+    with open(output_dir / MANIFEST, 'wt') as f:
+        json.dump(manifest, f, indent=2)
+    return output_dir
+
+
+class Bundle:
+
+    def __init__(self, path: Union[str, Path]):
+        """A compiled bundle of field model assets.
+
+        :param path: Bundle directory, as from ``compile_bundle()``.
+        """
+        self.path = Path(path)
+        if not (self.path / MANIFEST).exists():
+            raise FileNotFoundError(f'No bundle manifest in {self.path}')
+        with open(self.path / MANIFEST, 'rt') as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != BUNDLE_VERSION:
+            raise ValueError(f"Bundle version is {self.manifest['version']}; expected {BUNDLE_VERSION}. "
+                             f"Recompile it with scripts/compile_bundle.py")
+
+    def load_array(self, name) -> np.ndarray:
+        """Memory-map an array in the bundle."""
+        return np.load(self.path / f'{name}.npy', mmap_mode='r')
+
+    def is_stale(self) -> bool:
+        """Check whether any source asset has changed since the bundle was compiled."""
+        for source in self.manifest['sources'].values():
+            path = Path(source['path'])
+            if path.exists() and os.path.getmtime(path) != source['mtime']:
+                return True
+        return False
+
+    def field_fasttext(self) -> 'MatrixSimilarity':
+        return self._matrix_similarity('field_fasttext')
+
+    def field_entities(self) -> 'MatrixSimilarity':
+        return self._matrix_similarity('field_entities')
+
+    def _matrix_similarity(self, name) -> 'MatrixSimilarity':
+        from gensim.similarities import MatrixSimilarity
+        index = self.load_array(name)
+        similarity = MatrixSimilarity(None, num_features=index.shape[1], corpus_len=index.shape[0])
+        similarity.index = index
+        return similarity
+
+    def field_tfidf(self) -> 'SparseMatrixSimilarity':
+        from gensim.similarities import SparseMatrixSimilarity
+        shape = tuple(self.manifest['field_tfidf_shape'])
+        similarity = SparseMatrixSimilarity(None, num_features=shape[1])
+        similarity.index = csr_matrix((self.load_array('field_tfidf.data'),
+                                       self.load_array('field_tfidf.indices'),
+                                       self.load_array('field_tfidf.indptr')), shape=shape, copy=False)
+        return similarity
+
+    def field_keys(self) -> List[str]:
+        with open(self.path / 'field_keys.txt', 'rt') as f:
+            return [x.strip() for x in f if x.strip()]
+
+    def vocab(self) -> List[str]:
+        """Load the vocabulary table, which gives the token for each dictionary ID."""
+        with open(self.path / 'vocab.txt', 'rt') as f:
+            return f.read().split('\n')[:-1]
+
+    def tfidf(self) -> Tuple['TfIdfTransformer', 'Dictionary']:
+        """Recreate the tf-idf model and its dictionary from the vocabulary table and idfs."""
+        from gensim.corpora import Dictionary
+        from gensim.models import TfidfModel
+        from gensim.sklearn_api import TfIdfTransformer
+        dictionary = Dictionary()
+        dictionary.token2id = {token: i for i, token in enumerate(self.vocab())}
+        model = TfidfModel(normalize=self.manifest['tfidf']['normalize'])
+        model.eps = self.manifest['tfidf']['eps']
+        model.idfs = {i: idf for i, idf in enumerate(self.load_array('idfs').tolist()) if idf != 0.0}
+        transformer = TfIdfTransformer()
+        transformer.gensim_model = model
+        return transformer, dictionary
+
+    def _entity_table(self) -> dict:
+        with open(self.path / 'entities.json', 'rt') as f:
+            return json.load(f)
+
+    def entities(self) -> ahocorasick.Automaton:
+        """Recreate the entity automaton, with values that are views into the memory-mapped entity vectors."""
+        table = self._entity_table()
+        vectors = self.load_array('entity_vectors')
+        trie = ahocorasick.Automaton()
+        for i, (key, name) in enumerate(zip(table['keys'], table['names'])):
+            trie.add_word(key, (key, (name, vectors[i])))
+        trie.make_automaton()
+        return trie
+
+    def entity_index(self) -> Tuple[ahocorasick.Automaton, List[str], np.ndarray]:
+        """Create an entity ID trie, as from ``fos.entity.index_entities()``, with the entity names and the
+        memory-mapped entity vectors."""
+        table = self._entity_table()
+        return create_id_automaton(table['keys']), table['names'], self.load_array('entity_vectors')
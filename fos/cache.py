@@ -0,0 +1,238 @@
+"""
+Cache publication embeddings on the disk, keyed by a hash of the preprocessed text.
+
+Most texts are unchanged from one run to the next, and embedding them again gives the same FastText, tf-idf and entity
+vectors. With an ``EmbeddingCache``, we embed only the texts we haven't seen before, and look up the rest. After a field
+vector refresh, a full rerun then costs little more than scoring.
+
+The cache is a SQLite database. Each row holds the FastText and entity vectors as float32 bytes, and the tf-idf vector
+as int32 term IDs and float64 weights. The batch scorers embed with ``TfidfEngine`` in float64 when they have a cache,
+and cast to float32 to score, so their scores are the same with or without the cache.
+
+The tf-idf weights are cached as the embedding path computed them, and the paths compute them differently:
+``FieldModel.embed()`` caches gensim's weights, which ``sparse_similarity()`` normalizes again with ``sparse_norm()``,
+while ``TfidfEngine`` normalizes them again before we cache them. The two can differ in the last bits, so a cache shared
+by both paths doesn't always give the weights that the other path would compute.
+
+Cached embeddings are only valid for the embedding models that produced them. We record a fingerprint of the model
+assets in the database, and clear the cache if it changes. Entries are evicted when they haven't been used in
+``max_age_days``, or least-recently-used first when there are more than ``max_entries``.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from fos.bundle import MANIFEST
+from fos.entity import entity_index_paths
+from fos.settings import EN_FASTTEXT_PATH, EN_TFIDF_PATH, EN_DICT_PATH, EN_ENTITY_PATH, EN_ENTITY_INDEX_PATH
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of parameters in a statement; we look up keys in chunks of this size
+LOOKUP_CHUNK_SIZE = 500
+
+# Embedding function signature: texts -> (N x D FastText vectors, N x T CSR tf-idf matrix, N x D entity vectors)
+EmbedFunction = Callable[[Sequence[str]], Tuple[np.ndarray, csr_matrix, np.ndarray]]
+
+
+def text_key(text: str) -> bytes:
+    """Hash a preprocessed text for a cache key."""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def asset_fingerprint(lang="en", fasttext_table: Optional[Union[str, Path]] = None,
+                      bundle: Optional[Union[str, Path]] = None) -> str:
+    """Fingerprint the assets used to embed publications (but not the field embeddings) by their sizes and mtimes.
+
+    :param lang: Language, 'en'.
+    :param fasttext_table: Optionally, the directory of a word vector table that replaces the FastText model, as with
+        ``FieldModel(fasttext_table=...)``.
+    :param bundle: Optionally, the directory of a compiled asset bundle from which the tf-idf model and entities are
+        loaded, as with ``FieldModel(bundle=...)``.
+    """
+    if lang == "en":
+        # We embed entities with the entity index when it's up to date, and otherwise with the entity trie
+        paths = [EN_FASTTEXT_PATH, EN_TFIDF_PATH, EN_DICT_PATH, EN_ENTITY_PATH,
+                 *entity_index_paths(EN_ENTITY_INDEX_PATH)]
+    else:
+        raise ValueError(lang)
+    if fasttext_table is not None:
+        paths[0] = Path(fasttext_table) / 'word_vectors.npy'
+    if bundle is not None:
+        # Compiling a bundle rewrites its manifest
+        paths.append(Path(bundle) / MANIFEST)
+    stats = [f'{path.name}:{os.path.getsize(path)}:{os.path.getmtime(path)}' for path in paths if path.exists()]
+    return hashlib.blake2b('\n'.join(stats).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class CacheStats:
+
+    def __init__(self):
+        """Counts of cache lookups."""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self) -> str:
+        return (f'{self.hits:,} hits, {self.misses:,} misses ({self.hit_rate():.1%} hit rate), '
+                f'{self.evictions:,} evictions')
+
+
+class EmbeddingCache:
+
+    def __init__(self, path: Union[str, Path], fingerprint: Optional[str] = None, max_age_days: Optional[float] = None,
+                 max_entries: Optional[int] = None):
+        """An on-disk cache of publication embeddings.
+
+        :param path: Path to the SQLite database, which is created if it doesn't exist.
+        :param fingerprint: Fingerprint of the embedding models, as from ``asset_fingerprint()``. If it differs from
+            the fingerprint recorded in the database, the cache is cleared.
+        :param max_age_days: On ``evict()``, remove entries that haven't been used in this many days.
+        :param max_entries: On ``evict()``, remove the least-recently-used entries beyond this many.
+        """
+        self.path = Path(path)
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self._pid = None
+        self._connection = None
+        db = self.db
+        db.execute('create table if not exists meta (name text primary key, value text)')
+        db.execute('create table if not exists embeddings (key blob primary key, fasttext blob, entity blob, '
+                   'tfidf_indices blob, tfidf_data blob, accessed real) without rowid')
+        db.execute('create index if not exists embeddings_accessed on embeddings (accessed)')
+        if fingerprint is not None:
+            row = db.execute("select value from meta where name = 'fingerprint'").fetchone()
+            if row is not None and row[0] != fingerprint:
+                logger.warning(f'Embedding models have changed; clearing the embedding cache in {self.path}')
+                db.execute('delete from embeddings')
+            db.execute("insert or replace into meta values ('fingerprint', ?)", (fingerprint,))
+        db.commit()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared with forked processes, so e.g. each scoring worker opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(str(self.path), timeout=600, check_same_thread=False)
+            self._connection.execute('pragma journal_mode=wal')
+            self._pid = os.getpid()
+        return self._connection
+
+    def __len__(self):
+        return self.db.execute('select count(*) from embeddings').fetchone()[0]
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, tuple]:
+        """Look up embeddings by key, returning a dict of (fasttext, entity, tfidf_indices, tfidf_data) bytes for the
+        keys in the cache, and marking them as used."""
+        found = {}
+        db = self.db
+        for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            chunk = keys[start:start + LOOKUP_CHUNK_SIZE]
+            rows = db.execute(f'select key, fasttext, entity, tfidf_indices, tfidf_data from embeddings '
+                              f'where key in ({",".join("?" * len(chunk))})', chunk)
+            found.update((row[0], row[1:]) for row in rows)
+        now = time.time()
+        db.executemany('update embeddings set accessed = ? where key = ?', ((now, key) for key in found))
+        db.commit()
+        return found
+
+    def put_many(self, keys: Sequence[bytes], fasttext: np.ndarray, dtm: csr_matrix, entity: np.ndarray) -> None:
+        """Add a batch of embeddings to the cache.
+
+        :param keys: Keys, as from ``text_key()``.
+        :param fasttext: N x D FastText embeddings.
+        :param dtm: N x T tf-idf embeddings.
+        :param entity: N x D entity embeddings.
+        """
+        fasttext = np.asarray(fasttext, dtype=np.float32)
+        entity = np.asarray(entity, dtype=np.float32)
+        indices = dtm.indices.astype(np.int32)
+        data = dtm.data.astype(np.float64)
+        now = time.time()
+        rows = ((key, fasttext[i].tobytes(), entity[i].tobytes(),
+                 indices[dtm.indptr[i]:dtm.indptr[i + 1]].tobytes(), data[dtm.indptr[i]:dtm.indptr[i + 1]].tobytes(),
+                 now)
+                for i, key in enumerate(keys))
+        self.db.executemany('insert or replace into embeddings values (?, ?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def embed(self, texts: Sequence[str], embed: EmbedFunction, n_terms: int) \
+            -> Tuple[np.ndarray, csr_matrix, np.ndarray]:
+        """Embed a batch of texts, looking up those in the cache and embedding and caching the rest.
+
+        :param texts: Preprocessed texts.
+        :param embed: Function that embeds the texts that aren't in the cache.
+        :param n_terms: Size of the tf-idf vocabulary.
+        :return: N x D float32 FastText embeddings, N x T float64 CSR tf-idf embeddings, and N x D float32 entity
+            embeddings.
+        """
+        keys = [text_key(text) for text in texts]
+        found = self.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        self.stats.hits += len(texts) - len(missing)
+        self.stats.misses += len(missing)
+
+        rows: List[Optional[tuple]] = [found.get(key) for key in keys]
+        if missing:
+            miss_ft, miss_dtm, miss_ent = embed([texts[i] for i in missing])
+            miss_dtm = csr_matrix(miss_dtm)
+            self.put_many([keys[i] for i in missing], miss_ft, miss_dtm, miss_ent)
+            for j, i in enumerate(missing):
+                start, stop = miss_dtm.indptr[j], miss_dtm.indptr[j + 1]
+                rows[i] = (np.asarray(miss_ft[j], dtype=np.float32), np.asarray(miss_ent[j], dtype=np.float32),
+                           miss_dtm.indices[start:stop].astype(np.int32), miss_dtm.data[start:stop].astype(np.float64))
+        return self._assemble(rows, n_terms)
+
+    @staticmethod
+    def _assemble(rows: Iterable[tuple], n_terms: int) -> Tuple[np.ndarray, csr_matrix, np.ndarray]:
+        # Rows are cached bytes or freshly embedded arrays, either of which np.frombuffer() accepts
+        fasttext, entity, indices, data = zip(*((np.frombuffer(ft, dtype=np.float32),
+                                                 np.frombuffer(ent, dtype=np.float32),
+                                                 np.frombuffer(idx, dtype=np.int32),
+                                                 np.frombuffer(values, dtype=np.float64))
+                                                for ft, ent, idx, values in rows))
+        indptr = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in indices], out=indptr[1:])
+        dtm = csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(len(indices), n_terms))
+        return np.stack(fasttext), dtm, np.stack(entity)
+
+    def evict(self) -> int:
+        """Remove entries not used in ``max_age_days`` and the least-recently-used entries beyond ``max_entries``,
+        returning the count removed."""
+        db = self.db
+        evicted = 0
+        if self.max_age_days is not None:
+            cutoff = time.time() - self.max_age_days * 86400
+            evicted += db.execute('delete from embeddings where accessed < ?', (cutoff,)).rowcount
+        if self.max_entries is not None:
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                evicted += db.execute('delete from embeddings where key in '
+                                      '(select key from embeddings order by accessed limit ?)', (excess,)).rowcount
+        db.commit()
+        self.stats.evictions += evicted
+        return evicted
+
+    def close(self) -> None:
+        """Evict entries and close the database."""
+        self.evict()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,177 @@
+"""
+Checkpoint long batch scoring runs, so they can resume after an interruption.
+
+With checkpointing, the output for each input shard goes to part files in a parts directory, and a manifest there
+records each shard's closed parts and their record counts. We replace the manifest atomically, so it only ever describes
+complete parts, even if the process dies while writing it.
+
+On SIGTERM (as when a preemptible VM is stopped), scoring stops once the current batch is written, and the shard's
+parts so far are recorded with the shard marked incomplete. On resume, complete shards are skipped, incomplete shards
+pick up after their recorded records, and any part file missing from the manifest (e.g. one that was open when the
+process died) is discarded. Once every shard is complete, the parts are concatenated in input order.
+"""
+import json
+import multiprocessing as mp
+import os
+import shutil
+import signal
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+MANIFEST = 'manifest.json'
+
+
+class StopFlag:
+
+    def __init__(self, signals=(signal.SIGTERM,)):
+        """A flag that's set when the process receives a signal, so scoring loops can stop between batches.
+
+        The handler is installed on creation. The flag is in shared memory, so worker processes forked afterwards see it
+        set too. Create their pool with ``ignore_signals()`` as its initializer, so that they ignore signals sent to the
+        whole process group (as on a VM shutdown) and stop between batches once this process sets the flag. Because the
+        workers ignore SIGTERM, ``Pool.terminate()`` can't stop them: set the flag, then close and join the pool.
+
+        :param signals: Signals to handle.
+        """
+        self._flag = mp.get_context('fork').RawValue('b', 0)
+        self.signals = signals
+        self._previous = {signum: signal.signal(signum, self._handle) for signum in signals}
+
+    @property
+    def is_set(self) -> bool:
+        return bool(self._flag.value)
+
+    def set(self) -> None:
+        """Set the flag, as on a signal, e.g. to stop workers."""
+        self._flag.value = 1
+
+    def _handle(self, signum, frame) -> None:
+        if not self.is_set:
+            print(f'Received signal {signum}; stopping after the current batch')
+        self.set()
+
+    def restore(self) -> None:
+        """Restore the previous signal handlers."""
+        for signum, handler in self._previous.items():
+            signal.signal(signum, handler)
+
+    def __bool__(self):
+        return self.is_set
+
+
+def ignore_signals(signals=(signal.SIGTERM,)) -> None:
+    """Ignore signals in a worker process, which should stop when a ``StopFlag`` in its parent is set instead."""
+    for signum in signals:
+        signal.signal(signum, signal.SIG_IGN)
+
+
+def until_stopped(batches: Iterable, stop: StopFlag) -> Iterator:
+    """Stop yielding batches once ``stop`` is set."""
+    for batch in batches:
+        if stop:
+            break
+        yield batch
+
+
+def poll_results(results, interval=0.1) -> Iterator:
+    """Yield the results of ``Pool.imap()`` or ``Pool.imap_unordered()``, waking up every ``interval`` seconds.
+
+    A signal can be delivered to one of the pool's threads, and its Python handler then waits until the main thread
+    wakes up. Without a timeout, that would be when the next result arrives, which can be after a whole shard.
+    """
+    while True:
+        try:
+            yield results.next(timeout=interval)
+        except mp.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+
+def skip_records(batches: Iterable, n: int, size: Callable = len) -> Iterator:
+    """Skip the first ``n`` records of batches that are tuples of columns, as from ``iter_bq_file_batches()``.
+
+    :param batches: Iterable of batches.
+    :param n: Number of records to skip.
+    :param size: Function giving the number of records in a batch.
+    """
+    for batch in batches:
+        if n >= size(batch):
+            n -= size(batch)
+            continue
+        if n:
+            batch = tuple(column[n:] for column in batch)
+            n = 0
+        yield batch
+
+
+class Checkpoint:
+
+    def __init__(self, path: Union[str, Path], settings: Optional[dict] = None, resume=False):
+        """Track the scoring progress of input shards in a manifest.
+
+        :param path: Parts directory.
+        :param settings: Settings of the run, like the output format. Resuming a run with different settings is an
+            error, because its parts couldn't be concatenated.
+        :param resume: If true, resume from an existing manifest in the parts directory. Otherwise, any existing
+            parts directory is cleared.
+        """
+        self.path = Path(path)
+        self.settings = settings or {}
+        self.shards: Dict[str, dict] = {}
+        if resume and (self.path / MANIFEST).exists():
+            with open(self.path / MANIFEST, 'rt') as f:
+                manifest = json.load(f)
+            if manifest['settings'] != self.settings:
+                raise ValueError(f"Can't resume a run with settings {manifest['settings']} with {self.settings}")
+            self.shards = manifest['shards']
+            # Discard parts that weren't recorded
+            recorded = {part['name'] for shard in self.shards.values() for part in shard['parts']}
+            for path in self.path.iterdir():
+                if path.name != MANIFEST and path.name not in recorded:
+                    path.unlink()
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path.mkdir(parents=True)
+
+    def count(self, shard: str) -> int:
+        """Get the number of a shard's records that have been scored."""
+        return sum(part['count'] for part in self.shards.get(shard, {}).get('parts', []))
+
+    def total(self) -> int:
+        """Get the number of records that have been scored."""
+        return sum(self.count(shard) for shard in self.shards)
+
+    def is_complete(self, shard: str) -> bool:
+        return self.shards.get(shard, {}).get('complete', False)
+
+    def next_part(self, shard: str, suffix: str) -> Path:
+        """Get the path for a shard's next part file."""
+        return self.path / f"{shard}.{len(self.shards.get(shard, {}).get('parts', [])):03}{suffix}"
+
+    def record(self, shard: str, part_path: Path, count: int, complete: bool) -> None:
+        """Record a closed part file of a shard, and whether the shard is complete."""
+        # Make sure the part is on the disk before the manifest refers to it
+        with open(part_path, 'rb') as f:
+            os.fsync(f.fileno())
+        entry = self.shards.setdefault(shard, {'parts': [], 'complete': False})
+        entry['parts'].append({'name': part_path.name, 'count': count})
+        entry['complete'] = complete
+        self.save()
+
+    def save(self) -> None:
+        """Write the manifest atomically, by writing a temporary file and renaming it."""
+        tmp_path = self.path / f'{MANIFEST}.tmp'
+        with open(tmp_path, 'wt') as f:
+            json.dump({'settings': self.settings, 'shards': self.shards}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path / MANIFEST)
+
+    def parts(self, shards: Iterable[str]) -> List[Path]:
+        """List the part files of shards, in order."""
+        return [self.path / part['name'] for shard in shards for part in self.shards.get(shard, {}).get('parts', [])]
+
+    def remove(self) -> None:
+        """Remove the parts directory."""
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,68 @@
+"""
+Restrict L2/L3 field scoring to the fields under a publication's top L0 and L1 fields.
+
+A publication is eligible for the L2/L3 descendants of an (L0, L1) field pair if both are among its top three L0 and
+top three L1 fields, respectively. ``batch_score_corpus_constrained.py`` scores publications for L2/L3 fields only where
+they're eligible, and ``score_field_columns.py`` does the same for the columns it scores.
+"""
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+from fos.settings import ASSETS_DIR
+
+
+def load_meta():
+    """Load field metadata."""
+    return pd.read_json(ASSETS_DIR / 'fields/field_meta.jsonl', lines=True)
+
+
+def check_constraints(top_l0, top_l1, constraint_l0, constraint_l1):
+    """Find the constraints for which documents are eligible given their top L0s and top L1s.
+
+    :param top_l0: N x K array of the indexes of each document's top L0 fields.
+    :param top_l1: N x K array of the indexes of each document's top L1 fields.
+    :param constraint_l0: Array of the L0 field index for each of G constraints.
+    :param constraint_l1: Array of the L1 field index for each of G constraints.
+    :return: N x G boolean array, true where a document is eligible for the L2/3s of a constraint.
+    """
+    l0_match = (top_l0[:, :, None] == constraint_l0[None, None, :]).any(axis=1)
+    l1_match = (top_l1[:, :, None] == constraint_l1[None, None, :]).any(axis=1)
+    return l0_match & l1_match
+
+
+def load_constraints() -> Dict[Tuple[int, int], List[int]]:
+    """Load constraints as a dict mapping L0 and L1 field indexes to their descendant
+     L2 and L3 field indexes.
+
+    There are 12 (L0, L1) field pairs that have L2/L3 descendants. After scoring papers
+    for L0/L1s, we only want to score them for L2s and L3s that they're eligible for. We
+    require a top three L0 score and a top three L1 score for a paper to be eligible for
+    the L2/L3 descendants of that L0 and L1.
+    """
+    # meta gives us the levels for each field, which don't appear in the children table
+    meta = load_meta()
+    # The children table gives us all parent-child pairs, so we start by selecting the
+    #  L0-L1 pairs.
+    children = pd.read_json(ASSETS_DIR / 'fields/field_children.jsonl', lines=True)
+    l0_l1 = children.loc[children['parent_name'].isin(meta.loc[meta.level == 0, 'name'])]. \
+        rename(columns={'parent_name': 'l0', 'child_name': 'l1'})
+    # Inner joining the L0-L1 pairs with the children table then gives us each L0,L1,L2/3 triple,
+    # because the L3s are descendants of L1s, and not children of specific L2s. (They're clearly
+    # lower-level than L2s, but placing them under particular L2s wasn't possible.)
+    constraints = pd.merge(l0_l1, children.rename(columns={'parent_name': 'l1'}), on='l1')
+    # Aggregating over L2/L3s we get a list of the L2s/L3s for each L0-L1 pair
+    constraints = constraints.groupby(['l0', 'l1'], as_index=False).agg(child_name=('child_name', list))
+
+    # For slicing field embedding matrices we need indexes, not field names
+    def to_indices(names):
+        return [meta['name'][meta['name'] == name].index[0] for name in names]
+
+    # Map the field names to indices
+    constraints['child_idx'] = constraints['child_name'].apply(to_indices)
+    constraints['l0_idx'] = to_indices(constraints['l0'])
+    constraints['l1_idx'] = to_indices(constraints['l1'])
+
+    # Return a mapping that looks like (8, 1) => [755, 756, 757]
+    constraints.set_index(['l0_idx', 'l1_idx'], inplace=True)
+    return constraints['child_idx'].to_dict()
@@ -3,26 +3,32 @@ from pathlib import Path
 from google.cloud import bigquery
 
 from fos import gcp
-from fos.gcp import write_query, extract_table, delete_blobs, set_default_clients
-from fos.settings import CORPUS_DIR, QUERY_PATH
+from fos.gcp import write_query, extract_table, delete_blobs, set_default_clients, EXTRACT_FORMATS
+from fos.settings import CORPUS_DIR, QUERY_PATH, RAW_QUERY_PATH
 
 
-def download(lang='en', output_dir=CORPUS_DIR, query_path=QUERY_PATH, limit=1000, skip_prev=False,
+def download(lang='en', output_dir=CORPUS_DIR, query_path=None, limit=1000, skip_prev=False,
              use_default_clients=False, bq_dest='field_model_replication', extract_bucket='fields-of-study',
-             extract_prefix=None):
+             extract_prefix=None, extract_format='jsonl', raw_text=False):
     """Download a preprocessed corpus.
 
     :param lang: Language code, 'en'.
     :param output_dir: Directory for extract files.
-    :param query_path: Path to SQL file.
+    :param query_path: Path to SQL file. By default, ``corpus.sql``, or with ``raw_text``, ``raw_corpus.sql``.
     :param limit: Record limit.
     :param skip_prev: If true, skips unchanged records
     :param use_default_clients: If true, reads credentials from environment
     :param bq_dest: Dataset in BQ where data should be written
     :param extract_bucket: Bucket in GCS where exported jsonl should be written
     :param extract_prefix: GCS prefix where exported jsonl should be written within `extract_bucket`
+    :param extract_format: Extract as gzipped JSONL ('jsonl') or as Parquet ('parquet')
+    :param raw_text: If true, download raw titles and abstracts instead of preprocessed text, for
+        ``batch_score_corpus_constrained.py --raw-text``. The query results go to their own table, so they don't replace
+        the corpus table from which we update ``prev_{lang}_corpus``, but the extract files have the usual names
     """
-    query_destination = f'{bq_dest}.{lang}_corpus'
+    if query_path is None:
+        query_path = RAW_QUERY_PATH if raw_text else QUERY_PATH
+    query_destination = f'{bq_dest}.{lang}_raw_corpus' if raw_text else f'{bq_dest}.{lang}_corpus'
     extract_prefix = extract_prefix if extract_prefix else f'model-replication/{lang}_corpus-'
 
     # we'll write to {output_dir}/{lang}.tsv; check up front the directory exists
@@ -46,5 +52,6 @@ def download(lang='en', output_dir=CORPUS_DIR, query_path=QUERY_PATH, limit=1000
                 query_parameters=[bigquery.ScalarQueryParameter("lang", "STRING", lang)],
                 clobber=True)
     delete_blobs(extract_bucket, extract_prefix)
-    extract_table(query_destination, f'gs://{extract_bucket}/{extract_prefix}*.jsonl.gz')
+    suffix = EXTRACT_FORMATS[extract_format][2]
+    extract_table(query_destination, f'gs://{extract_bucket}/{extract_prefix}*{suffix}', extract_format)
     gcp.download(extract_bucket, extract_prefix, output_dir)
@@ -10,39 +10,155 @@ We've done the same in our replication, but with FastText vectors. When embeddin
 (field) mentions and then define its entity embedding as the average over the vectors of mentioned entities.
 Specifically, we use Aho-Corasick over tokens, as implemented in pyahocorasick
 (https://pyahocorasick.readthedocs.io/en/latest/).
+
+To embed a batch of texts, it's faster to use an automaton whose values are integer entity IDs (see
+``index_entities()``). We count the mentions of each entity in each text, and then the entity embeddings for the batch
+are the product of the sparse count matrix and a matrix of entity vectors.
+
+The pickled entity vector trie holds a tuple and a separate numpy array for every entity, so it's slow to unpickle.
+``write_entity_index()`` saves the entity ID trie instead, with the entity vectors as one E x D float32 ``.npy`` array
+(memory-mapped when loaded) and the entity names as JSON. ``embed_entities()`` and ``find_keywords()`` take either
+kind of trie.
 """
 import json
+import logging
+import os
 import pickle
-from typing import Tuple, Optional
+from pathlib import Path
+from typing import Callable, Iterable, Tuple, Optional, List, Sequence, Union
 
 import ahocorasick
 import numpy as np
+from scipy.sparse import csr_matrix
+
+from fos.settings import ASSETS_DIR, FASTTEXT_DIM, EN_ENTITY_PATH, EN_ENTITY_INDEX_PATH
+from fos.vectors import norm_sum, row_norm
 
-from fos.settings import ASSETS_DIR, FASTTEXT_DIM
-from fos.vectors import norm_sum
+logger = logging.getLogger(__name__)
 
 
-def embed_entities(text, trie) -> Optional[np.ndarray]:
+def embed_entities(text, trie, vectors: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
     """Embed entity mentions in text.
 
     Per the LanguageSimilarity code, the entity embedding is the l2-normed sum of the vectors for entities that appear
     in the text.
 
     :param text: Input text.
-    :param trie: Entity vector trie.
+    :param trie: Entity vector trie, or with ``vectors``, an entity ID trie.
+    :param vectors: For an entity ID trie, the entity vectors in order of ID.
     :return: A vector if any entity mentions are in the input text; otherwise None.
     """
-    vectors = [v for _, (k, v) in find_keywords(text, trie)]
+    if vectors is not None:
+        entity_ids = [entity_id for _, entity_id in trie.iter_long(text)]
+        vectors = vectors[entity_ids]
+    else:
+        vectors = [v for _, (k, v) in find_keywords(text, trie)]
     if not len(vectors):
         return np.zeros(FASTTEXT_DIM, dtype=np.float32)
     return norm_sum(vectors)
 
 
-def find_keywords(text: str, trie: ahocorasick.Automaton) -> Tuple[str, np.ndarray]:
+def batch_embed_entities(texts: Sequence[str], trie: ahocorasick.Automaton, vectors: np.ndarray) -> np.ndarray:
+    """Embed entity mentions in a batch of texts.
+
+    This gives the same embeddings as ``embed_entities()``, up to float32 rounding (we sum the vectors of mentioned
+    entities in a different order).
+
+    :param texts: Input texts.
+    :param trie: Entity ID trie, as from ``index_entities()``.
+    :param vectors: Entity vectors, in order of entity ID.
+    :return: N x D array of l2-normed entity embeddings. Rows are zeroed for texts without any entity mentions.
+    """
+    counts = count_entities(texts, trie, len(vectors))
+    return row_norm(counts @ vectors)
+
+
+def count_entities(texts: Sequence[str], trie: ahocorasick.Automaton, n_entities: int) -> csr_matrix:
+    """Count the longest-matching entity mentions in a batch of texts.
+
+    :param texts: Input texts.
+    :param trie: Entity ID trie, as from ``index_entities()``.
+    :param n_entities: Number of entities.
+    :return: N x E sparse matrix of mention counts.
+    """
+    entity_ids = []
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        n_before = len(entity_ids)
+        entity_ids.extend(entity_id for _, entity_id in trie.iter_long(text))
+        lengths[i] = len(entity_ids) - n_before
+    doc_ids = np.repeat(np.arange(len(texts)), lengths)
+    # Duplicate (doc, entity) pairs are summed
+    return csr_matrix((np.ones(len(entity_ids), dtype=np.float32), (doc_ids, np.array(entity_ids, dtype=np.int64))),
+                      shape=(len(texts), n_entities))
+
+
+def wiki_entity(value) -> Tuple[str, np.ndarray]:
+    """Get the name and vector of an entity from its value in the Wiki entity trie, a (key, (name, vector)) tuple."""
+    return value[1]
+
+
+def mag_entity(value) -> Tuple[str, np.ndarray]:
+    """Get the name and vector of an entity from its value in a MAG entity trie (see ``create_mag_entity_trie.py``), an
+    (entity, vector) tuple in which the entity is its own name."""
+    return value
+
+
+def entity_table(trie: ahocorasick.Automaton, unpack: Callable = wiki_entity) \
+        -> Tuple[List[str], List[str], np.ndarray]:
+    """Get the keys, names and vectors of the entities in an entity vector trie, in the same order.
+
+    :param trie: Entity vector trie, as from ``load_entities()``.
+    :param unpack: Function getting the (name, vector) of an entity from its value in the trie, e.g. ``mag_entity`` for
+        a MAG entity trie.
+    :return: Entity keys, entity names, and an E x D array of entity vectors.
+    """
+    keys = []
+    names = []
+    vectors = []
+    for key, value in trie.items():
+        name, vector = unpack(value)
+        keys.append(key)
+        names.append(name)
+        vectors.append(vector)
+    return keys, names, np.array(vectors, dtype=np.float32).reshape(len(names), -1 if names else FASTTEXT_DIM)
+
+
+def create_id_automaton(keys: Iterable[str]) -> ahocorasick.Automaton:
+    """Create an entity ID trie, whose values are the positions of the keys."""
+    id_trie = ahocorasick.Automaton(ahocorasick.STORE_INTS)
+    for entity_id, key in enumerate(keys):
+        id_trie.add_word(key, entity_id)
+    id_trie.make_automaton()
+    return id_trie
+
+
+def index_entities(trie: ahocorasick.Automaton, unpack: Callable = wiki_entity) \
+        -> Tuple[ahocorasick.Automaton, List[str], np.ndarray]:
+    """Convert an entity vector trie into one whose values are entity IDs.
+
+    :param trie: Entity vector trie, as from ``load_entities()``.
+    :param unpack: Function getting the (name, vector) of an entity from its value in the trie (see ``entity_table()``).
+    :return: Entity ID trie, entity names in order of ID, and an E x D array of entity vectors in order of ID.
+    """
+    keys, names, vectors = entity_table(trie, unpack)
+    return create_id_automaton(keys), names, vectors
+
+
+def find_keywords(text: str, trie: ahocorasick.Automaton, vectors: Optional[np.ndarray] = None) \
+        -> Tuple[str, np.ndarray]:
     """Find in text the longest-matching entities in the trie.
 
-    :return: Yields tuples of the matching key and its value.
+    :param text: Input text.
+    :param trie: Entity vector trie, or with ``vectors``, an entity ID trie.
+    :param vectors: For an entity ID trie, the entity vectors in order of ID.
+    :return: Yields tuples of the matching key and its value. For an entity ID trie, yields tuples of the entity ID
+        and its vector.
     """
+    if vectors is not None:
+        for end_index, entity_id in trie.iter_long(text):
+            yield entity_id, vectors[entity_id]
+        return
     for end_index, (k, v) in trie.iter_long(text):
         yield k, v
 
@@ -53,6 +169,59 @@ def load_entities(lang="en") -> ahocorasick.Automaton:
     return trie
 
 
+def entity_index_paths(path: Union[str, Path]) -> Tuple[Path, Path, Path]:
+    """Get the paths of an entity ID trie, as from ``write_entity_index()``, and its entity vectors and names."""
+    path = Path(path)
+    return path, path.with_suffix('.vectors.npy'), path.with_suffix('.names.json')
+
+
+def write_entity_index(trie: ahocorasick.Automaton, names: List[str], vectors: np.ndarray,
+                       path: Union[str, Path] = EN_ENTITY_INDEX_PATH) -> Path:
+    """Write an entity ID trie, as from ``index_entities()``, with its entity names and vectors.
+
+    :param trie: Entity ID trie.
+    :param names: Entity names, in order of ID.
+    :param vectors: E x D array of entity vectors, in order of ID.
+    :param path: Path for the pickled trie. The vectors and names are written alongside it (see
+        ``entity_index_paths()``).
+    :return: The trie path.
+    """
+    trie_path, vectors_path, names_path = entity_index_paths(path)
+    with open(trie_path, 'wb') as f:
+        pickle.dump(trie, f)
+    np.save(vectors_path, np.ascontiguousarray(vectors, dtype=np.float32), allow_pickle=False)
+    with open(names_path, 'wt') as f:
+        json.dump(list(names), f)
+    return trie_path
+
+
+def read_entity_index(path: Union[str, Path]) -> Tuple[ahocorasick.Automaton, List[str], np.ndarray]:
+    """Read an entity ID trie written by ``write_entity_index()``, with its names and memory-mapped vectors."""
+    trie_path, vectors_path, names_path = entity_index_paths(path)
+    with open(trie_path, 'rb') as f:
+        trie = pickle.load(f)
+    with open(names_path, 'rt') as f:
+        names = json.load(f)
+    return trie, names, np.load(vectors_path, mmap_mode='r')
+
+
+def load_entity_index(lang="en") -> Tuple[ahocorasick.Automaton, List[str], np.ndarray]:
+    """Load the entity ID trie, names and vectors, as from ``index_entities(load_entities())``.
+
+    We read them from ``write_entity_index()`` output if it's at least as new as the entity vector trie; otherwise, we
+    index the entity vector trie.
+    """
+    if lang == "en":
+        path, trie_path = EN_ENTITY_INDEX_PATH, EN_ENTITY_PATH
+    else:
+        raise ValueError(lang)
+    if path.exists():
+        if not trie_path.exists() or os.path.getmtime(path) >= os.path.getmtime(trie_path):
+            return read_entity_index(path)
+        logger.warning(f'{trie_path} is newer than {path}; indexing it instead')
+    return index_entities(load_entities(lang))
+
+
 def read_trie(path):
     """Read LanguageSimilarity-formatted entity trie
 
@@ -26,6 +26,12 @@ from tqdm import tqdm
 PROJECT_ID = 'gcp-cset-projects'
 KEY_PATH = Path(__file__).parent / '../key.json'
 
+# Destination format, compression and file suffix for each format in which we extract tables
+EXTRACT_FORMATS = {
+    'jsonl': ('NEWLINE_DELIMITED_JSON', 'GZIP', '.jsonl.gz'),
+    'parquet': ('PARQUET', 'SNAPPY', '.parquet'),
+}
+
 _bq_client = None
 _storage_client = None
 _credentials = None
@@ -100,14 +106,16 @@ def write_query(sql: Union[str, Path],
     return job
 
 
-def extract_table(table: str, destination: str):
-    """Extract a BQ table to GCS as gzipped JSONL.
+def extract_table(table: str, destination: str, extract_format='jsonl'):
+    """Extract a BQ table to GCS as gzipped JSONL or as Parquet.
 
     :param table: Source as ``dataset.table``.
-    :param destination: GCS path starting with ``gs://`` and ending with ``-*.jsonl.gz``.
+    :param destination: GCS path starting with ``gs://`` and ending with ``-*.jsonl.gz`` (or ``-*.parquet``).
+    :param extract_format: 'jsonl' or 'parquet'.
     :return:
     """
-    assert destination.endswith('*.jsonl.gz')
+    destination_format, compression, suffix = EXTRACT_FORMATS[extract_format]
+    assert destination.endswith(f'*{suffix}')
     client = create_bq_client()
     dataset_id, table_id = table.split('.')
     dataset_ref = bigquery.DatasetReference(PROJECT_ID, dataset_id)
@@ -115,7 +123,7 @@ def extract_table(table: str, destination: str):
     job = client.extract_table(
         table_ref,
         destination,
-        job_config=ExtractJobConfig(destination_format="NEWLINE_DELIMITED_JSON", compression="GZIP"),
+        job_config=ExtractJobConfig(destination_format=destination_format, compression=compression),
         location="US",
     )
     # Block
@@ -154,13 +162,14 @@ def delete_blobs(bucket: str, prefix: str) -> None:
         print(f'Deleted {blob.name}')
 
 
-def download_table(table: str, bucket: str, prefix: str, output_dir: Path):
+def download_table(table: str, bucket: str, prefix: str, output_dir: Path, extract_format='jsonl'):
     """
 
     :param table: Table to extract as '{dataset}.{table}'
     :param bucket: Bucket for extraction.
     :param prefix: Prefix for extracted and downloaded files (without '-*.jsonl.gz' suffix).
     :param output_dir: Output directory on the disk.
+    :param extract_format: 'jsonl' or 'parquet'.
     :return:
     """
     # Check the output_dir first so we fail early
@@ -170,7 +179,7 @@ def download_table(table: str, bucket: str, prefix: str, output_dir: Path):
         raise ValueError(f'Empty prefix will delete all blobs in the {bucket} bucket')
     # Delete any prior extracts with the same prefix
     delete_blobs(bucket, prefix)
-    extract_table(table, f'gs://{bucket}/{prefix}-*.jsonl.gz')
+    extract_table(table, f'gs://{bucket}/{prefix}-*{EXTRACT_FORMATS[extract_format][2]}', extract_format)
     download(bucket, prefix, output_dir)
 
 
@@ -179,7 +188,8 @@ def download_query(sql: Union[str, Path],
                    bucket: str,
                    prefix: str,
                    output_dir: Path,
-                   clobber=False):
+                   clobber=False,
+                   extract_format='jsonl'):
     """
 
     :param sql: Query to write to table.
@@ -188,9 +198,10 @@ def download_query(sql: Union[str, Path],
     :param prefix: (without '*.jsonl.gz' suffix)
     :param output_dir: Output directory on the disk.
     :param clobber: If True, overwrite any existing table contents.
+    :param extract_format: 'jsonl' or 'parquet'.
     """
     write_query(sql, table, clobber=clobber)
-    download_table(table, bucket, prefix, output_dir)
+    download_table(table, bucket, prefix, output_dir, extract_format)
 
 
 def get_schema(dataset: str, table: str) -> List[SchemaField]:
@@ -0,0 +1,223 @@
+"""
+Record runtime metrics for scoring jobs, as JSON lines and an optional Prometheus textfile.
+
+Printing a doc count and elapsed time per batch doesn't say where time and memory go on a production run. A
+``MetricsRecorder`` accumulates the time and docs of each stage (e.g. reading, FastText embedding, scoring, writing),
+and counts of events like empty embeddings. After each batch, it writes a JSON line with the batch's size and latency,
+stage throughput so far, counters, queue depths, cache hit rate, peak RSS and optionally the top allocations from
+``tracemalloc``. When it's closed, it writes a summary with batch latency percentiles.
+
+With a Prometheus textfile path (e.g. in the node exporter's ``--collector.textfile.directory``), the same metrics are
+also written in the Prometheus text format after each batch, replacing the file atomically. Worker processes forked
+from the process that created the recorder append to the same JSON lines file (each line is one write), but only the
+creating process writes the textfile.
+"""
+import contextlib
+import json
+import os
+import threading
+import timeit
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+
+from fos.benchmark import peak_rss_mb
+
+
+class MetricsRecorder:
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, prometheus_path: Optional[Union[str, Path]] = None,
+                 tracemalloc_top=0, job='fos'):
+        """Record runtime metrics.
+
+        :param path: Path for JSON lines output. If None, metrics are accumulated but not written.
+        :param prometheus_path: Optionally, a path for a Prometheus textfile.
+        :param tracemalloc_top: If nonzero, trace allocations, and record this many top allocation sites per batch.
+            Tracing slows Python allocations down considerably.
+        :param job: Value of the 'job' label in Prometheus output.
+        """
+        self.path = Path(path) if path is not None else None
+        self.prometheus_path = Path(prometheus_path) if prometheus_path is not None else None
+        self.tracemalloc_top = tracemalloc_top
+        self.job = job
+        self.stage_seconds: Dict[str, float] = defaultdict(float)
+        self.stage_docs: Dict[str, int] = defaultdict(int)
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.latencies: List[float] = []
+        self.docs = 0
+        self.start_time = timeit.default_timer()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._file = None
+        self._file_pid = None
+        if tracemalloc_top and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, docs: int):
+        """Time a stage's processing of some docs."""
+        start_time = timeit.default_timer()
+        try:
+            yield
+        finally:
+            elapsed = timeit.default_timer() - start_time
+            with self._lock:
+                self.stage_seconds[name] += elapsed
+                self.stage_docs[name] += docs
+
+    def iter_stage(self, name: str, batches: Iterable, size=len) -> Iterator:
+        """Time a stage that yields batches, like reading input."""
+        batches = iter(batches)
+        while True:
+            start_time = timeit.default_timer()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            elapsed = timeit.default_timer() - start_time
+            with self._lock:
+                self.stage_seconds[name] += elapsed
+                self.stage_docs[name] += size(batch)
+            yield batch
+
+    def count(self, name: str, n: int) -> None:
+        """Increment a counter."""
+        with self._lock:
+            self.counters[name] += int(n)
+
+    def count_empty(self, ft: np.ndarray, dtm, ent: np.ndarray) -> None:
+        """Count the docs in a batch without FastText, tf-idf or entity embeddings (i.e., with zeroed rows)."""
+        self.count('empty_fasttext', (~ft.any(axis=1)).sum())
+        self.count('empty_tfidf', (dtm.getnnz(axis=1) == 0).sum())
+        self.count('empty_entity', (~ent.any(axis=1)).sum())
+
+    def throughput(self) -> Dict[str, float]:
+        """Get docs/sec for each stage, over the time spent in the stage."""
+        return {name: self.stage_docs[name] / seconds if seconds else 0.0
+                for name, seconds in self.stage_seconds.items()}
+
+    def percentiles(self, q=(50, 90, 99)) -> Dict[str, float]:
+        """Get percentiles of batch latency, in seconds."""
+        if not self.latencies:
+            return {}
+        return {f'p{p}': float(x) for p, x in zip(q, np.percentile(self.latencies, q))}
+
+    def batch(self, docs: int, latency: float, queue_depths: Optional[Dict[str, int]] = None, cache=None,
+              **extra) -> dict:
+        """Record a completed batch, and write metrics.
+
+        :param docs: Number of docs in the batch.
+        :param latency: Seconds from the start of the batch to the end of its output.
+        :param queue_depths: Current depth of each stage's input queue, as from ``Pipeline.queue_depths()``.
+        :param cache: Optionally, an ``EmbeddingCache``, whose hit rate we record.
+        :param extra: Added to the JSON line, e.g. the input shard.
+        """
+        with self._lock:
+            self.docs += docs
+            self.latencies.append(latency)
+        record = {
+            'event': 'batch',
+            'batch': len(self.latencies),
+            'docs': docs,
+            'latency': round(latency, 4),
+            **self._snapshot(),
+            'queue_depths': queue_depths or {},
+            **extra,
+        }
+        if cache is not None:
+            record['cache'] = {'hits': cache.stats.hits, 'misses': cache.stats.misses,
+                               'hit_rate': round(cache.stats.hit_rate(), 4)}
+        if self.tracemalloc_top and tracemalloc.is_tracing():
+            record['tracemalloc'] = top_allocations(self.tracemalloc_top)
+        self._write(record)
+        self._write_prometheus(record)
+        return record
+
+    def _snapshot(self) -> dict:
+        return {
+            'time': dt.now().isoformat(),
+            'pid': os.getpid(),
+            'elapsed': round(timeit.default_timer() - self.start_time, 3),
+            'total_docs': self.docs,
+            'docs_per_sec': {name: round(x, 1) for name, x in self.throughput().items()},
+            'stage_seconds': {name: round(x, 3) for name, x in self.stage_seconds.items()},
+            'counters': dict(self.counters),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+
+    def summary(self) -> dict:
+        """Summarize the run, including batch latency percentiles."""
+        return {'event': 'summary', **self._snapshot(), 'batches': len(self.latencies),
+                'latency_percentiles': self.percentiles()}
+
+    def close(self) -> dict:
+        """Write and return the summary."""
+        summary = self.summary()
+        self._write(summary)
+        self._write_prometheus(summary)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return summary
+
+    def _write(self, record: dict) -> None:
+        if self.path is None:
+            return
+        # Forked workers open their own handle, and each line goes out in one write to the file opened for appending
+        if self._file is None or self._file_pid != os.getpid():
+            self._file = open(self.path, 'at')
+            self._file_pid = os.getpid()
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def _write_prometheus(self, record: dict) -> None:
+        if self.prometheus_path is None or os.getpid() != self._pid:
+            return
+        tmp_path = self.prometheus_path.with_name(self.prometheus_path.name + '.tmp')
+        with open(tmp_path, 'wt') as f:
+            f.write(format_prometheus(record, self.percentiles(), job=self.job))
+        os.replace(tmp_path, self.prometheus_path)
+
+
+def top_allocations(n=10) -> List[dict]:
+    """Get the top allocation sites by size from ``tracemalloc``."""
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    return [{'location': str(stat.traceback), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:n]]
+
+
+def format_prometheus(record: dict, percentiles: Dict[str, float], job='fos') -> str:
+    """Format metrics in the Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in samples:
+            labels = {'job': job, **labels}
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}')
+
+    metric('fos_docs_total', 'counter', 'Documents scored.', [({}, record['total_docs'])])
+    metric('fos_stage_seconds_total', 'counter', 'Seconds spent in each stage.',
+           [({'stage': name}, x) for name, x in record['stage_seconds'].items()])
+    metric('fos_stage_docs_per_second', 'gauge', 'Throughput of each stage.',
+           [({'stage': name}, x) for name, x in record['docs_per_sec'].items()])
+    metric('fos_events_total', 'counter', 'Counts of events, like empty embeddings.',
+           [({'event': name}, x) for name, x in record['counters'].items()])
+    metric('fos_batch_latency_seconds', 'summary', 'Batch latency.',
+           [({'quantile': str(int(p[1:]) / 100)}, x) for p, x in percentiles.items()])
+    metric('fos_peak_rss_bytes', 'gauge', 'Peak resident set size.', [({}, int(record['peak_rss_mb'] * 1024 ** 2))])
+    if record.get('queue_depths'):
+        metric('fos_queue_depth', 'gauge', 'Batches waiting for each stage.',
+               [({'stage': name}, x) for name, x in record['queue_depths'].items()])
+    if 'cache' in record:
+        metric('fos_cache_hit_ratio', 'gauge', 'Embedding cache hit rate.', [({}, record['cache']['hit_rate'])])
+    return '\n'.join(lines) + '\n'
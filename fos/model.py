@@ -1,16 +1,32 @@
 import json
 import logging
-from typing import List, Tuple, Optional
+import threading
+from pathlib import Path
+from typing import Iterable, List, Tuple, Optional, Union
 
 import numpy as np
+from ahocorasick import Automaton
+from scipy.sparse import csr_matrix
 
-from fos.entity import load_entities, embed_entities
+from fos.bundle import Bundle
+from fos.cache import EmbeddingCache
+from fos.entity import load_entities, embed_entities, index_entities, load_entity_index
+from fos.store import EmbeddingStore, EmbeddingStoreWriter
 from fos.vectors import load_tfidf, load_fasttext, load_field_fasttext, load_field_tfidf, load_field_keys, \
     embed_fasttext, embed_tfidf, load_field_entities, sparse_similarity, convert_vector
+from fos.wordvectors import FastTextEngine
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Components of a FieldModel that can be loaded separately: the FastText model, the tf-idf model and dictionary, the
+# entity automaton, and the three field embedding matrices
+COMPONENTS = ('fasttext', 'tfidf', 'entities', 'field_matrices')
+
+# Loaded forms of components, other than the components themselves: the entity ID automaton, names and vectors are
+# another form of the entities
+COMPONENT_FORMS = {'entity_index': 'entities'}
+
 
 class Embedding:
 
@@ -52,6 +68,20 @@ class Embedding:
         """
         f.write(self.json(digits=digits, **kw) + '\n')
 
+    def dump_store(self, writer: EmbeddingStoreWriter, merged_id: str) -> None:
+        """Add to an embedding store (see ``fos.store``).
+
+        :param writer: Store writer, as from ``FieldModel.store_writer()``.
+        :param merged_id: Merged ID of the publication.
+        """
+        writer.add(merged_id, self.fasttext, self.tfidf, self.entity)
+
+    @classmethod
+    def load_store(cls, store: EmbeddingStore, merged_id: str) -> 'Embedding':
+        """Load a publication's embeddings from an embedding store."""
+        fasttext, tfidf, entity = store.get(merged_id)
+        return cls(fasttext=fasttext, tfidf=tfidf, entity=entity)
+
 
 class Similarity:
 
@@ -77,32 +107,171 @@ class Similarity:
 
 class FieldModel(object):
 
-    def __init__(self, lang="en"):
+    def __init__(self, lang="en", bundle: Optional[Union[str, Path]] = None, cache: Optional[EmbeddingCache] = None,
+                 components: Optional[Iterable[str]] = None, lazy=False,
+                 fasttext_table: Optional[Union[str, Path]] = None):
         """A 'model' for field scoring.
 
         :param lang: Language, 'en'.
+        :param bundle: Optionally, the directory of a compiled asset bundle (see ``fos.bundle``) from which to load
+            everything but the FastText model.
+        :param cache: Optionally, a cache of publication embeddings (see ``fos.cache``) for ``embed()`` to consult.
+        :param components: Optionally, the components of the model to load (see ``COMPONENTS``), e.g.
+            ``{'field_matrices'}`` to score stored embeddings without loading the FastText model. By default, all of
+            them. Using a component that wasn't selected raises a ValueError. The field keys are always available.
+        :param lazy: If true, load each component when it's first used, instead of now. Load eagerly before forking
+            worker processes, so they share the parent's copy of the model.
+        :param fasttext_table: Optionally, the directory of a word vector table (see ``fos.wordvectors``), like a
+            compact variant from ``scripts/compact_fasttext.py``, to load as the FastText component instead of the full
+            model. Words that aren't in the table are skipped.
         """
-        logger.debug('Loading FieldModel assets')
+        self.lang = lang
+        self.cache = cache
+        self.fasttext_table = fasttext_table
+        self.components = frozenset(COMPONENTS if components is None else components)
+        unknown = self.components.difference(COMPONENTS)
+        if unknown:
+            raise ValueError(f'Unknown FieldModel components {sorted(unknown)}; expected some of {COMPONENTS}')
+        self.bundle = None
+        if bundle is not None:
+            self.bundle = Bundle(bundle)
+            if self.bundle.is_stale():
+                logger.warning(f'Assets have changed since the bundle in {bundle} was compiled')
+        self._loaded = {}
+        # Lazy loading can happen in pipeline stage threads
+        self._lock = threading.RLock()
+        if not lazy:
+            logger.debug('Loading FieldModel assets')
+            for component in COMPONENTS:
+                if component in self.components:
+                    # We embed with the entity index, so we load it rather than the entity vector automaton
+                    self._component('entity_index' if component == 'entities' else component)
+            self._component('field_keys')
 
+    def _component(self, name: str):
+        """Get a component, loading it if it hasn't been loaded."""
+        with self._lock:
+            if name not in self._loaded:
+                component = COMPONENT_FORMS.get(name, name)
+                if component != 'field_keys' and component not in self.components:
+                    raise ValueError(f"This FieldModel was created without the '{component}' component")
+                logger.debug(f'Loading FieldModel {name}')
+                self._loaded[name] = getattr(self, f'_load_{name}')()
+            return self._loaded[name]
+
+    def _load_fasttext(self):
         # Vectors for embedding publications
-        self.fasttext = load_fasttext(lang)
-        self.tfidf, self.dictionary = load_tfidf(lang)
-        self.entities = load_entities(lang)
+        if self.fasttext_table is not None:
+            return FastTextEngine.from_table(self.fasttext_table)
+        return load_fasttext(self.lang)
+
+    def _load_tfidf(self):
+        if self.bundle is not None:
+            return self.bundle.tfidf()
+        return load_tfidf(self.lang)
+
+    def _load_entities(self):
+        if self.bundle is not None:
+            return self.bundle.entities()
+        return load_entities(self.lang)
 
+    def _load_entity_index(self):
+        if self.bundle is not None:
+            return self.bundle.entity_index()
+        if 'entities' in self._loaded:
+            return index_entities(self._loaded['entities'])
+        return load_entity_index(self.lang)
+
+    def _load_field_matrices(self):
         # Field embeddings
-        self.field_fasttext = load_field_fasttext(lang)
-        self.field_tfidf = load_field_tfidf(lang)
-        self.field_entities = load_field_entities(lang)
+        if self.bundle is not None:
+            return self.bundle.field_fasttext(), self.bundle.field_tfidf(), self.bundle.field_entities()
+        return load_field_fasttext(self.lang), load_field_tfidf(self.lang), load_field_entities(self.lang)
 
+    def _load_field_keys(self):
         # Field embedding index (gives the field IDs corresponding with field score vector elements)
-        self.index = load_field_keys(lang)
+        if self.bundle is not None:
+            return self.bundle.field_keys()
+        return load_field_keys(self.lang)
+
+    @property
+    def fasttext(self):
+        """The FastText model, or with ``fasttext_table``, a ``FastTextEngine``."""
+        return self._component('fasttext')
+
+    @property
+    def tfidf(self):
+        """The tf-idf model."""
+        return self._component('tfidf')[0]
+
+    @property
+    def dictionary(self):
+        """The tf-idf dictionary."""
+        return self._component('tfidf')[1]
+
+    @property
+    def entities(self):
+        """The entity automaton."""
+        return self._component('entities')
+
+    @property
+    def entity_index(self) -> Tuple[Automaton, List[str], np.ndarray]:
+        """The entity ID automaton, entity names and entity vectors, as from ``index_entities()``."""
+        return self._component('entity_index')
+
+    @property
+    def field_fasttext(self):
+        """FastText field embeddings."""
+        return self._component('field_matrices')[0]
+
+    @property
+    def field_tfidf(self):
+        """tf-idf field embeddings."""
+        return self._component('field_matrices')[1]
+
+    @property
+    def field_entities(self):
+        """Entity field embeddings."""
+        return self._component('field_matrices')[2]
+
+    @property
+    def index(self) -> List[str]:
+        """Field keys, in the row order of the field embeddings."""
+        return self._component('field_keys')
 
     def embed(self, text: str) -> Embedding:
         """Embed publication text three ways."""
+        if self.cache is not None:
+            fasttext, dtm, entity = self.cache.embed([text], self._embed_texts, len(self.dictionary))
+            return Embedding(fasttext=fasttext[0],
+                             tfidf=list(zip(dtm.indices.tolist(), dtm.data.tolist())),
+                             entity=entity[0])
+        return self._embed(text)
+
+    def _embed(self, text: str) -> Embedding:
+        entity_trie, _, entity_vectors = self.entity_index
         return Embedding(
             fasttext=embed_fasttext(text, self.fasttext),
             tfidf=embed_tfidf(text.split(), self.tfidf, self.dictionary),
-            entity=embed_entities(text, self.entities))
+            entity=embed_entities(text, entity_trie, entity_vectors))
+
+    def _embed_texts(self, texts: List[str]) -> Tuple[np.ndarray, csr_matrix, np.ndarray]:
+        """Embed texts one at a time for the embedding cache, returning arrays like a batch embedding."""
+        embeddings = [self._embed(text) for text in texts]
+        indptr = np.cumsum([0] + [len(embedding.tfidf) for embedding in embeddings])
+        tfidf = [x for embedding in embeddings for x in embedding.tfidf]
+        dtm = csr_matrix(([weight for _, weight in tfidf], [term_id for term_id, _ in tfidf], indptr),
+                         shape=(len(texts), len(self.dictionary)), dtype=np.float64)
+        return (np.stack([embedding.fasttext for embedding in embeddings]), dtm,
+                np.stack([embedding.entity for embedding in embeddings]))
+
+    def store_writer(self, path: Union[str, Path], **kw) -> EmbeddingStoreWriter:
+        """Open a writer for an embedding store of this model's embeddings.
+
+        :param path: Store directory.
+        :param kw: Passed to ``EmbeddingStoreWriter``, e.g. ``dtype`` and ``shard_size``.
+        """
+        return EmbeddingStoreWriter(path, n_terms=len(self.dictionary), **kw)
 
     def score(self, embedding: Embedding) -> Similarity:
         """Calculate field scores from a publication's embeddings."""
@@ -0,0 +1,200 @@
+"""
+Write field scores as JSONL or Parquet.
+
+JSONL output takes a ``json.dumps()`` call per document. Parquet output is columnar and compressed: we convert each
+scoring batch to an Arrow table and write it as one row group, with a ``merged_id`` column and a
+``list<struct<name, score>>`` column of field scores, matching ``schemas/field_scores.json``.
+
+To load Parquet output into BigQuery, enable list inference (``--parquet_enable_list_inference`` with ``bq load``, or
+``enableListInference`` in the load job's Parquet options), so the lists of structs load as REPEATED RECORD columns.
+"""
+import json
+import shutil
+from pathlib import Path
+from typing import List, Sequence, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+OUTPUT_FORMATS = ('jsonl', 'parquet')
+
+# Top field scores by name, as from batch_score_corpus_constrained.py. This matches schemas/field_scores.json, but for
+# 'is_imputed', which we add in BQ
+FIELD_SCORES_SCHEMA = pa.schema([
+    pa.field('merged_id', pa.string(), nullable=False),
+    pa.field('fields', pa.list_(pa.struct([
+        pa.field('name', pa.string(), nullable=False),
+        pa.field('score', pa.float64(), nullable=False),
+    ]))),
+])
+
+# All field scores by field ID, as from batch_score_corpus.py. Scores are null where a doc has no positive similarity
+# with a field. Every doc has the same field IDs, so we dictionary-encode them; they're strings in the Parquet output
+ALL_FIELD_SCORES_SCHEMA = pa.schema([
+    pa.field('merged_id', pa.string(), nullable=False),
+    pa.field('fields', pa.list_(pa.struct([
+        pa.field('id', pa.dictionary(pa.int32(), pa.string()), nullable=False),
+        pa.field('score', pa.float64()),
+    ]))),
+])
+
+# List offsets are int32, so lists in an Arrow array can't hold more than this many values in total
+MAX_LIST_VALUES = 2 ** 31 - 1
+
+
+class JsonlScoreWriter:
+    suffix = '.jsonl'
+
+    def __init__(self, path: Union[str, Path]):
+        """Write score records to a file as JSONL.
+
+        :param path: Output path.
+        """
+        self.path = Path(path)
+        self.f = open(self.path, 'wt')
+
+    def write(self, records: List[dict]) -> int:
+        """Write score records, returning the record count."""
+        self.f.write(''.join(json.dumps(record) + '\n' for record in records))
+        return len(records)
+
+    def append_part(self, path: Union[str, Path]) -> None:
+        """Append the output of another writer of this type, e.g. from a worker process."""
+        with open(path, 'rt') as part:
+            shutil.copyfileobj(part, self.f)
+
+    def close(self) -> None:
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParquetScoreWriter:
+    suffix = '.parquet'
+
+    def __init__(self, path: Union[str, Path], schema: pa.Schema = FIELD_SCORES_SCHEMA, compression='snappy'):
+        """Write score records to a Parquet file, one row group per batch.
+
+        :param path: Output path.
+        :param schema: Arrow schema of the output.
+        :param compression: Parquet compression codec.
+        """
+        self.path = Path(path)
+        self.schema = schema
+        self.writer = pq.ParquetWriter(self.path, schema, compression=compression)
+
+    def write(self, records: List[dict]) -> int:
+        """Write score records as a row group, returning the record count."""
+        return self.write_table(pa.Table.from_pylist(records, schema=self.schema))
+
+    def write_table(self, table: pa.Table) -> int:
+        """Write an Arrow table as a row group, returning its row count."""
+        if table.num_rows:
+            self.writer.write_table(table, row_group_size=table.num_rows)
+        return table.num_rows
+
+    def append_part(self, path: Union[str, Path]) -> None:
+        """Append the row groups of another Parquet file, e.g. from a worker process."""
+        part = pq.ParquetFile(path)
+        for i in range(part.num_row_groups):
+            self.write_table(part.read_row_group(i))
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_score_writer(path: Union[str, Path], output_format='jsonl', **kwargs):
+    """Open a JsonlScoreWriter or ParquetScoreWriter.
+
+    :param path: Output path.
+    :param output_format: 'jsonl' or 'parquet'.
+    :param kwargs: Passed to the ParquetScoreWriter.
+    """
+    if output_format == 'jsonl':
+        return JsonlScoreWriter(path)
+    if output_format == 'parquet':
+        return ParquetScoreWriter(path, **kwargs)
+    raise ValueError(output_format)
+
+
+def score_patch_records(merged_ids: Sequence[str], scores: np.ndarray, keys: Sequence[str], digits=6) -> List[dict]:
+    """Create patch records of field score columns for a batch of docs, for ``merge_score_patch()``.
+
+    :param merged_ids: IDs of the N docs.
+    :param scores: N x C array of scores, NaN where missing.
+    :param keys: Field ID for each of the C columns.
+    :param digits: Float precision.
+    :return: A record for each doc, with its ``merged_id`` and its score for each field by ID, or null where missing.
+    """
+    return [{'merged_id': merged_id, **{k: None if np.isnan(v) else round(v, digits) for k, v in zip(keys, row)}}
+            for merged_id, row in zip(merged_ids, scores.astype(float).tolist())]
+
+
+def merge_score_patch(scores_path: Union[str, Path], patch_path: Union[str, Path],
+                      output_path: Union[str, Path]) -> int:
+    """Merge a patch of field score columns into JSONL scores by ``merged_id``, as from ``score_field_columns.py``.
+
+    The patch is read into memory by ``merged_id``, so it can be in any order, as when it comes from a different run or
+    from workers. It's small compared to the scores, holding only the patched columns, and the scores are streamed.
+    Scores without a patch record (e.g. after a ``--limit``) are copied as they are. Patched columns replace any prior
+    scores for those fields.
+
+    :param scores_path: Path to JSONL scores, with a ``merged_id`` and a score for each field.
+    :param patch_path: Path to the JSONL patch.
+    :param output_path: Path for the merged JSONL scores.
+    :return: Count of patched records.
+    """
+    with open(patch_path, 'rt') as f:
+        patches = {patch['merged_id']: patch for patch in map(json.loads, f)}
+    i = 0
+    with open(scores_path, 'rt') as scores, open(output_path, 'wt') as f:
+        for line in scores:
+            record = json.loads(line)
+            patch = patches.pop(record['merged_id'], None)
+            if patch is not None:
+                record.update(patch)
+                line = json.dumps(record) + '\n'
+                i += 1
+            f.write(line)
+    if patches:
+        raise ValueError(f"{len(patches):,} patch records aren't in the scores, e.g. {next(iter(patches))}")
+    return i
+
+
+def all_field_scores_table(merged_ids: Sequence[str], scores: np.ndarray, index: Sequence[str]) -> pa.Table:
+    """Create a table of every field score for a batch of docs, with schema ``ALL_FIELD_SCORES_SCHEMA``.
+
+    :param merged_ids: IDs of the N docs.
+    :param scores: N x F array of scores, NaN where missing.
+    :param index: Field ID for each of the F columns.
+    """
+    n_docs, n_fields = scores.shape
+    merged_ids = list(merged_ids)
+    index = pa.array(list(index), pa.string())
+    value_fields = list(ALL_FIELD_SCORES_SCHEMA.field('fields').type.value_type)
+    # Each doc has a list of every field, so the lists are the same length, and we can build them from flat columns. We
+    # build the table in chunks of rows with no more than MAX_LIST_VALUES scores
+    chunk_size = MAX_LIST_VALUES // n_fields
+    batches = []
+    for start in range(0, n_docs, chunk_size):
+        chunk = scores[start:start + chunk_size]
+        flat_scores = chunk.astype(np.float64).ravel()
+        ids = pa.DictionaryArray.from_arrays(pa.array(np.tile(np.arange(n_fields, dtype=np.int32), len(chunk))), index)
+        values = pa.StructArray.from_arrays([ids, pa.array(flat_scores, mask=np.isnan(flat_scores))],
+                                            fields=value_fields)
+        offsets = pa.array(np.arange(len(chunk) + 1, dtype=np.int32) * np.int32(n_fields))
+        batches.append(pa.RecordBatch.from_arrays(
+            [pa.array(merged_ids[start:start + len(chunk)], pa.string()), pa.ListArray.from_arrays(offsets, values)],
+            schema=ALL_FIELD_SCORES_SCHEMA))
+    return pa.Table.from_batches(batches, schema=ALL_FIELD_SCORES_SCHEMA)
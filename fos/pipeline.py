@@ -0,0 +1,187 @@
+"""
+Run batch scoring as a pipeline of stages connected by bounded queues.
+
+Scoring a batch has stages that are bound by different things: reading (gzip decompression and JSON decoding),
+embedding, scoring (mostly BLAS) and writing (JSON encoding and file I/O). Run one after another, each stage leaves the
+CPU idle for the others. Here each stage runs in its own thread, so e.g. the next batch can be read and decompressed
+while the current one is scored. Queues between stages are bounded, so a fast stage blocks (backpressure) instead of
+buffering batches without limit.
+
+Threads only overlap work that releases the GIL, like zlib decompression, numpy and file I/O. For CPU-bound Python
+work, run more processes instead (e.g. ``batch_score_corpus_constrained.py --workers``).
+
+To find the bottleneck, compare stage occupancy: the share of wall time each stage spends busy, rather than waiting
+for input from upstream or blocked on output to a full queue downstream. The bottleneck is the busiest stage, and the
+stages upstream of it spend their time blocked on output.
+"""
+import queue
+import threading
+import timeit
+from typing import Iterable, Callable, Sequence, Tuple, Iterator, List, Dict
+
+# Sentinel that marks the end of a stage's output
+_DONE = object()
+
+
+class StageStats:
+
+    def __init__(self, name: str):
+        """Timing for a pipeline stage.
+
+        :param name: Stage name.
+        """
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.waiting_input = 0.0
+        self.waiting_output = 0.0
+        self.queue_depth = 0
+        self.queue_samples = 0
+
+    def occupancy(self, elapsed: float) -> float:
+        """Get the share of elapsed wall time the stage was busy."""
+        return self.busy / elapsed if elapsed else 0.0
+
+    def report(self, elapsed: float) -> str:
+        mean_depth = self.queue_depth / self.queue_samples if self.queue_samples else 0.0
+        return (f'{self.name}: {self.items:,} items, {self.occupancy(elapsed):.0%} busy '
+                f'({self.waiting_input / elapsed if elapsed else 0:.0%} waiting for input, '
+                f'{self.waiting_output / elapsed if elapsed else 0:.0%} blocked on output, '
+                f'mean input queue depth {mean_depth:.1f})')
+
+
+class Pipeline:
+
+    def __init__(self, source: Iterable, stages: Sequence[Tuple[str, Callable]], maxsize=2):
+        """A pipeline of stages, each running in a thread.
+
+        :param source: Iterable of input items, like batches of records. It's consumed in a 'read' stage thread.
+        :param stages: Sequence of (name, function) pairs. Each function takes the output of the previous stage (or
+            an item from the source) and returns the input for the next. The output of the last stage is discarded.
+        :param maxsize: Maximum number of items waiting between two stages.
+        """
+        self.source = source
+        self.stages = stages
+        self.maxsize = maxsize
+        self.stats = [StageStats('read')] + [StageStats(name) for name, _ in stages]
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+        self._queues: List[queue.Queue] = []
+
+    def run(self) -> None:
+        """Run the pipeline until the source is exhausted, re-raising the first error in any stage."""
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages]
+        self._queues = queues
+        threads = [threading.Thread(target=self._read, args=(queues[0], self.stats[0]), name='read', daemon=True)]
+        for i, (name, fn) in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._work, args=(fn, queues[i], out_queue, self.stats[i + 1]),
+                                            name=name, daemon=True))
+        start_time = timeit.default_timer()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            self.elapsed = timeit.default_timer() - start_time
+        if self._errors:
+            raise self._errors[0]
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Get the number of items currently waiting for each stage."""
+        return {name: q.qsize() for (name, _), q in zip(self.stages, self._queues)}
+
+    def bottleneck(self) -> StageStats:
+        """Get the stage that was busy for the largest share of the run."""
+        return max(self.stats, key=lambda stats: stats.busy)
+
+    def report(self) -> str:
+        """Summarize stage occupancy."""
+        lines = [stats.report(self.elapsed) for stats in self.stats]
+        lines.append(f'Bottleneck: {self.bottleneck().name}')
+        return '\n'.join(lines)
+
+    def _fail(self, error: BaseException) -> None:
+        self._errors.append(error)
+        self._stop.set()
+
+    def _put(self, q: queue.Queue, item, stats: StageStats) -> None:
+        # Block while the queue is full, unless another stage fails
+        start_time = timeit.default_timer()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats.waiting_output += timeit.default_timer() - start_time
+
+    def _get(self, q: queue.Queue, stats: StageStats):
+        start_time = timeit.default_timer()
+        stats.queue_depth += q.qsize()
+        stats.queue_samples += 1
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self._stop.is_set():
+                    item = _DONE
+                    break
+        stats.waiting_input += timeit.default_timer() - start_time
+        return item
+
+    def _read(self, out_queue: queue.Queue, stats: StageStats) -> None:
+        try:
+            items = iter(self.source)
+            while not self._stop.is_set():
+                start_time = timeit.default_timer()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                stats.busy += timeit.default_timer() - start_time
+                stats.items += 1
+                self._put(out_queue, item, stats)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(out_queue, _DONE, stats)
+
+    def _work(self, fn: Callable, in_queue: queue.Queue, out_queue: queue.Queue, stats: StageStats) -> None:
+        try:
+            while True:
+                item = self._get(in_queue, stats)
+                if item is _DONE:
+                    break
+                start_time = timeit.default_timer()
+                result = fn(item)
+                stats.busy += timeit.default_timer() - start_time
+                stats.items += 1
+                if out_queue is not None:
+                    self._put(out_queue, result, stats)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            if out_queue is not None:
+                self._put(out_queue, _DONE, stats)
+
+
+def limit_batches(batches: Iterable, limit=0, size: Callable = len) -> Iterator:
+    """Stop yielding batches once at least ``limit`` records have been yielded, if ``limit`` isn't zero.
+
+    :param batches: Iterable of batches.
+    :param limit: Record limit.
+    :param size: Function giving the number of records in a batch.
+    """
+    i = 0
+    for batch in batches:
+        yield batch
+        i += size(batch)
+        if limit and (i >= limit):
+            break
@@ -0,0 +1,136 @@
+"""
+Preprocess batches of text, with the same output as ``fos.util.preprocess()``.
+
+``preprocess()`` runs per text: a translation table, NFKD normalization and an ASCII round trip, and two regex
+substitutions. For a batch, we join the texts with a separator that none of these steps changes or matches across (NUL:
+it isn't whitespace, punctuation or a word character, and it decomposes to itself), so each step runs once over the
+batch instead of once per text. Most abstracts are pure ASCII, for which NFKD normalization, the ASCII round trip and
+lowercasing (after the translation table lowercased the ASCII letters) do nothing, so we skip them for the ASCII texts
+in a batch. A text that contains NUL is preprocessed on its own.
+
+The regexes are most of the remaining time, so we replace them with equivalents for the ASCII text they see (after
+the round trip, every text is ASCII). ``LONE_NUMBERS`` starts with ``\b``, which the regex engine tries at every
+position; ``LONE_DIGITS`` starts with a digit, so the engine can skip ahead to digits. And ``NONBREAKING_SPACE``
+replaces every space, even a single one, with a space. The translation table has already replaced newlines and
+vertical tabs (which it excludes) with spaces, so it's equivalent to splitting on whitespace and joining with spaces.
+
+``BatchPreprocessor`` splits large batches across a pool of worker processes. With raw titles and abstracts (e.g. from
+an extract of the corpus before its regex cleanup in ``corpus.sql``), ``preprocess_records()`` combines them as
+``preprocess_text()`` does, without pandas.
+"""
+import multiprocessing as mp
+import re
+import unicodedata
+from typing import List, Optional, Sequence
+
+from more_itertools import chunked
+
+from fos.util import TO_CLEAN_LOWER, is_null
+
+# Joins the texts of a batch
+SEPARATOR = '\x00'
+
+# Equivalent to LONE_NUMBERS for ASCII text: a digit not preceded by a word character, then digits not followed by one
+LONE_DIGITS = re.compile(r'[0-9](?<!\w[0-9])[0-9]*(?!\w)', re.ASCII)
+
+
+def _preprocess(text: str, is_ascii: bool) -> str:
+    # As in preprocess(), but skipping the steps that do nothing for ASCII text. Texts joined with SEPARATOR may keep a
+    # space on either side of it
+    text = text.translate(TO_CLEAN_LOWER)
+    if not is_ascii:
+        text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii').lower()
+    text = LONE_DIGITS.sub('', text)
+    return ' '.join(text.split())
+
+
+def preprocess_batch(texts: Sequence[str], lang='en') -> List[str]:
+    """Preprocess a batch of texts, with the same output as ``preprocess()`` for each."""
+    if lang != 'en':
+        raise ValueError(lang)
+    output = [''] * len(texts)
+    groups = {True: [], False: []}
+    for i, text in enumerate(texts):
+        if SEPARATOR in text:
+            output[i] = _preprocess(text, text.isascii()).strip()
+        else:
+            groups[text.isascii()].append(i)
+    for is_ascii, indexes in groups.items():
+        if indexes:
+            joined = _preprocess(SEPARATOR.join([texts[i] for i in indexes]), is_ascii)
+            for i, text in zip(indexes, joined.split(SEPARATOR)):
+                output[i] = text.strip()
+    return output
+
+
+def record_text(title: Optional[str], abstract: Optional[str]) -> str:
+    """Combine a title and abstract, either of which may be missing, as ``preprocess_text()`` does."""
+    text = ''
+    if not is_null(title):
+        text += title + ' '
+    if not is_null(abstract):
+        text += abstract
+    return text
+
+
+def preprocess_records(titles: Sequence[Optional[str]], abstracts: Sequence[Optional[str]], lang='en') -> List[str]:
+    """Preprocess a batch of titles and abstracts, with the same output as ``preprocess_text()`` for each record."""
+    return preprocess_batch([record_text(title, abstract) for title, abstract in zip(titles, abstracts)], lang)
+
+
+def _preprocess_batch_star(args):
+    return preprocess_batch(*args)
+
+
+def _preprocess_records_star(args):
+    return preprocess_records(*args)
+
+
+class BatchPreprocessor:
+
+    def __init__(self, workers=1, chunk_size=10_000, lang='en'):
+        """Preprocess batches of text, across a pool of worker processes if ``workers`` is more than one.
+
+        The pool is forked from the process that first uses it. Worker processes (like those of a ``Pool``) can't
+        have children, so in them use one worker.
+
+        :param workers: Number of worker processes.
+        :param chunk_size: Number of texts each worker preprocesses at a time.
+        :param lang: Language, 'en'.
+        """
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.lang = lang
+        self._pool = None
+
+    def __call__(self, texts: Sequence[str]) -> List[str]:
+        """Preprocess a batch of texts."""
+        if self.workers <= 1 or len(texts) <= self.chunk_size:
+            return preprocess_batch(texts, self.lang)
+        return self._map(_preprocess_batch_star, texts)
+
+    def records(self, titles: Sequence[Optional[str]], abstracts: Sequence[Optional[str]]) -> List[str]:
+        """Preprocess a batch of titles and abstracts."""
+        if self.workers <= 1 or len(titles) <= self.chunk_size:
+            return preprocess_records(titles, abstracts, self.lang)
+        return self._map(_preprocess_records_star, titles, abstracts)
+
+    def _map(self, fn, *columns) -> List[str]:
+        # Preprocess chunks of the columns in the pool, in order
+        if self._pool is None:
+            self._pool = mp.get_context('fork').Pool(self.workers)
+        chunks = zip(*(chunked(column, self.chunk_size) for column in columns),
+                     [self.lang] * -(-len(columns[0]) // self.chunk_size))
+        return [text for texts in self._pool.imap(fn, chunks) for text in texts]
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
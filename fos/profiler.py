@@ -0,0 +1,216 @@
+"""
+Sample the stacks of scoring runs, for flame graphs of each stage.
+
+Stage timings (``fos.metrics``) say which stage is slow, but not which library inside it: FastText, gensim,
+pyahocorasick, numpy or our own code. A ``StackSampler`` is a statistical profiler cheap enough to leave on for a
+production run. A sampling thread wakes every few milliseconds and records the Python stack of every thread that is
+working on a sampled batch, under the innermost stage the thread is in (e.g. 'fasttext' or 'score'). Batches are
+numbered as they're read, and every Nth is sampled, so the overhead is bounded and the sample spans the run. Unlike a
+signal-based sampler, this sees the stage threads of ``--pipeline`` runs while the main thread waits for them.
+
+Stacks are written in the collapsed format (``frame;frame;frame count`` per line) that flame graph tools like
+``flamegraph.pl``, speedscope and inferno read, with one file per stage. Each process (including forked workers)
+writes its own files as it goes, and ``close()`` merges them into ``{stage}.folded``.
+
+Samples are in wall time, so they include time a stage spends waiting, e.g. on reads. The sampling thread needs the GIL,
+so a sample that falls during a call into a C extension that holds the GIL (like ``getSentenceVector`` or
+``iter_long``) is taken when the call returns, and attributed to the Python line that made it. That's the granularity
+we need to compare libraries, but calls into C appear as their Python callers.
+"""
+import contextlib
+import functools
+import itertools
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# Samples taken in a sampled batch, but outside any stage
+OTHER_STAGE = 'other'
+
+
+class StackSampler:
+
+    def __init__(self, output_dir: Union[str, Path], every=10, interval=0.005):
+        """Sample stacks in every Nth batch, per stage.
+
+        :param output_dir: Directory for collapsed stack files.
+        :param every: Sample every Nth batch, starting with the first. 1 samples every batch.
+        :param interval: Seconds between samples.
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.every = every
+        self.interval = interval
+        # Sampled stacks by stage, for this process
+        self.stacks: Dict[str, Counter] = defaultdict(Counter)
+        self.samples = 0
+        # Each thread working on a sampled batch has a stack of stage names
+        self._threads: Dict[int, List[str]] = {}
+        self._sampler_pid = None
+        self._stop = threading.Event()
+
+    def start(self) -> 'StackSampler':
+        """Start the sampling thread."""
+        self._start_sampler()
+        return self
+
+    def _start_sampler(self) -> None:
+        # Forked children don't inherit the sampling thread, so they start their own on their first sampled batch
+        if self._sampler_pid != os.getpid():
+            self._sampler_pid = os.getpid()
+            self._stop = threading.Event()
+            threading.Thread(target=self._run, args=(self._stop,), name='stack-sampler', daemon=True).start()
+
+    def _run(self, stop: threading.Event) -> None:
+        while not stop.wait(self.interval):
+            self._sample()
+
+    def sampled(self, batch: int) -> bool:
+        """Check whether a batch should be sampled."""
+        return batch % self.every == 0
+
+    @contextlib.contextmanager
+    def batch(self, batch: int):
+        """Mark this thread as working on a batch, sampling its stack if it's a sampled batch."""
+        if not self.sampled(batch):
+            yield
+            return
+        self._start_sampler()
+        thread = threading.get_ident()
+        self._threads[thread] = [OTHER_STAGE]
+        try:
+            yield
+        finally:
+            del self._threads[thread]
+            self.flush()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Attribute this thread's samples to a stage, if it's working on a sampled batch."""
+        stages = self._threads.get(threading.get_ident())
+        if stages is None:
+            yield
+            return
+        stages.append(name)
+        try:
+            yield
+        finally:
+            stages.pop()
+
+    def iter_stage(self, name: str, batches: Iterable) -> Iterator:
+        """Number batches as they're read, sampling the reading of each sampled batch as a stage."""
+        batches = iter(batches)
+        for i in itertools.count():
+            with self.batch(i), self.stage(name):
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    return
+            yield batch
+
+    def _sample(self) -> None:
+        frames = sys._current_frames()
+        for thread, stages in list(self._threads.items()):
+            thread_frame = frames.get(thread)
+            if thread_frame is None or not stages:
+                continue
+            self.stacks[stages[-1]][collapse_stack(thread_frame)] += 1
+            self.samples += 1
+
+    def flush(self) -> None:
+        """Write this process's stacks, replacing what it wrote before."""
+        pid = os.getpid()
+        # The sampling thread can add samples while we write, so we write copies
+        for stage, stacks in list(self.stacks.items()):
+            path = self.output_dir / f'{stage}.{pid}.folded'
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'wt') as f:
+                f.writelines(f'{stack} {count}\n' for stack, count in list(stacks.items()))
+            os.replace(tmp_path, path)
+
+    def close(self) -> Dict[str, Counter]:
+        """Stop sampling and merge every process's stacks into a file per stage, returning the merged stacks."""
+        self._stop.set()
+        self._sampler_pid = None
+        self.flush()
+        return merge_stacks(self.output_dir)
+
+
+def collapse_stack(frame) -> str:
+    """Format a stack as semicolon-delimited frames, outermost first."""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f'{code.co_name} ({short_path(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+@functools.lru_cache(maxsize=None)
+def short_path(path: str) -> str:
+    """Shorten a source path to its import path, e.g. 'fasttext/FastText.py', by removing the longest ``sys.path``
+    entry it's in."""
+    prefixes = [os.path.join(os.path.abspath(entry or '.'), '') for entry in sys.path]
+    prefixes = [prefix for prefix in prefixes if path.startswith(prefix)]
+    return path[len(max(prefixes, key=len)):] if prefixes else path
+
+
+def read_stacks(path: Union[str, Path]) -> Counter:
+    """Read collapsed stacks."""
+    stacks = Counter()
+    with open(path, 'rt') as f:
+        for line in f:
+            stack, count = line.rstrip('\n').rsplit(' ', 1)
+            stacks[stack] += int(count)
+    return stacks
+
+
+def merge_stacks(output_dir: Union[str, Path]) -> Dict[str, Counter]:
+    """Merge the per-process ``{stage}.{pid}.folded`` files in a directory into ``{stage}.folded`` files."""
+    output_dir = Path(output_dir)
+    merged: Dict[str, Counter] = defaultdict(Counter)
+    for path in sorted(output_dir.glob('*.*.folded')):
+        stage, pid = path.name[:-len('.folded')].rsplit('.', 1)
+        if not pid.isdigit():
+            continue
+        merged[stage].update(read_stacks(path))
+        path.unlink()
+    for stage, stacks in merged.items():
+        path = output_dir / f'{stage}.folded'
+        if path.exists():
+            # E.g. from an earlier close() in the same directory
+            stacks.update(read_stacks(path))
+        with open(path, 'wt') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in stacks.most_common())
+    return dict(merged)
+
+
+def top_frames(stacks: Counter, n=10, package=True) -> List[Tuple[str, int]]:
+    """Count samples by their innermost frame (self time), or with ``package``, by the innermost frame's top-level
+    package or module, e.g. 'fasttext', 'gensim' or 'fos'."""
+    counts = Counter()
+    for stack, count in stacks.items():
+        leaf = stack.rsplit(';', 1)[-1]
+        if package:
+            path = leaf[leaf.rfind('(') + 1:leaf.rfind(':')]
+            leaf = path.split(os.sep, 1)[0] if os.sep in path else path.rsplit('.py', 1)[0]
+        counts[leaf] += count
+    return counts.most_common(n)
+
+
+def format_profile(stacks: Dict[str, Counter], n=5) -> str:
+    """Summarize sampled stacks: samples per stage, and the packages most samples were in."""
+    lines = []
+    for stage, stage_stacks in sorted(stacks.items(), key=lambda item: -sum(item[1].values())):
+        total = sum(stage_stacks.values())
+        top = ', '.join(f'{name} {count / total:.0%}' for name, count in top_frames(stage_stacks, n))
+        lines.append(f'{stage}: {total:,} samples ({top})')
+    return '\n'.join(lines)
+
+
+def profile_stage(profiler: Optional[StackSampler], name: str):
+    """Get a context for a stage with a profiler, if any."""
+    return profiler.stage(name) if profiler is not None else contextlib.nullcontext()
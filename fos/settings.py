@@ -1,20 +1,26 @@
+import os
 from pathlib import Path
 
 FASTTEXT_DIM = 250
 
 FOS_DIR = Path(__file__).parent
 PIPELINES_DIR = FOS_DIR.parent
-ASSETS_DIR = PIPELINES_DIR / 'assets'
+# Set FOS_ASSETS_DIR to load assets from another directory, like the synthetic assets from fos.synthetic
+ASSETS_DIR = Path(os.environ['FOS_ASSETS_DIR']) if 'FOS_ASSETS_DIR' in os.environ else PIPELINES_DIR / 'assets'
 CORPUS_DIR = ASSETS_DIR / 'corpus'
 SQL_DIR = PIPELINES_DIR / 'sql'
 
 QUERY_PATH = SQL_DIR / 'corpus.sql'
+# The same publications, with raw titles and abstracts rather than preprocessed text
+RAW_QUERY_PATH = SQL_DIR / 'raw_corpus.sql'
 
 EN_FASTTEXT_PATH = ASSETS_DIR / 'en_merged_model_120221.bin'
 EN_TFIDF_PATH = ASSETS_DIR / 'tfidf_model_en_merged_sample.pkl'
 EN_DICT_PATH = ASSETS_DIR / 'id2word_dict_en_merged_sample.txt'
 
 EN_ENTITY_PATH = ASSETS_DIR / 'en_entity_trie.pkl'
+# The same entities as an automaton of entity IDs, with the entity vectors and names alongside (see fos.entity)
+EN_ENTITY_INDEX_PATH = ASSETS_DIR / 'en_entity_index.pkl'
 
 EN_FIELD_FASTTEXT_PATH = ASSETS_DIR / 'en_field_fasttext_similarity.pkl'
 EN_FIELD_TFIDF_PATH = ASSETS_DIR / 'en_field_tfidf_similarity.pkl'
@@ -0,0 +1,256 @@
+"""
+Store publication embeddings as sharded ``.npy`` arrays.
+
+As JSONL, each publication's embeddings take a few kilobytes of text, and reading them back means a ``json.loads()``
+and an ``Embedding`` per publication. An embedding store is a directory of shards, each holding the embeddings of up to
+``shard_size`` publications as arrays:
+
+- ``{shard}.ids.txt``: merged IDs, one per line
+- ``{shard}.fasttext.npy`` and ``{shard}.entity.npy``: N x D FastText and entity embeddings, as float16 by default
+- ``{shard}.tfidf.indptr.npy``, ``{shard}.tfidf.indices.npy`` and ``{shard}.tfidf.data.npy``: N x T tf-idf embeddings
+  as CSR arrays
+
+A manifest lists the shards. Shards load in bulk (with ``mmap_mode='r'``), as the batches that the scoring kernels in
+``fos.vectors`` expect.
+"""
+import json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from more_itertools import chunked
+from scipy.sparse import csr_matrix
+
+from fos.settings import CORPUS_DIR, FASTTEXT_DIM
+
+MANIFEST = 'manifest.json'
+
+
+class EmbeddingStoreWriter:
+
+    def __init__(self, path: Union[str, Path], n_terms: int, dim=FASTTEXT_DIM, dtype=np.float16, shard_size=100_000):
+        """Write publication embeddings to a store.
+
+        :param path: Store directory. It's created if it doesn't exist, and any existing store in it is overwritten.
+        :param n_terms: Size of the tf-idf vocabulary.
+        :param dim: Dimension of the FastText and entity embeddings.
+        :param dtype: Data type of the stored FastText and entity embeddings, float16 or float32.
+        :param shard_size: Maximum number of publications per shard.
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.n_terms = n_terms
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        self.shards = []
+        self._ids: List[str] = []
+        self._fasttext: List[np.ndarray] = []
+        self._entity: List[np.ndarray] = []
+        self._tfidf: List[csr_matrix] = []
+        self._buffered = 0
+
+    def add(self, merged_id: str, fasttext: Optional[np.ndarray], tfidf: Optional[List[Tuple[int, float]]],
+            entity: Optional[np.ndarray]) -> None:
+        """Add a publication's embeddings, as in an ``Embedding``.
+
+        :param merged_id: Merged ID.
+        :param fasttext: FastText embedding.
+        :param tfidf: tf-idf embedding as (term ID, weight) pairs.
+        :param entity: Entity embedding.
+        """
+        tfidf = tfidf or []
+        dtm = csr_matrix(([weight for _, weight in tfidf], [term_id for term_id, _ in tfidf], [0, len(tfidf)]),
+                         shape=(1, self.n_terms), dtype=np.float32)
+        self.add_batch([merged_id], self._dense(fasttext)[None, :], dtm, self._dense(entity)[None, :])
+
+    def _dense(self, vector) -> np.ndarray:
+        # Embeddings can be None or empty; we store zeros, which score like missing embeddings in the batch kernels
+        if vector is None or not len(vector):
+            return np.zeros(self.dim, dtype=np.float32)
+        return np.asarray(vector, dtype=np.float32)
+
+    def add_batch(self, ids: Sequence[str], fasttext: np.ndarray, dtm: csr_matrix, entity: np.ndarray) -> None:
+        """Add a batch of embeddings.
+
+        :param ids: Merged IDs of the N publications.
+        :param fasttext: N x D FastText embeddings.
+        :param dtm: N x T tf-idf embeddings.
+        :param entity: N x D entity embeddings.
+        """
+        self._ids.extend(ids)
+        self._fasttext.append(np.asarray(fasttext, dtype=self.dtype))
+        self._entity.append(np.asarray(entity, dtype=self.dtype))
+        self._tfidf.append(csr_matrix(dtm, dtype=np.float32))
+        self._buffered += len(ids)
+        while self._buffered >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def _flush(self, n: int) -> None:
+        """Write the first n buffered publications as a shard."""
+        fasttext = np.concatenate(self._fasttext)
+        entity = np.concatenate(self._entity)
+        tfidf = self._tfidf[0] if len(self._tfidf) == 1 else _vstack_csr(self._tfidf)
+        name = f'shard-{len(self.shards):05}'
+        with open(self.path / f'{name}.ids.txt', 'wt') as f:
+            f.writelines(f'{merged_id}\n' for merged_id in self._ids[:n])
+        np.save(self.path / f'{name}.fasttext.npy', fasttext[:n])
+        np.save(self.path / f'{name}.entity.npy', entity[:n])
+        shard_tfidf = tfidf[:n]
+        shard_tfidf.sort_indices()
+        np.save(self.path / f'{name}.tfidf.indptr.npy', shard_tfidf.indptr.astype(np.int64))
+        np.save(self.path / f'{name}.tfidf.indices.npy', shard_tfidf.indices.astype(np.int32))
+        np.save(self.path / f'{name}.tfidf.data.npy', shard_tfidf.data)
+        self.shards.append({'name': name, 'count': n})
+        # Keep any remainder in the buffer
+        self._ids = self._ids[n:]
+        self._fasttext = [fasttext[n:]]
+        self._entity = [entity[n:]]
+        self._tfidf = [tfidf[n:]]
+        self._buffered -= n
+
+    def close(self) -> None:
+        """Write any buffered embeddings and the manifest."""
+        if self._buffered:
+            self._flush(self._buffered)
+        manifest = {
+            'dim': self.dim,
+            'n_terms': self.n_terms,
+            'dtype': self.dtype.name,
+            'count': sum(shard['count'] for shard in self.shards),
+            'shards': self.shards,
+        }
+        with open(self.path / MANIFEST, 'wt') as f:
+            json.dump(manifest, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _vstack_csr(matrices: Sequence[csr_matrix]) -> csr_matrix:
+    # Like scipy.sparse.vstack, without its conversions to COO and back
+    indptr = [np.zeros(1, dtype=np.int64)]
+    offset = 0
+    for matrix in matrices:
+        indptr.append(matrix.indptr[1:].astype(np.int64) + offset)
+        offset += matrix.indptr[-1]
+    return csr_matrix((np.concatenate([matrix.data for matrix in matrices]),
+                       np.concatenate([matrix.indices for matrix in matrices]),
+                       np.concatenate(indptr)),
+                      shape=(sum(matrix.shape[0] for matrix in matrices), matrices[0].shape[1]))
+
+
+class EmbeddingStore:
+
+    def __init__(self, path: Union[str, Path]):
+        """Read publication embeddings from a store.
+
+        :param path: Store directory, as written by an ``EmbeddingStoreWriter``.
+        """
+        self.path = Path(path)
+        if not (self.path / MANIFEST).exists():
+            raise FileNotFoundError(f'No embedding store manifest in {self.path}')
+        with open(self.path / MANIFEST, 'rt') as f:
+            self.manifest = json.load(f)
+        self.shards = [shard['name'] for shard in self.manifest['shards']]
+        self._index: Optional[Dict[str, Tuple[int, int]]] = None
+
+    def __len__(self):
+        return self.manifest['count']
+
+    def shard_ids(self, shard: int) -> List[str]:
+        with open(self.path / f'{self.shards[shard]}.ids.txt', 'rt') as f:
+            return f.read().split('\n')[:-1]
+
+    def load_shard(self, shard: int, dtype=np.float32) -> Tuple[List[str], np.ndarray, csr_matrix, np.ndarray]:
+        """Load a shard's merged IDs, FastText embeddings, tf-idf embeddings and entity embeddings.
+
+        :param shard: Shard number.
+        :param dtype: Data type of the returned FastText and entity embeddings. If None, they're memory-mapped as
+            stored.
+        """
+        return (self.shard_ids(shard), *self.load_arrays(shard, dtype))
+
+    def load_arrays(self, shard: int, dtype=np.float32) -> Tuple[np.ndarray, csr_matrix, np.ndarray]:
+        """Load a shard's embeddings, as in ``load_shard()``, without its merged IDs."""
+        name = self.shards[shard]
+
+        def load(suffix):
+            return np.load(self.path / f'{name}.{suffix}.npy', mmap_mode='r')
+
+        fasttext, entity = load('fasttext'), load('entity')
+        if dtype is not None:
+            fasttext, entity = fasttext.astype(dtype), entity.astype(dtype)
+        dtm = csr_matrix((load('tfidf.data'), load('tfidf.indices'), load('tfidf.indptr')),
+                         shape=(len(fasttext), self.manifest['n_terms']), copy=False)
+        return fasttext, dtm, entity
+
+    def iter_batches(self, dtype=np.float32) -> Iterator[Tuple[List[str], np.ndarray, csr_matrix, np.ndarray]]:
+        """Iterate over the store one shard at a time, yielding (ids, fasttext, tfidf, entity) batches."""
+        for shard in range(len(self.shards)):
+            yield self.load_shard(shard, dtype)
+
+    def index(self) -> Dict[str, Tuple[int, int]]:
+        """Map merged IDs to their (shard, row) in the store."""
+        if self._index is None:
+            self._index = {merged_id: (shard, row)
+                           for shard in range(len(self.shards))
+                           for row, merged_id in enumerate(self.shard_ids(shard))}
+        return self._index
+
+    def get(self, merged_id: str) -> Tuple[np.ndarray, List[Tuple[int, float]], np.ndarray]:
+        """Get a publication's FastText embedding, tf-idf embedding as (term ID, weight) pairs, and entity embedding."""
+        shard, row = self.index()[merged_id]
+        fasttext, dtm, entity = self.load_arrays(shard, dtype=None)
+        return _row(fasttext, dtm, entity, row)
+
+    def iter_rows(self) -> Iterator[Tuple[str, np.ndarray, List[Tuple[int, float]], np.ndarray]]:
+        """Iterate over publications one at a time, yielding their merged IDs and embeddings as from ``get()``."""
+        for ids, fasttext, dtm, entity in self.iter_batches(dtype=None):
+            for row, merged_id in enumerate(ids):
+                yield (merged_id, *_row(fasttext, dtm, entity, row))
+
+
+def _row(fasttext: np.ndarray, dtm: csr_matrix, entity: np.ndarray, row: int) \
+        -> Tuple[np.ndarray, List[Tuple[int, float]], np.ndarray]:
+    start, stop = dtm.indptr[row], dtm.indptr[row + 1]
+    return fasttext[row], list(zip(dtm.indices[start:stop].tolist(), dtm.data[start:stop].tolist())), entity[row]
+
+
+def read_jsonl_batches(path: Union[str, Path], n_terms: int, batch_size=100_000) \
+        -> Iterator[Tuple[List[str], np.ndarray, csr_matrix, np.ndarray]]:
+    """Read batches of (merged IDs, FastText embeddings, tf-idf embeddings, entity embeddings) from JSONL, as from
+    ``EmbeddingStore.iter_batches()``."""
+    with open(path, 'rt') as f:
+        for lines in chunked(f, batch_size):
+            records = [json.loads(line) for line in lines]
+            tfidf = [record['tfidf'] or [] for record in records]
+            indptr = np.zeros(len(tfidf) + 1, dtype=np.int64)
+            np.cumsum([len(pairs) for pairs in tfidf], out=indptr[1:])
+            dtm = csr_matrix(([weight for pairs in tfidf for _, weight in pairs],
+                              [term_id for pairs in tfidf for term_id, _ in pairs], indptr),
+                             shape=(len(records), n_terms), dtype=np.float32)
+            yield ([record['merged_id'] for record in records],
+                   np.array([record['fasttext'] for record in records], dtype=np.float32), dtm,
+                   np.array([record['entity'] for record in records], dtype=np.float32))
+
+
+def read_embedding_batches(lang="en", input_format='store', n_terms=0, batch_size=100_000, corpus_dir=CORPUS_DIR) \
+        -> Iterator[Tuple[List[str], np.ndarray, csr_matrix, np.ndarray]]:
+    """Read batches of the publication embeddings written by ``embed_corpus.py``, as from ``iter_batches()``.
+
+    :param lang: Language, 'en'.
+    :param input_format: 'jsonl' to read ``{lang}_embeddings.jsonl`` in batches of ``batch_size``, or 'store' to read
+        the ``{lang}_embeddings`` store a shard at a time.
+    :param n_terms: Size of the tf-idf vocabulary, for JSONL.
+    :param batch_size: Records per JSONL batch.
+    :param corpus_dir: Directory of the embeddings.
+    """
+    if input_format == 'jsonl':
+        return read_jsonl_batches(Path(corpus_dir) / f'{lang}_embeddings.jsonl', n_terms, batch_size)
+    if input_format == 'store':
+        return EmbeddingStore(Path(corpus_dir) / f'{lang}_embeddings').iter_batches()
+    raise ValueError(input_format)
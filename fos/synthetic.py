@@ -0,0 +1,226 @@
+"""
+Generate small synthetic stand-ins for the model assets and corpus, for benchmarking and tests without DVC or network
+access.
+
+The real assets are multi-GB and pulled with DVC. Here we generate assets with the same formats and layout, named as in
+``fos.settings``, in a directory of our choosing:
+
+- a synthetic corpus of abstracts, written as ``corpus/en_corpus-*.jsonl.gz`` shards (or Parquet). Words are drawn from
+  a Zipf distribution over a generated vocabulary, mixed with the topic words of a few fields and their ancestors, and
+  the occasional field name
+- a toy FastText model trained on the corpus, with the real embedding dimension
+- a gensim Dictionary and tf-idf model (pickled as the sklearn wrapper, like the real asset)
+- field embeddings with a row for every field in ``fields/field_meta.jsonl`` (copied with ``field_children.jsonl``), as
+  pickled gensim similarity indexes, embedding synthetic field text as the real pipeline embeds Wikipedia text
+- an entity automaton of field names, whose entity vectors sum the FastText embeddings of the fields mentioned in each
+  field's text, and the same entities as an entity ID automaton and vector matrix
+
+Point the pipeline at the generated assets by setting ``FOS_ASSETS_DIR`` before running a scorer or the benchmarks, e.g.
+``FOS_ASSETS_DIR=/tmp/fos-assets PYTHONPATH=. python scripts/benchmark.py run``.
+"""
+import gzip
+import json
+import pickle
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Union
+
+import fasttext
+import numpy as np
+import pandas as pd
+from gensim.corpora import Dictionary
+from gensim.similarities import MatrixSimilarity, SparseMatrixSimilarity
+from gensim.sklearn_api import TfIdfTransformer
+from scipy.sparse import csr_matrix
+
+from fos.entity import create_automaton, index_entities, write_entity_index
+from fos.settings import FASTTEXT_DIM, EN_FASTTEXT_PATH, EN_TFIDF_PATH, EN_DICT_PATH, EN_ENTITY_PATH, \
+    EN_ENTITY_INDEX_PATH, EN_FIELD_FASTTEXT_PATH, EN_FIELD_TFIDF_PATH, EN_FIELD_ENTITY_PATH, EN_FIELD_KEY_PATH, \
+    ASSETS_DIR
+from fos.util import preprocess
+from fos.vectors import norm
+
+CONSONANTS = 'bcdfghjklmnprstvz'
+VOWELS = 'aeiou'
+
+
+def make_vocab(size: int, rng: np.random.Generator) -> List[str]:
+    """Generate distinct pronounceable words, in order of frequency rank."""
+    vocab = {}
+    while len(vocab) < size:
+        n_syllables = rng.integers(1, 5)
+        word = ''.join(rng.choice(list(CONSONANTS)) + rng.choice(list(VOWELS)) for _ in range(n_syllables))
+        vocab.setdefault(word, None)
+    return list(vocab)
+
+
+def zipf_probabilities(size: int, exponent=1.1) -> np.ndarray:
+    """Get probabilities proportional to 1 / rank ** exponent."""
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+class SyntheticCorpus:
+
+    def __init__(self, meta: pd.DataFrame, children: pd.DataFrame, vocab_size=20_000, topic_size=30,
+                 doc_length=150, topic_share=0.3, mention_rate=0.5, seed=0):
+        """Generate synthetic field text and abstracts.
+
+        :param meta: Field metadata, as in ``field_meta.jsonl``.
+        :param children: Parent-child field pairs, as in ``field_children.jsonl``.
+        :param vocab_size: Number of generated words.
+        :param topic_size: Number of topic words for each field.
+        :param doc_length: Mean abstract length in words.
+        :param topic_share: Share of an abstract's words drawn from the topic words of its fields.
+        :param mention_rate: Mean count of field name mentions per abstract.
+        :param seed: Random seed.
+        """
+        self.rng = np.random.default_rng(seed)
+        self.meta = meta
+        self.names = meta['name'].tolist()
+        # Field names as they'd appear in preprocessed text
+        self.mentions = [preprocess(name) for name in self.names]
+        self.vocab = np.array(make_vocab(vocab_size, self.rng))
+        self.probabilities = zipf_probabilities(vocab_size)
+        # Topic words skew toward the less frequent words, as field-specific terms do
+        self.topics = [self.rng.choice(vocab_size, size=topic_size, replace=False,
+                                       p=zipf_probabilities(vocab_size, exponent=0.5)[::-1])
+                       for _ in self.names]
+        self.doc_length = doc_length
+        self.topic_share = topic_share
+        self.mention_rate = mention_rate
+        index = {name: i for i, name in enumerate(self.names)}
+        self.parents: Dict[int, List[int]] = {}
+        for parent, child in zip(children['parent_name'], children['child_name']):
+            if parent in index and child in index:
+                self.parents.setdefault(index[child], []).append(index[parent])
+
+    def ancestors(self, field: int) -> List[int]:
+        """Get a field and its ancestors."""
+        fields = [field]
+        for parent in self.parents.get(field, []):
+            fields.extend(self.ancestors(parent))
+        return fields
+
+    def field_text(self, field: int, length=300) -> str:
+        """Generate the text for a field, like its Wikipedia content: its topic words, and mentions of itself and its
+        ancestors."""
+        words = list(self.vocab[self.rng.choice(self.topics[field], size=length)])
+        for ancestor in self.ancestors(field):
+            words.insert(int(self.rng.integers(0, len(words))), self.mentions[ancestor])
+        return ' '.join(words)
+
+    def abstract(self) -> str:
+        """Generate an abstract about a random field and its ancestors."""
+        fields = self.ancestors(int(self.rng.integers(0, len(self.names))))
+        length = max(5, int(self.rng.lognormal(np.log(self.doc_length), 0.5)))
+        n_topic = self.rng.binomial(length, self.topic_share)
+        topic_words = np.concatenate([self.topics[field] for field in fields])
+        words = list(self.vocab[np.concatenate([
+            self.rng.choice(len(self.vocab), size=length - n_topic, p=self.probabilities),
+            self.rng.choice(topic_words, size=n_topic),
+        ])])
+        self.rng.shuffle(words)
+        for _ in range(self.rng.poisson(self.mention_rate)):
+            words.insert(int(self.rng.integers(0, len(words))), self.mentions[self.rng.choice(fields)])
+        return ' '.join(words)
+
+
+def write_corpus(corpus: SyntheticCorpus, output_dir: Path, n_docs=10_000, n_shards=4, extract_format='jsonl') \
+        -> List[str]:
+    """Write synthetic abstracts as shards of a corpus extract, returning the abstracts."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    texts = [corpus.abstract() for _ in range(n_docs)]
+    records = [{'merged_id': f'synthetic-{i}', 'text': text} for i, text in enumerate(texts)]
+    shard_size = -(-n_docs // n_shards)
+    for shard, start in enumerate(range(0, n_docs, shard_size)):
+        shard_records = records[start:start + shard_size]
+        if extract_format == 'jsonl':
+            with gzip.open(output_dir / f'en_corpus-{shard:012}.jsonl.gz', 'wt') as f:
+                f.writelines(json.dumps(record) + '\n' for record in shard_records)
+        elif extract_format == 'parquet':
+            pd.DataFrame(shard_records).to_parquet(output_dir / f'en_corpus-{shard:012}.parquet', index=False)
+        else:
+            raise ValueError(extract_format)
+    return texts
+
+
+def train_fasttext(texts: List[str], path: Path, epoch=1, bucket=20_000, threads=4) -> fasttext.FastText._FastText:
+    """Train a toy FastText model with the real embedding dimension."""
+    with tempfile.NamedTemporaryFile('wt', suffix='.txt') as f:
+        f.writelines(text + '\n' for text in texts)
+        f.flush()
+        model = fasttext.train_unsupervised(f.name, model='skipgram', dim=FASTTEXT_DIM, epoch=epoch, minCount=1,
+                                            bucket=bucket, thread=threads, verbose=0)
+    model.save_model(str(path))
+    return model
+
+
+def generate_assets(output_dir: Union[str, Path], n_docs=10_000, n_shards=4, vocab_size=20_000, doc_length=150,
+                    extract_format='jsonl', epoch=1, bucket=20_000, seed=0,
+                    fields_dir: Union[str, Path] = ASSETS_DIR / 'fields') -> Path:
+    """Generate synthetic assets and a corpus in a directory laid out like ``assets``.
+
+    :param output_dir: Output directory.
+    :param n_docs: Number of abstracts in the corpus.
+    :param n_shards: Number of corpus extract shards.
+    :param vocab_size: Number of generated words.
+    :param doc_length: Mean abstract length in words.
+    :param extract_format: Corpus extract format, 'jsonl' or 'parquet'.
+    :param epoch: FastText training epochs.
+    :param bucket: FastText subword buckets. The model's size is about (vocabulary + buckets) x 250 x 4 bytes.
+    :param seed: Random seed.
+    :param fields_dir: Directory of the field metadata and children tables to copy.
+    :return: The output directory.
+    """
+    output_dir = Path(output_dir)
+    (output_dir / 'fields').mkdir(parents=True, exist_ok=True)
+    for name in ['field_meta.jsonl', 'field_children.jsonl']:
+        shutil.copy(Path(fields_dir) / name, output_dir / 'fields' / name)
+    meta = pd.read_json(output_dir / 'fields/field_meta.jsonl', lines=True)
+    children = pd.read_json(output_dir / 'fields/field_children.jsonl', lines=True)
+    corpus = SyntheticCorpus(meta, children, vocab_size=vocab_size, doc_length=doc_length, seed=seed)
+
+    texts = write_corpus(corpus, output_dir / 'corpus', n_docs, n_shards, extract_format)
+    field_texts = [corpus.field_text(field) for field in range(len(corpus.names))]
+
+    # Publication embedding models
+    model = train_fasttext(texts + field_texts, output_dir / EN_FASTTEXT_PATH.name, epoch=epoch, bucket=bucket)
+    dictionary = Dictionary(text.split() for text in texts + field_texts)
+    dictionary.save_as_text(str(output_dir / EN_DICT_PATH.name))
+    tfidf = TfIdfTransformer(dictionary=dictionary).fit([dictionary.doc2bow(text.split()) for text in texts])
+    with open(output_dir / EN_TFIDF_PATH.name, 'wb') as f:
+        pickle.dump(tfidf, f)
+
+    # Field embeddings, in the row order of the field keys
+    field_fasttext = [norm(model.get_sentence_vector(text)) for text in field_texts]
+    field_tfidf = []
+    for text in field_texts:
+        vector = tfidf.gensim_model[dictionary.doc2bow(text.split())]
+        field_tfidf.append(csr_matrix(([x for _, x in vector], ([0] * len(vector), [i for i, _ in vector])),
+                                      shape=(1, len(dictionary))))
+
+    # Entity vectors sum the FastText embeddings of the fields mentioned in each field's text
+    matcher = create_automaton({mention: i for i, mention in enumerate(corpus.mentions)})
+    entity_vectors = []
+    for text in field_texts:
+        mentioned = [field for _, (_, field) in matcher.iter_long(text)]
+        vector = np.sum([field_fasttext[field] for field in mentioned], axis=0) if mentioned \
+            else np.zeros(FASTTEXT_DIM, dtype=np.float32)
+        entity_vectors.append(norm(vector).astype(np.float32))
+    entities = create_automaton({mention: (name, vector)
+                                 for mention, name, vector in zip(corpus.mentions, corpus.names, entity_vectors)})
+
+    with open(output_dir / EN_ENTITY_PATH.name, 'wb') as f:
+        pickle.dump(entities, f)
+    write_entity_index(*index_entities(entities), output_dir / EN_ENTITY_INDEX_PATH.name)
+    with open(output_dir / EN_FIELD_FASTTEXT_PATH.name, 'wb') as f:
+        pickle.dump(MatrixSimilarity(field_fasttext, num_features=FASTTEXT_DIM, dtype=np.float32), f)
+    with open(output_dir / EN_FIELD_TFIDF_PATH.name, 'wb') as f:
+        pickle.dump(SparseMatrixSimilarity(field_tfidf, num_features=len(dictionary), dtype=np.float32), f)
+    with open(output_dir / EN_FIELD_ENTITY_PATH.name, 'wb') as f:
+        pickle.dump(MatrixSimilarity(entity_vectors, num_features=FASTTEXT_DIM, dtype=np.float32), f)
+    with open(output_dir / EN_FIELD_KEY_PATH.name, 'wt') as f:
+        f.writelines(f'{name}\n' for name in corpus.names)
+    return output_dir
@@ -0,0 +1,106 @@
+"""
+Embed batches of texts with tf-idf, without gensim.
+
+The gensim path for a batch creates a bag of words per document with ``Dictionary.doc2bow()``, weights it with
+``TfidfModel.__getitem__()``, normalizes it again with ``sparse_norm()`` and converts the batch to a sparse matrix with
+``matutils.corpus2csc()``, all in Python one document (and one token) at a time. Here we look up every token in a batch
+at once, count (document, token) pairs with numpy, and weight and normalize the counts as arrays, yielding a CSR matrix.
+
+The result is bit-for-bit the same as the gensim path. For this we sum the squared weights for the l2 norms in the same
+order as gensim, one term at a time in order of term ID, rather than with numpy's pairwise summation.
+"""
+from itertools import repeat
+from typing import Sequence
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class TfidfEngine:
+
+    def __init__(self, token2id: dict, idfs: np.ndarray, eps=1e-12, dtype=np.float32):
+        """Embed batches of texts with tf-idf.
+
+        :param token2id: Mapping of tokens to term IDs, like ``Dictionary.token2id``.
+        :param idfs: The idf for each term ID. Zero for terms without an idf.
+        :param eps: Like ``TfidfModel.eps``, terms with an idf or normalized weight no greater than this are dropped.
+        :param dtype: Data type of the result, like ``corpus2csc(dtype=...)``.
+        """
+        self.token2id = token2id
+        self.idfs = np.asarray(idfs, dtype=np.float64)
+        self.eps = eps
+        self.dtype = dtype
+        self.n_terms = len(self.idfs)
+
+    @classmethod
+    def from_gensim(cls, tfidf, dictionary, dtype=np.float32) -> 'TfidfEngine':
+        """Create an engine from a gensim tf-idf model (or its sklearn wrapper) and dictionary."""
+        model = getattr(tfidf, 'gensim_model', tfidf)
+        idfs = np.zeros(len(dictionary), dtype=np.float64)
+        term_ids = np.fromiter(model.idfs.keys(), dtype=np.int64, count=len(model.idfs))
+        idfs[term_ids] = np.fromiter(model.idfs.values(), dtype=np.float64, count=len(model.idfs))
+        return cls(dictionary.token2id, idfs, eps=model.eps, dtype=dtype)
+
+    @classmethod
+    def from_bundle(cls, bundle, dtype=np.float32) -> 'TfidfEngine':
+        """Create an engine from the vocabulary table and idfs in a compiled bundle (see ``fos.bundle``)."""
+        token2id = {token: i for i, token in enumerate(bundle.vocab())}
+        return cls(token2id, bundle.load_array('idfs'), eps=bundle.manifest['tfidf']['eps'], dtype=dtype)
+
+    def embed(self, texts: Sequence[str]) -> csr_matrix:
+        """Embed a batch of (preprocessed) texts.
+
+        :param texts: Texts, in which tokens are separated by whitespace.
+        :return: N x T CSR matrix of l2-normalized tf-idf weights, with sorted indices.
+        """
+        # Look up every token in the batch, giving -1 for tokens that aren't in the vocabulary
+        tokens = [text.split() for text in texts]
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        flat = [token for doc in tokens for token in doc]
+        term_ids = np.fromiter(map(self.token2id.get, flat, repeat(-1)), dtype=np.int64, count=len(flat))
+        doc_ids = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+
+        # Count each (doc, term) pair, in order of doc and then term ID, dropping terms without an idf
+        known = term_ids >= 0
+        known[known] = np.abs(self.idfs[term_ids[known]]) > self.eps
+        keys, counts = np.unique(doc_ids[known] * self.n_terms + term_ids[known], return_counts=True)
+        rows, cols = np.divmod(keys, self.n_terms)
+        indptr = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(texts)), out=indptr[1:])
+
+        # Weight and normalize like TfidfModel.__getitem__, then drop weights no greater than eps
+        weights = counts.astype(np.float64) * self.idfs[cols]
+        weights /= np.repeat(np.sqrt(sequential_row_sums(weights * weights, indptr)), np.diff(indptr))
+        keep = np.abs(weights) > self.eps
+        if not keep.all():
+            weights, cols, rows = weights[keep], cols[keep], rows[keep]
+            np.cumsum(np.bincount(rows, minlength=len(texts)), out=indptr[1:])
+
+        # Normalize again like sparse_norm(), which only divides rows whose length isn't exactly one
+        lengths = np.sqrt(sequential_row_sums(weights * weights, indptr))
+        lengths[lengths == 0.0] = 1.0
+        weights /= np.repeat(lengths, np.diff(indptr))
+
+        return csr_matrix((weights.astype(self.dtype), cols.astype(np.int32), indptr),
+                          shape=(len(texts), self.n_terms))
+
+
+def sequential_row_sums(values: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    """Sum the values in each row of a CSR matrix, adding one element at a time in order, like Python's ``sum()``.
+
+    numpy's reductions use pairwise summation, which can differ from sequential summation in the last bits. Here we
+    instead take one step per column position, adding the next element of every row that has one.
+    """
+    lengths = np.diff(indptr)
+    sums = np.zeros(len(lengths), dtype=np.float64)
+    if not len(lengths):
+        return sums
+    # Order rows by length descending, so the rows with a kth element are a prefix of the ordering
+    order = np.argsort(-lengths, kind='stable')
+    sorted_lengths = lengths[order]
+    starts = indptr[:-1][order]
+    for k in range(sorted_lengths[0]):
+        n_rows = np.searchsorted(-sorted_lengths, -k, side='left')
+        rows = order[:n_rows]
+        sums[rows] += values[starts[:n_rows] + k]
+    return sums
@@ -0,0 +1,115 @@
+"""
+Select the top-scoring fields for each document.
+
+A full ``argsort`` of each row of an N x F score array is O(N F log F), but we only keep the top k fields per level.
+Here we instead use ``argpartition`` to find each row's top k in O(N F), and sort just those k.
+
+NaN scores (fields that weren't scored, like L2/L3 fields outside a document's constraints) rank like scores of zero,
+and neither appears in output.
+"""
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+
+def top_k(scores: np.ndarray, k=10, offset=0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find the top k scores in each row.
+
+    :param scores: N x F array of scores.
+    :param k: Number of scores to keep per row. If there are fewer than k columns, we keep them all.
+    :param offset: Added to the column indices, e.g. where a level's slice of ``scores`` begins in the full array.
+    :return: N x k arrays of column indices and scores, sorted descending by score, and a mask that is false where a
+        score is NaN or zero.
+    """
+    scores = np.nan_to_num(scores)
+    n_docs, n_fields = scores.shape
+    k = min(k, n_fields)
+    if k < n_fields:
+        candidates = np.argpartition(scores, n_fields - k, axis=1)[:, n_fields - k:]
+    else:
+        candidates = np.broadcast_to(np.arange(n_fields), (n_docs, n_fields))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    # Sort the k candidates in each row descending
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    indices = np.take_along_axis(candidates, order, axis=1) + offset
+    top_scores = np.take_along_axis(candidate_scores, order, axis=1)
+    return indices, top_scores, top_scores != 0.0
+
+
+def top_k_by_level(scores: np.ndarray, levels: np.ndarray, k: Union[int, Dict[int, int]] = 10, offset=0,
+                   include: Sequence[int] = None) -> Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Find the top k scores in each row within each field level.
+
+    :param scores: N x F array of scores.
+    :param levels: Level of each of the F fields.
+    :param k: Number of scores to keep per row and level, or a dict giving this for each level.
+    :param offset: Added to the column indices, e.g. where ``scores`` begins in the full array of field scores.
+    :param include: Levels to rank. By default, all the levels in ``levels``.
+    :return: Dict mapping each level to the output of ``top_k()`` for its fields, with column indices into ``scores``
+        (plus ``offset``).
+    """
+    levels = np.asarray(levels)
+    if include is None:
+        include = np.unique(levels).tolist()
+    results = {}
+    for level in include:
+        level_k = k[level] if isinstance(k, dict) else k
+        columns = np.flatnonzero(levels == level)
+        if not len(columns):
+            raise ValueError(f'No fields in level {level}')
+        if columns[-1] - columns[0] + 1 == len(columns):
+            # Levels are usually contiguous, so we can take a view instead of a copy
+            indices, top_scores, valid = top_k(scores[:, columns[0]:columns[-1] + 1], level_k, offset + columns[0])
+        else:
+            indices, top_scores, valid = top_k(scores[:, columns], level_k)
+            indices = columns[indices] + offset
+        results[level] = (indices, top_scores, valid)
+    return results
+
+
+def to_score_records(indices: np.ndarray, scores: np.ndarray, valid: np.ndarray, names: Sequence[str],
+                     decimals=4) -> List[List[dict]]:
+    """Format the output of ``top_k()`` as a list of {'name': str, 'score': float} dicts for each document.
+
+    :param indices: N x k array of column indices.
+    :param scores: N x k array of scores.
+    :param valid: N x k mask of scores to keep.
+    :param names: Field name for each column index.
+    :param decimals: Round scores to this many decimal places.
+    """
+    names = np.asarray(names, dtype=object)
+    return [
+        [{'name': name, 'score': round(score, decimals)}
+         for name, score, keep in zip(row_names, row_scores, row_valid) if keep]
+        for row_names, row_scores, row_valid in zip(names[indices].tolist(), scores.tolist(), valid.tolist())
+    ]
+
+
+def field_agreement(scores: np.ndarray, other_scores: np.ndarray, levels: np.ndarray, k=3) -> dict:
+    """Compare two N x F arrays of field scores for the same documents, e.g. from a model and a compact variant.
+
+    For each level, we report the share of documents whose top field is the same, the mean share of their top k fields
+    in common, and the max absolute difference between their scores.
+
+    :param scores: N x F array of reference scores.
+    :param other_scores: N x F array of scores to compare.
+    :param levels: Level of each of the F fields.
+    :param k: Number of top fields to compare per level.
+    :return: Dict with 'docs', 'max_abs_diff' over all fields, and for each level under 'levels', 'top1', f'top{k}'
+        and 'max_abs_diff'.
+    """
+    levels = np.asarray(levels)
+    diffs = np.abs(np.nan_to_num(scores) - np.nan_to_num(other_scores))
+    top = top_k_by_level(scores, levels, k)
+    other_top = top_k_by_level(other_scores, levels, k)
+    report = {'docs': len(scores), 'max_abs_diff': float(diffs.max(initial=0.0)), 'levels': {}}
+    for level, (indices, _, _) in top.items():
+        other_indices = other_top[level][0]
+        # Each row's indices are distinct, so matches between the rows count the fields in common
+        in_common = (indices[:, :, None] == other_indices[:, None, :]).sum(axis=(1, 2))
+        report['levels'][level] = {
+            'top1': float(np.mean(indices[:, 0] == other_indices[:, 0])) if len(indices) else 1.0,
+            f'top{k}': float(np.mean(in_common / indices.shape[1])) if len(indices) else 1.0,
+            'max_abs_diff': float(diffs[:, levels == level].max(initial=0.0)),
+        }
+    return report
@@ -6,8 +6,9 @@ import subprocess
 import unicodedata
 from functools import partial
 from pathlib import Path
+from typing import Iterator, Sequence, Tuple
 
-import pandas as pd
+from more_itertools import chunked
 
 from fos.settings import CORPUS_DIR, PIPELINES_DIR
 
@@ -39,28 +40,95 @@ def preprocess(text, lang='en'):
     return text.strip()
 
 
-def iter_bq_extract(prefix, corpus_dir=CORPUS_DIR):
-    files = list(Path(corpus_dir).glob(f'{prefix}*.jsonl.gz'))
+# Suffix of the files in a BQ extract, by format (see ``fos.gcp.EXTRACT_FORMATS``)
+EXTRACT_SUFFIXES = {'jsonl': '.jsonl.gz', 'parquet': '.parquet'}
+
+
+def list_bq_extract(prefix, corpus_dir=CORPUS_DIR, suffix='.jsonl.gz'):
+    """List the files of a BQ extract, in order."""
+    files = list(Path(corpus_dir).glob(f'{prefix}*{suffix}'))
     if not files:
-        raise FileNotFoundError(f"No files found in {corpus_dir} match glob '{prefix}*.jsonl.gz'")
-    print(f"Found {len(files):,} files in {corpus_dir} matching glob '{prefix}*.jsonl.gz'")
-    for file in sorted(files):
-        with gzip.open(file, 'rb') as infile:
-            print(f"Opened {file}")
-            i = 0
-            for line in infile:
-                if not line:
-                    continue
-                yield json.loads(line)
-                i += 1
-            print(f"Read {i:,} records from {file}")
+        raise FileNotFoundError(f"No files found in {corpus_dir} match glob '{prefix}*{suffix}'")
+    print(f"Found {len(files):,} files in {corpus_dir} matching glob '{prefix}*{suffix}'")
+    return sorted(files)
+
+
+def iter_bq_file(file):
+    """Iterate over the records in one file of a BQ extract."""
+    with gzip.open(file, 'rb') as infile:
+        print(f"Opened {file}")
+        i = 0
+        for line in infile:
+            if not line:
+                continue
+            yield json.loads(line)
+            i += 1
+        print(f"Read {i:,} records from {file}")
+
+
+def iter_bq_extract(prefix, corpus_dir=CORPUS_DIR):
+    for file in list_bq_extract(prefix, corpus_dir):
+        yield from iter_bq_file(file)
+
+
+def iter_parquet_file_batches(file, batch_size=100_000, columns: Sequence[str] = ('merged_id', 'text')) \
+        -> Iterator[Tuple[list, ...]]:
+    """Iterate over batches of columns in one Parquet file of a BQ extract.
+
+    We decode only the requested columns, and yield each batch as a tuple of lists (one per column) rather than
+    creating a dict per record.
+    """
+    # pyarrow is slow to import, and JSONL extracts don't need it
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(file)
+    print(f"Opened {file}")
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=list(columns)):
+        yield tuple(batch.column(i).to_pylist() for i in range(len(columns)))
+    print(f"Read {parquet_file.metadata.num_rows:,} records from {file}")
+
+
+def iter_bq_file_batches(file, batch_size=100_000, columns: Sequence[str] = ('merged_id', 'text')) \
+        -> Iterator[Tuple[list, ...]]:
+    """Iterate over batches of columns in one file of a BQ extract, as gzipped JSONL or Parquet."""
+    if str(file).endswith(EXTRACT_SUFFIXES['parquet']):
+        yield from iter_parquet_file_batches(file, batch_size, columns)
+    else:
+        for records in chunked(iter_bq_file(file), batch_size):
+            yield tuple([record[column] for record in records] for column in columns)
+
+
+def iter_bq_batches(prefix, corpus_dir=CORPUS_DIR, batch_size=100_000, extract_format='jsonl',
+                    columns: Sequence[str] = ('merged_id', 'text')) -> Iterator[Tuple[list, ...]]:
+    """Iterate over batches of columns in a BQ extract.
+
+    :param prefix: Prefix of the extract files, like 'en_'.
+    :param corpus_dir: Directory of the extract files.
+    :param batch_size: Maximum records per batch.
+    :param extract_format: 'jsonl' or 'parquet'.
+    :param columns: Columns to read.
+    :return: Iterator over tuples of lists, one list for each column. JSONL batches can span files; Parquet batches
+        don't, so the last batch from each Parquet file may be short.
+    """
+    if extract_format == 'jsonl':
+        for records in chunked(iter_bq_extract(prefix, corpus_dir), batch_size):
+            yield tuple([record[column] for record in records] for column in columns)
+    elif extract_format == 'parquet':
+        for file in list_bq_extract(prefix, corpus_dir, EXTRACT_SUFFIXES['parquet']):
+            yield from iter_parquet_file_batches(file, batch_size, columns)
+    else:
+        raise ValueError(extract_format)
+
+
+def is_null(value) -> bool:
+    """Check whether a value is missing: None or NaN (which isn't equal to itself)."""
+    return value is None or value != value
 
 
 def preprocess_text(record, lang="en"):
     text = ""
-    if "title" in record and not pd.isnull(record["title"]):
+    if "title" in record and not is_null(record["title"]):
         text += record["title"] + " "
-    if "abstract" in record and not pd.isnull(record["abstract"]):
+    if "abstract" in record and not is_null(record["abstract"]):
         text += record["abstract"]
     return preprocess(text, lang)
 
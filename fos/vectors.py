@@ -4,19 +4,23 @@
 import math
 import pickle
 from pathlib import Path
-from typing import Tuple, List, Iterable
+from typing import TYPE_CHECKING, Tuple, List, Iterable, Optional, Sequence
 
 import numpy as np
-from fasttext.FastText import _FastText
-from gensim import matutils
-from gensim.corpora import Dictionary
-from gensim.similarities import MatrixSimilarity, SparseMatrixSimilarity
-from gensim.sklearn_api import TfIdfTransformer
+from scipy.sparse import issparse
 
 from fos.settings import EN_TFIDF_PATH, EN_FASTTEXT_PATH, EN_FIELD_FASTTEXT_PATH, \
     EN_FIELD_TFIDF_PATH, EN_DICT_PATH, EN_FIELD_KEY_PATH, \
     EN_FIELD_ENTITY_PATH
 
+# FastText and gensim (which imports scikit-learn, via gensim.sklearn_api) are slow to import, so we import them where
+# they're used, and the scoring path doesn't pay for them until it loads the models
+if TYPE_CHECKING:
+    from fasttext.FastText import _FastText
+    from gensim.corpora import Dictionary
+    from gensim.similarities import MatrixSimilarity, SparseMatrixSimilarity
+    from gensim.sklearn_api import TfIdfTransformer
+
 ASSETS_DIR = Path(__file__).parent.parent / 'assets'
 
 
@@ -27,14 +31,15 @@ def embed_fasttext(text, model):
     return norm(vector)
 
 
-def embed_tfidf(text: List, tfidf: TfIdfTransformer, dictionary):
+def embed_tfidf(text: List, tfidf: 'TfIdfTransformer', dictionary):
     bow = dictionary.doc2bow(text)
     if not len(bow):
         return []
     return tfidf.gensim_model[bow]
 
 
-def load_tfidf(lang="en") -> Tuple[TfIdfTransformer, Dictionary]:
+def load_tfidf(lang="en") -> Tuple['TfIdfTransformer', 'Dictionary']:
+    from gensim.corpora import Dictionary
     if lang == "en":
         with open(EN_TFIDF_PATH, 'rb') as f:
             tfidf = pickle.load(f)
@@ -44,7 +49,8 @@ def load_tfidf(lang="en") -> Tuple[TfIdfTransformer, Dictionary]:
     return tfidf, dictionary
 
 
-def load_fasttext(lang="en") -> _FastText:
+def load_fasttext(lang="en") -> '_FastText':
+    from fasttext.FastText import _FastText
     if lang == "en":
         path = EN_FASTTEXT_PATH
     else:
@@ -53,7 +59,7 @@ def load_fasttext(lang="en") -> _FastText:
     return _FastText(model_path=str(path))
 
 
-def load_field_fasttext(lang="en") -> MatrixSimilarity:
+def load_field_fasttext(lang="en") -> 'MatrixSimilarity':
     if lang == "en":
         path = EN_FIELD_FASTTEXT_PATH
     else:
@@ -62,7 +68,7 @@ def load_field_fasttext(lang="en") -> MatrixSimilarity:
         return pickle.load(f)
 
 
-def load_field_entities(lang="en") -> MatrixSimilarity:
+def load_field_entities(lang="en") -> 'MatrixSimilarity':
     if lang == "en":
         path = EN_FIELD_ENTITY_PATH
     else:
@@ -80,7 +86,7 @@ def load_field_keys(lang="en") -> List[str]:
         return [x.strip() for x in f if x.strip()]
 
 
-def load_field_tfidf(lang="en") -> SparseMatrixSimilarity:
+def load_field_tfidf(lang="en") -> 'SparseMatrixSimilarity':
     if lang == "en":
         path = EN_FIELD_TFIDF_PATH
     else:
@@ -90,6 +96,7 @@ def load_field_tfidf(lang="en") -> SparseMatrixSimilarity:
 
 
 def sparse_similarity(query, index):
+    from gensim import matutils
     # gensim's sparse format looks like [(token_id, tfidf), (token_id, tfidf), ...]
     query = sparse_norm(query)
     # default case: query is a single vector, in sparse gensim format
@@ -102,8 +109,14 @@ def sparse_similarity(query, index):
 
 
 def batch_sparse_similarity(query, index):
-    query = [sparse_norm(x) for x in query]
-    query = matutils.corpus2csc(query, index.shape[1], dtype=index.dtype)
+    if issparse(query):
+        # An N x T matrix of normalized document vectors, as from TfidfEngine.embed(); transposing it gives the same
+        # T x N CSC matrix as corpus2csc
+        query = query.T
+    else:
+        from gensim import matutils
+        query = [sparse_norm(x) for x in query]
+        query = matutils.corpus2csc(query, index.shape[1], dtype=index.dtype)
     # compute cosine similarity against every other document in the collection
     result = index * query.tocsc()  # N x T * T x C = N x C
     # avoid converting to dense array if maintaining sparsity
@@ -119,6 +132,125 @@ def sparse_norm(vector):
         return list(vector)
 
 
+def row_norm(vectors) -> np.ndarray:
+    """Normalize document (row) vectors in an array of document embeddings, leaving zeroed rows as they are."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, ord=2, axis=1)[:, None]
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms != 0.0)
+
+
+class ScoringBuffers:
+
+    def __init__(self):
+        """Work buffers for ScoringKernel, which kernels that never score concurrently can share."""
+        self.size = 0
+        self._arrays = None
+
+    def get(self, n_docs, n_fields) -> Tuple[np.ndarray, ...]:
+        """Get N x F views of the buffers, growing them if they're too small."""
+        size = n_docs * n_fields
+        if size > self.size:
+            self._arrays = (np.empty(size, dtype=np.float32), np.empty(size, dtype=np.float32),
+                            np.empty(size, dtype=np.uint8), np.empty(size, dtype=bool), np.empty(size, dtype=bool))
+            self.size = size
+        return tuple(array[:size].reshape(n_docs, n_fields) for array in self._arrays)
+
+
+class ScoringKernel:
+
+    def __init__(self, field_fasttext, field_tfidf, field_entities, positive_only=False, fill=0.0,
+                 buffers: Optional[ScoringBuffers] = None, keep_all=False):
+        """Score batches of publication embeddings against a set of fields.
+
+        We average the FastText, tf-idf and entity similarities for each publication-field pair, over the similarities
+        that are valid. Rather than stacking the three N x F similarity matrices and masking them, we accumulate each
+        similarity in turn into float32 buffers, with a count of valid similarities per cell. The buffers are reused
+        across batches, so scoring a batch allocates little beyond the sparse tf-idf product.
+
+        :param field_fasttext: F x D FastText field embeddings.
+        :param field_tfidf: F x T sparse tf-idf field embeddings.
+        :param field_entities: F x D entity field embeddings.
+        :param positive_only: If true, similarities are valid if greater than zero; otherwise, if in [0, 1].
+        :param fill: Score for publication-field pairs without any valid similarities.
+        :param buffers: Optionally, buffers shared with other kernels.
+        :param keep_all: If true, every similarity is valid, so scores are plain averages of the three similarities,
+            as from ``FieldModel.score()``. This overrides ``positive_only``.
+        """
+        self.field_fasttext = np.ascontiguousarray(field_fasttext, dtype=np.float32)
+        self.field_tfidf = field_tfidf
+        self.field_entities = np.ascontiguousarray(field_entities, dtype=np.float32)
+        self.positive_only = positive_only
+        self.fill = fill
+        self.keep_all = keep_all
+        self.n_fields = self.field_fasttext.shape[0]
+        self.buffers = buffers if buffers is not None else ScoringBuffers()
+
+    def _accumulate(self, sims, sums, counts, valid, upper):
+        # Add valid similarities to the running sums and count them
+        if self.keep_all:
+            valid.fill(True)
+        elif self.positive_only:
+            np.greater(sims, 0.0, out=valid)
+        else:
+            np.greater_equal(sims, 0.0, out=valid)
+            np.less_equal(sims, 1.0, out=upper)
+            np.logical_and(valid, upper, out=valid)
+        np.add(sums, sims, out=sums, where=valid)
+        np.add(counts, valid, out=counts, casting='unsafe')
+
+    def score(self, ft, dtm, ent, out=None) -> np.ndarray:
+        """Score a batch of publication embeddings.
+
+        :param ft: N x D l2-normed FastText embeddings.
+        :param dtm: tf-idf embeddings in gensim's sparse format, or as a sparse matrix from ``TfidfEngine``.
+        :param ent: N x D l2-normed entity embeddings.
+        :param out: Optional N x F float32 array for the scores. If None, the scores are returned in a buffer that the
+            next call (to this kernel or any sharing its buffers) overwrites.
+        :return: N x F array of scores.
+        """
+        ft = np.asarray(ft, dtype=np.float32)
+        ent = np.asarray(ent, dtype=np.float32)
+        sums, sims, counts, valid, upper = self.buffers.get(ft.shape[0], self.n_fields)
+        sums.fill(0.0)
+        counts.fill(0)
+
+        np.dot(ft, self.field_fasttext.T, out=sims)
+        self._accumulate(sims, sums, counts, valid, upper)
+
+        # toarray() adds the sparse similarities to the buffer, so we zero it first
+        sims.fill(0.0)
+        batch_sparse_similarity(dtm, self.field_tfidf).astype(np.float32, copy=False).toarray(out=sims)
+        self._accumulate(sims, sums, counts, valid, upper)
+
+        np.dot(ent, self.field_entities.T, out=sims)
+        self._accumulate(sims, sums, counts, valid, upper)
+        return self._divide(sums, counts, valid, out)
+
+    def average(self, similarities: Sequence[np.ndarray], out=None) -> np.ndarray:
+        """Average precomputed N x F similarity arrays over the valid similarities, as in ``score()``.
+
+        :param similarities: N x F similarity arrays, like the FastText, tf-idf and entity similarities of a batch.
+        :param out: As in ``score()``.
+        :return: N x F array of scores.
+        """
+        sums, _, counts, valid, upper = self.buffers.get(*similarities[0].shape)
+        sums.fill(0.0)
+        counts.fill(0)
+        for sims in similarities:
+            self._accumulate(np.asarray(sims, dtype=np.float32), sums, counts, valid, upper)
+        return self._divide(sums, counts, valid, out)
+
+    def _divide(self, sums, counts, valid, out) -> np.ndarray:
+        # Divide the sums by the counts of valid similarities, filling cells without any
+        if out is None:
+            out = sums
+        np.greater(counts, 0, out=valid)
+        np.divide(sums, counts, out=out, where=valid, casting='unsafe')
+        np.logical_not(valid, out=valid)
+        np.copyto(out, self.fill, where=valid)
+        return out
+
+
 def norm_sum(vectors: Iterable[np.ndarray]) -> np.ndarray:
     vector = np.sum(vectors, axis=0)
     return norm(vector)
@@ -0,0 +1,268 @@
+"""
+Embed batches of texts with FastText sentence vectors, as one sparse product against a table of word vectors.
+
+For an unsupervised model, ``get_sentence_vector()`` splits a text on whitespace, looks up each word's vector (the sum
+of its input vector and its character n-gram vectors, divided by their number), normalizes it, and averages the
+normalized vectors of the words whose vectors aren't zero. Calling it once per text, through pybind and holding the
+GIL, is the slowest part of embedding a batch. Here we precompute the normalized vector of every word in the model's
+vocabulary (subwords included) into a table, which ``build_word_table()`` writes as a ``.npy`` array that we
+memory-map, like the arrays of a bundle (see ``fos.bundle``). A batch is then an N x V sparse matrix of token counts
+times the V x D table, and a count of the tokens with nonzero vectors per text. Only out-of-vocabulary words, whose
+vectors are sums of hashed n-gram vectors, are looked up with the FastText model, once per distinct word in the batch.
+
+The result matches ``get_sentence_vector()`` to within float32 rounding: FastText sums a text's word vectors one at a
+time in text order, and the sparse product sums them in order of word ID, with repeated words multiplied by their
+counts. The table has a row of ``FASTTEXT_DIM`` float32s per word, so ``max_words`` can limit it to the most frequent
+words (FastText sorts its vocabulary by frequency); the others are looked up like out-of-vocabulary words.
+
+A compact variant of the model is a table of just the words in (a sample of) our corpus, including words outside the
+model's vocabulary, with its rows quantized to int8 (with a scale per row) or float16. It replaces the full model:
+``FieldModel(fasttext_table=...)`` loads it instead, and words that aren't in it are skipped rather than looked up.
+Quantized rows are gathered and dequantized for each batch before the product. Scores from a compact variant differ
+from the full model's, so ``scripts/compact_fasttext.py`` reports their agreement (see ``fos.topk.field_agreement()``).
+"""
+import json
+import logging
+import os
+from datetime import datetime as dt
+from collections import Counter
+from itertools import repeat
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from fos.settings import ASSETS_DIR, EN_FASTTEXT_PATH
+from fos.vectors import load_fasttext, row_norm
+
+if TYPE_CHECKING:
+    from fasttext.FastText import _FastText
+
+logger = logging.getLogger(__name__)
+
+# Increment this when the table layout changes, so we don't load tables built by an older version
+TABLE_VERSION = 1
+
+MANIFEST = 'manifest.json'
+
+# Data types in which tables can store word vectors
+TABLE_DTYPES = ('float32', 'float16', 'int8')
+
+
+def table_dir(lang="en") -> Path:
+    """Get the default word vector table directory for a language."""
+    if lang == "en":
+        return ASSETS_DIR / 'en_fasttext_table'
+    raise ValueError(lang)
+
+
+def word_vectors(model: '_FastText', words: Sequence[str]) -> np.ndarray:
+    """Get the normalized FastText vectors of words, as ``get_sentence_vector()`` averages them. Words whose vectors
+    are zero (e.g. out-of-vocabulary words without n-grams) have zeroed rows."""
+    vectors = np.zeros((len(words), model.get_dimension()), dtype=np.float32)
+    for i, word in enumerate(words):
+        vectors[i] = model.get_word_vector(word)
+    return row_norm(vectors)
+
+
+def quantize_rows(vectors: np.ndarray, dtype='int8') -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Quantize the rows of a float32 array, returning the quantized array and, for int8, a scale for each row."""
+    if dtype == 'float32':
+        return vectors, None
+    if dtype == 'float16':
+        return vectors.astype(np.float16), None
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1, initial=0.0) / 127.0
+        scales[scales == 0.0] = 1.0
+        return np.rint(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    raise ValueError(f'Unknown table dtype {dtype}; expected one of {TABLE_DTYPES}')
+
+
+def corpus_vocab(texts: Iterable[str], min_count=1, max_words: Optional[int] = None) -> List[str]:
+    """Get the words in (preprocessed) texts that appear at least ``min_count`` times, most frequent first."""
+    counts = Counter()
+    for text in texts:
+        counts.update(text.split())
+    return [word for word, count in counts.most_common(max_words) if count >= min_count]
+
+
+def build_word_table(lang="en", output_dir: Optional[Union[str, Path]] = None, model: Optional['_FastText'] = None,
+                     max_words: Optional[int] = None, chunk_size=10_000, words: Optional[Sequence[str]] = None,
+                     dtype='float32') -> Path:
+    """Build a table of the normalized vectors of the words in a FastText model's vocabulary.
+
+    :param lang: Language, 'en'.
+    :param output_dir: Table directory. By default, ``table_dir(lang)``.
+    :param model: Optionally, the FastText model. By default, we load it with ``load_fasttext(lang)``.
+    :param max_words: Optionally, include only this many of the most frequent words.
+    :param chunk_size: Number of word vectors to look up at a time.
+    :param words: Optionally, the words to include instead of the model's vocabulary, e.g. from ``corpus_vocab()``
+        for a compact variant. They needn't be in the model's vocabulary.
+    :param dtype: Data type of the stored vectors, one of ``TABLE_DTYPES``. With int8, we also store row scales.
+    :return: The table directory.
+    """
+    if lang == "en":
+        source_path = EN_FASTTEXT_PATH
+    else:
+        raise ValueError(lang)
+    output_dir = Path(output_dir) if output_dir is not None else table_dir(lang)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if model is None:
+        model = load_fasttext(lang)
+    if dtype not in TABLE_DTYPES:
+        raise ValueError(f'Unknown table dtype {dtype}; expected one of {TABLE_DTYPES}')
+    vocab = words is None
+    words = model.get_words() if vocab else list(words)
+    if max_words is not None:
+        words = words[:max_words]
+
+    # Write the table in chunks to a memory-mapped file, so we never hold all of it
+    tmp_path = output_dir / 'word_vectors.tmp.npy'
+    table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.dtype(dtype),
+                                      shape=(len(words), model.get_dimension()))
+    counted = np.zeros(len(words), dtype=np.float32)
+    scales = np.ones(len(words), dtype=np.float32)
+    for start in range(0, len(words), chunk_size):
+        vectors = word_vectors(model, words[start:start + chunk_size])
+        stop = start + len(vectors)
+        counted[start:stop] = vectors.any(axis=1)
+        table[start:stop], chunk_scales = quantize_rows(vectors, dtype)
+        if chunk_scales is not None:
+            scales[start:stop] = chunk_scales
+    table.flush()
+    del table
+    os.replace(tmp_path, output_dir / 'word_vectors.npy')
+    np.save(output_dir / 'counted.npy', counted, allow_pickle=False)
+    if dtype == 'int8':
+        np.save(output_dir / 'scales.npy', scales, allow_pickle=False)
+    with open(output_dir / 'words.txt', 'wt') as f:
+        f.writelines(f'{word}\n' for word in words)
+
+    manifest = {
+        'version': TABLE_VERSION,
+        'lang': lang,
+        'created': dt.now().isoformat(),
+        'source': {'path': str(source_path), 'size': os.path.getsize(source_path),
+                   'mtime': os.path.getmtime(source_path)} if source_path.exists() else None,
+        'words': len(words),
+        'max_words': max_words,
+        'dim': model.get_dimension(),
+        'dtype': dtype,
+        # Whether the table is the model's vocabulary, or other words (e.g. a compact variant's corpus vocabulary)
+        'vocab': vocab,
+    }
+    with open(output_dir / MANIFEST, 'wt') as f:
+        json.dump(manifest, f, indent=2)
+    return output_dir
+
+
+class FastTextEngine:
+
+    def __init__(self, words: Sequence[str], vectors: np.ndarray, counted: Optional[np.ndarray] = None,
+                 fasttext: Optional['_FastText'] = None, scales: Optional[np.ndarray] = None):
+        """Embed batches of texts with FastText sentence vectors.
+
+        :param words: The words in the table, in row order.
+        :param vectors: V x D array of normalized word vectors, as from ``word_vectors()``, or quantized as from
+            ``quantize_rows()``.
+        :param counted: Optionally, 1 for each word whose vector isn't zero and 0 otherwise. By default, we find them.
+        :param fasttext: The FastText model, for out-of-vocabulary words. Without it, out-of-vocabulary words are
+            skipped, which doesn't match ``get_sentence_vector()`` for texts that have them.
+        :param scales: For int8 vectors, the scale of each row.
+        """
+        self.word2id = {word: i for i, word in enumerate(words)}
+        self.vectors = vectors
+        self.scales = scales
+        self.counted = np.asarray(counted if counted is not None else vectors.any(axis=1), dtype=np.float32)
+        self.fasttext = fasttext
+        self.dim = vectors.shape[1]
+        self.n_words = len(self.word2id)
+
+    @classmethod
+    def from_fasttext(cls, model: '_FastText', max_words: Optional[int] = None) -> 'FastTextEngine':
+        """Create an engine with a table built in memory from a FastText model."""
+        words = model.get_words()
+        if max_words is not None:
+            words = words[:max_words]
+        return cls(words, word_vectors(model, words), fasttext=model)
+
+    @classmethod
+    def from_table(cls, path: Union[str, Path], fasttext: Optional['_FastText'] = None) -> 'FastTextEngine':
+        """Create an engine from a table directory, as from ``build_word_table()``, memory-mapping the table."""
+        path = Path(path)
+        if not (path / MANIFEST).exists():
+            raise FileNotFoundError(f'No word vector table manifest in {path}')
+        with open(path / MANIFEST, 'rt') as f:
+            manifest = json.load(f)
+        if manifest['version'] != TABLE_VERSION:
+            raise ValueError(f"Word vector table version is {manifest['version']}; expected {TABLE_VERSION}. "
+                             f"Rebuild it with scripts/build_fasttext_table.py")
+        source = manifest['source']
+        if source is not None and Path(source['path']).exists() \
+                and os.path.getmtime(source['path']) != source['mtime']:
+            logger.warning(f'The FastText model has changed since the word vector table in {path} was built')
+        with open(path / 'words.txt', 'rt') as f:
+            words = f.read().split('\n')[:-1]
+        scales = np.load(path / 'scales.npy') if manifest['dtype'] == 'int8' else None
+        return cls(words, np.load(path / 'word_vectors.npy', mmap_mode='r'), np.load(path / 'counted.npy'),
+                   fasttext=fasttext, scales=scales)
+
+    def get_dimension(self) -> int:
+        """Get the dimension of the vectors, like ``_FastText.get_dimension()``."""
+        return self.dim
+
+    def get_sentence_vector(self, text: str) -> np.ndarray:
+        """Embed one text, like ``_FastText.get_sentence_vector()``, so an engine can stand in for the model."""
+        return self.embed([text])[0]
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Embed a batch of (preprocessed) texts.
+
+        :param texts: Texts, in which words are separated by whitespace.
+        :return: N x D array of sentence vectors, as from ``get_sentence_vector()``. They aren't normalized.
+        """
+        # Look up every word in the batch, giving -1 for words that aren't in the table
+        tokens = [text.split() for text in texts]
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        flat = [token for doc in tokens for token in doc]
+        word_ids = np.fromiter(map(self.word2id.get, flat, repeat(-1)), dtype=np.int64, count=len(flat))
+        doc_ids = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+
+        # Sum the word vectors of each text, and count the words with nonzero vectors
+        known = word_ids >= 0
+        if self.vectors.dtype == np.float32:
+            counts = self._counts(doc_ids[known], word_ids[known], (len(texts), self.n_words))
+            sums = np.asarray(counts @ self.vectors, dtype=np.float32)
+            n_counted = counts @ self.counted
+        else:
+            # Gather and dequantize the rows of the words in the batch, rather than converting the whole table
+            rows, columns = np.unique(word_ids[known], return_inverse=True)
+            counts = self._counts(doc_ids[known], columns, (len(texts), len(rows)))
+            sums = np.asarray(counts @ self.dequantize(rows), dtype=np.float32)
+            n_counted = counts @ self.counted[rows]
+        if self.fasttext is not None and not known.all():
+            # Look up each distinct out-of-vocabulary word once
+            oov_index = {}
+            oov_ids = np.fromiter((oov_index.setdefault(flat[i], len(oov_index)) for i in np.flatnonzero(~known)),
+                                  dtype=np.int64, count=len(flat) - known.sum())
+            oov_vectors = word_vectors(self.fasttext, list(oov_index))
+            oov_counts = self._counts(doc_ids[~known], oov_ids, (len(texts), len(oov_index)))
+            sums += oov_counts @ oov_vectors
+            n_counted += oov_counts @ oov_vectors.any(axis=1).astype(np.float32)
+
+        # Average, leaving texts without any counted words zeroed
+        n_counted = n_counted[:, None]
+        return np.divide(sums, n_counted, out=np.zeros_like(sums), where=n_counted > 0)
+
+    def dequantize(self, rows: np.ndarray) -> np.ndarray:
+        """Get rows of the table as float32 vectors."""
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows, None]
+        return vectors
+
+    @staticmethod
+    def _counts(doc_ids: np.ndarray, word_ids: np.ndarray, shape: Tuple[int, int]) -> csr_matrix:
+        # Converting to CSR sums the duplicate (doc, word) pairs
+        return csr_matrix((np.ones(len(doc_ids), dtype=np.float32), (doc_ids, word_ids)), shape=shape)
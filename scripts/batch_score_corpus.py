@@ -1,31 +1,54 @@
 import argparse
+import contextlib
 import json
 import math
 import timeit
 from itertools import zip_longest
 from datetime import datetime as dt
+from pathlib import Path
 
 import numpy as np
-from more_itertools import chunked
 
-from fos.entity import load_entities, embed_entities
+from fos.cache import EmbeddingCache, asset_fingerprint
+from fos.entity import batch_embed_entities, load_entity_index
+from fos.output import ALL_FIELD_SCORES_SCHEMA, OUTPUT_FORMATS, ParquetScoreWriter, all_field_scores_table
+from fos.pipeline import Pipeline, limit_batches
+from fos.profiler import StackSampler, format_profile, profile_stage
 from fos.settings import CORPUS_DIR
-from fos.util import iter_bq_extract
+from fos.tfidf import TfidfEngine
+from fos.util import EXTRACT_SUFFIXES, iter_bq_batches
 from fos.vectors import load_fasttext, load_tfidf, load_field_fasttext, load_field_tfidf, load_field_entities, \
-    load_field_keys, batch_sparse_similarity
-
-
-def row_norm(vectors):
-    norms = np.linalg.norm(vectors, ord=2, axis=1)[:, None]
-    return np.divide(vectors, norms, where=norms != 0.0)
-
-
-def main(lang='en', chunk_size=100_000, limit=100_000):
+    load_field_keys, row_norm, ScoringKernel
+
+
+def write_batch(f, ids, avg_sim, index) -> None:
+    """Write a batch's average field scores to a file handle as JSONL."""
+    for merged_id, row in zip_longest(ids, avg_sim):
+        f.write(json.dumps({
+            'merged_id': merged_id,
+            'fields': [
+                {
+                    'id': k,
+                    'score': None if math.isnan(float(v)) else float(v)
+                }
+                for k, v in zip_longest(index, row)]
+        }) + '\n')
+
+
+def main(lang='en', chunk_size=100_000, limit=100_000, pipeline=False, output_format='jsonl', input_format='jsonl',
+         cache_path=None, cache_max_age_days=None, cache_max_entries=None, profile_dir=None, profile_every=10,
+         profile_interval=0.005):
     print(f'[{dt.now().isoformat()}] Loading assets')
     # Vectors for embedding publications
     fasttext = load_fasttext(lang)
     tfidf, dictionary = load_tfidf(lang)
-    entities = load_entities(lang)
+    # The embedding cache holds float64 tf-idf weights, so with a cache we embed in float64 and cast to float32 to score
+    cache = None
+    if cache_path is not None:
+        cache = EmbeddingCache(cache_path, asset_fingerprint(lang), max_age_days=cache_max_age_days,
+                               max_entries=cache_max_entries)
+    tfidf_engine = TfidfEngine.from_gensim(tfidf, dictionary, dtype=np.float32 if cache is None else np.float64)
+    entity_trie, _, entity_vectors = load_entity_index(lang)
 
     # Field embeddings
     field_fasttext = load_field_fasttext(lang)
@@ -35,58 +58,136 @@ def main(lang='en', chunk_size=100_000, limit=100_000):
     # Field embedding index (gives the field IDs corresponding with field score vector elements)
     index = load_field_keys(lang)
 
+    # With a profiler, we sample the stacks of some batches, attributing samples to stages
+    profiler = None
+    if profile_dir is not None:
+        profiler = StackSampler(profile_dir, every=profile_every, interval=profile_interval).start()
+
+    def in_batch(n, fn, *args):
+        with profiler.batch(n) if profiler is not None else contextlib.nullcontext():
+            return fn(*args)
+
+    def embed_texts(texts):
+        with profile_stage(profiler, 'fasttext'):
+            ft = [fasttext.get_sentence_vector(text) for text in texts]
+            ft = row_norm(ft)
+
+        with profile_stage(profiler, 'tfidf'):
+            dtm = tfidf_engine.embed(texts)
+
+        with profile_stage(profiler, 'entities'):
+            ent = batch_embed_entities(texts, entity_trie, entity_vectors)
+        return ft, dtm, ent
+
+    def embed(batch):
+        ids, texts = batch
+        if cache is not None:
+            ft, dtm, ent = cache.embed(texts, embed_texts, tfidf_engine.n_terms)
+            return ids, ft, dtm.astype(np.float32), ent
+        return (ids, *embed_texts(texts))
+
+    # Average over the positive similarities for each publication-field pair, or NaN if there are none
+    kernel = ScoringKernel(field_fasttext.index, field_tfidf.index, field_entities.index, positive_only=True,
+                           fill=np.nan)
+
+    def score(embedded):
+        ids, ft, dtm, ent = embedded
+        # In pipeline mode, the write stage may still be using the previous batch's scores while we score this one,
+        # so we can't return them in the kernel's buffer
+        out = np.empty((len(ids), len(index)), dtype=np.float32) if pipeline else None
+        with profile_stage(profiler, 'score'):
+            avg_sim = kernel.score(ft, dtm, ent, out=out)
+        return ids, avg_sim
+
     i = 0
     start_time = timeit.default_timer()
     print(f'[{dt.now().isoformat()}] Starting job')
 
-    with open(CORPUS_DIR / f'{lang}_scores.jsonl', 'wt') as f:
-        # Break iterable into sub-iterables with chunk_size elements. The last sub-iterable will (probably) have length
-        # less than chunk_size.
-        for batch in chunked(iter_bq_extract(f'{lang}_'), chunk_size):
-            batch_start_time = timeit.default_timer()
-            ft = [fasttext.get_sentence_vector(record['text']) for record in batch]
-            ft = row_norm(ft)
-            ft_sim = np.dot(field_fasttext.index, ft.T).T
-
-            bow = [dictionary.doc2bow(record['text'].split()) for record in batch]
-            dtm = [doc for doc in tfidf.gensim_model[bow]]
-            tfidf_sim = batch_sparse_similarity(dtm, field_tfidf.index)
-
-            ent = [embed_entities(record['text'], entities) for record in batch]
-            ent = row_norm(ent)
-            entity_sim = np.dot(field_entities.index, ent.T).T
-
-            sims = np.array((ft_sim, tfidf_sim.A, entity_sim))
-            avg_sim = np.apply_along_axis(lambda x: np.average(x[x > 0.0], axis=0), 0, sims)
-
-            for record, row in zip_longest(batch, avg_sim):
-                f.write(json.dumps({
-                    'merged_id': record['merged_id'],
-                    'fields': [
-                        {
-                            'id': k,
-                            'score': None if math.isnan(float(v)) else float(v)
-                        }
-                        for k, v in zip_longest(index, row)]
-                }) + '\n')
-            i += len(batch)
-
-            batch_stop_time = timeit.default_timer()
-            batch_elapsed = round(batch_stop_time - batch_start_time, 1)
-            print(f'[{dt.now().isoformat()}] Scored {len(batch):,} docs in {batch_elapsed}s ({i:,} scored so far)')
-
-            if limit and (i >= limit):
-                print(f'[{dt.now().isoformat()}] Stopping (--limit was {limit:,})')
-                break
+    output_path = CORPUS_DIR / f'{lang}_scores.{output_format}'
+    if output_format == 'parquet':
+        # We write each batch's scores as a Parquet row group
+        output = ParquetScoreWriter(output_path, schema=ALL_FIELD_SCORES_SCHEMA)
+
+        def write_scores(ids, avg_sim):
+            with profile_stage(profiler, 'write'):
+                output.write_table(all_field_scores_table(ids, avg_sim, index))
+    else:
+        output = open(output_path, 'wt')
+
+        def write_scores(ids, avg_sim):
+            with profile_stage(profiler, 'write'):
+                write_batch(output, ids, avg_sim, index)
+
+    with output:
+        # Read batches of (merged IDs, texts) with chunk_size elements. The last batch will (probably) have length less
+        # than chunk_size.
+        batches = limit_batches(iter_bq_batches(f'{lang}_', batch_size=chunk_size, extract_format=input_format), limit,
+                                size=lambda batch: len(batch[0]))
+        if profiler is not None:
+            batches = profiler.iter_stage('read', batches)
+
+        if pipeline:
+            def write(scored):
+                nonlocal i
+                ids, avg_sim = scored
+                write_scores(ids, avg_sim)
+                i += len(ids)
+                print(f'[{dt.now().isoformat()}] Wrote {len(ids):,} docs ({i:,} scored so far)')
+
+            # Batches carry their number, for the profiler
+            stages = Pipeline(enumerate(batches), [
+                ('embed', lambda item: (item[0], in_batch(item[0], embed, item[1]))),
+                ('score', lambda item: (item[0], in_batch(item[0], score, item[1]))),
+                ('write', lambda item: in_batch(item[0], write, item[1])),
+            ])
+            stages.run()
+            print(f'[{dt.now().isoformat()}] Pipeline stage occupancy:\n{stages.report()}')
+        else:
+            for n, batch in enumerate(batches):
+                batch_start_time = timeit.default_timer()
+                in_batch(n, lambda: write_scores(*score(embed(batch))))
+                i += len(batch[0])
+
+                batch_stop_time = timeit.default_timer()
+                batch_elapsed = round(batch_stop_time - batch_start_time, 1)
+                print(f'[{dt.now().isoformat()}] Scored {len(batch[0]):,} docs in {batch_elapsed}s '
+                      f'({i:,} scored so far)')
+
+        if limit and (i >= limit):
+            print(f'[{dt.now().isoformat()}] Stopped (--limit was {limit:,})')
 
     stop_time = timeit.default_timer()
     elapsed = round(stop_time - start_time, 1)
     print(f'[{dt.now().isoformat()}] Scored {i:,} docs in {elapsed}s')
+    if cache is not None:
+        cache.close()
+        print(f'[{dt.now().isoformat()}] Embedding cache: {cache.stats.report()}')
+    if profiler is not None:
+        print(f'[{dt.now().isoformat()}] Wrote sampled stacks to {profile_dir}:\n{format_profile(profiler.close())}')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Score merged corpus text')
     parser.add_argument('lang', choices=('en',), help='Language')
     parser.add_argument('--limit', type=int, default=100_000, help='Record limit')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Read, embed, score and write batches in concurrent stages, and report stage occupancy')
+    parser.add_argument('--input-format', choices=tuple(EXTRACT_SUFFIXES), default='jsonl',
+                        help='Format of the corpus extract in assets/corpus (see download_corpus.py --format)')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='jsonl', help='Output format')
+    parser.add_argument('--cache', type=Path, help='Cache publication embeddings in this SQLite database')
+    parser.add_argument('--cache-max-age-days', type=float,
+                        help='Evict cached embeddings not used in this many days')
+    parser.add_argument('--cache-max-entries', type=int,
+                        help='Evict the least-recently-used cached embeddings beyond this many')
+    parser.add_argument('--profile', type=Path,
+                        help='Sample the stacks of some batches, writing collapsed stacks per stage to this directory')
+    parser.add_argument('--profile-every', type=int, default=10,
+                        help='With --profile, sample every Nth batch (default: 10)')
+    parser.add_argument('--profile-interval', type=float, default=5,
+                        help='With --profile, milliseconds between samples (default: 5)')
     args = parser.parse_args()
-    main(lang=args.lang, limit=args.limit)
+    main(lang=args.lang, limit=args.limit, pipeline=args.pipeline, output_format=args.output_format,
+         input_format=args.input_format, cache_path=args.cache, cache_max_age_days=args.cache_max_age_days,
+         cache_max_entries=args.cache_max_entries, profile_dir=args.profile, profile_every=args.profile_every,
+         profile_interval=args.profile_interval / 1000)
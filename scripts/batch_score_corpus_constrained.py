@@ -4,160 +4,78 @@ Score batches of documents in terms of their similarity to fields.
 This script achieves some efficiency gains over `batch_score_corpus.py` by restricting
 L2/L3 scoring for publications to the L2/L3 fields with a top-3 L0/L1 ancestor. (We
 previously imposed this restriction after ingest.) The script also limits output to
-top-10 fields in each level.
-"""
-import argparse
-import json
-import timeit
-from datetime import datetime as dt
-from typing import Dict, Tuple, List
+top-10 fields in each level (configurable with ``--top-k`` and ``--levels``).
 
-import numpy as np
-import pandas as pd
-from more_itertools import chunked
+With ``--workers N``, input shards are scored by a pool of N processes that fork from this one after it loads the
+model, and this process merges their output.
 
-from fos.entity import embed_entities
-from fos.model import FieldModel
-from fos.settings import CORPUS_DIR, ASSETS_DIR
-from fos.util import iter_bq_extract
-from fos.vectors import batch_sparse_similarity
+With ``--checkpoint``, each input shard's output goes to part files and a manifest records the finished ones, so a run
+that's interrupted (e.g. by preemption, which sends SIGTERM) can continue with ``--resume`` (see ``fos.checkpoint``).
 
+With ``--metrics``, stage throughput, batch latency, queue depths, empty embedding counts, cache hit rates and peak RSS
+are written as JSON lines, and with ``--prometheus``, to a Prometheus textfile (see ``fos.metrics``).
 
-def row_norm(vectors):
-    """Normalize document (row) vectors in an array of document embeddings."""
-    norms = np.linalg.norm(vectors, ord=2, axis=1)[:, None]
-    return np.divide(vectors, norms, where=norms != 0.0)
+With ``--raw-text``, the extract has raw titles and abstracts rather than text preprocessed in BigQuery, and we
+preprocess them here (see ``fos.preprocess``).
 
+With ``--fasttext-table DIR``, FastText sentence vectors are computed for each batch at once from a precomputed table
+of word vectors (see ``fos.wordvectors``), rather than one text at a time. With ``--compact-fasttext DIR``, a compact
+variant of the FastText model (from ``compact_fasttext.py``) replaces the full model, which we then don't load.
 
-def load_meta():
-    """Load field metadata."""
-    return pd.read_json(ASSETS_DIR / 'fields/field_meta.jsonl', lines=True)
+With ``--profile DIR``, the stacks of every Nth batch (``--profile-every``) are sampled, and written as collapsed stacks
+per stage for flame graphs (see ``fos.profiler``).
+"""
+import argparse
+import contextlib
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import timeit
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Tuple, List, Optional, Sequence
 
+import numpy as np
+from scipy.sparse import csr_matrix
 
-def batch_fasttext(fasttext, batch):
-    """Embed a batch of texts using FastText."""
-    vectors = [fasttext.get_sentence_vector(record['text']) for record in batch]
+from fos.cache import EmbeddingCache, asset_fingerprint
+from fos.checkpoint import Checkpoint, StopFlag, ignore_signals, poll_results, skip_records, until_stopped
+from fos.constraints import load_meta, load_constraints, check_constraints
+from fos.entity import batch_embed_entities
+from fos.metrics import MetricsRecorder
+from fos.model import FieldModel
+from fos.output import OUTPUT_FORMATS, open_score_writer
+from fos.pipeline import Pipeline, limit_batches
+from fos.preprocess import BatchPreprocessor
+from fos.profiler import StackSampler, format_profile, profile_stage
+from fos.settings import CORPUS_DIR
+from fos.tfidf import TfidfEngine
+from fos.topk import top_k_by_level, to_score_records
+from fos.util import EXTRACT_SUFFIXES, iter_bq_batches, iter_bq_file_batches, list_bq_extract
+from fos.vectors import ScoringKernel, ScoringBuffers, row_norm
+from fos.wordvectors import FastTextEngine
+
+# Columns of a corpus extract with raw titles and abstracts, for --raw-text
+RAW_COLUMNS = ('merged_id', 'title', 'abstract')
+
+
+def batch_fasttext(fasttext, texts):
+    """Embed a batch of texts using FastText, or a FastTextEngine."""
+    if isinstance(fasttext, FastTextEngine):
+        return row_norm(fasttext.embed(texts))
+    vectors = [fasttext.get_sentence_vector(text) for text in texts]
     return row_norm(vectors)
 
 
-def batch_entities(entities, batch):
+def batch_entities(entity_trie, entity_vectors, texts):
     """Embed a batch of text entities using FastText."""
-    vectors = [embed_entities(record['text'], entities) for record in batch]
-    return row_norm(vectors)
-
+    return batch_embed_entities(texts, entity_trie, entity_vectors)
 
-def cosine_similarity(docs, fields):
-    """Calculate the similarity between documents and fields."""
-    return np.dot(docs, fields.T)
 
-
-def batch_tfidf(tfidf, dictionary, batch):
+def batch_tfidf(tfidf_engine, texts):
     """Embed a batch of texts using tf-idf."""
-    bow = [dictionary.doc2bow(record['text'].split()) for record in batch]
-    dtm = [doc for doc in tfidf.gensim_model[bow]]
-    return dtm
-
-
-def average_similarity(ft, entity, tfidf):
-    """Average the FastText, entity FastText, and tf-idf similarities for a batch.
-
-    Not all documents will have similarity scores of all types. We take the average
-    over available score types.
-    """
-    sims = np.array((ft, tfidf.A, entity))
-    valid_mask = (sims >= 0) & (sims <= 1)
-    valid_sums = np.sum(sims * valid_mask, axis=0)
-    valid_counts = np.sum(valid_mask, axis=0)
-    avg = np.divide(valid_sums, valid_counts, where=valid_counts > 0)
-    return avg
-
-
-def batch_score(ft, dtm, ent, field_ft, field_tfidf, field_entities):
-    """Score a batch of document embeddings and return an average score."""
-    ft_sim = cosine_similarity(ft, field_ft)
-    tfidf_sim = batch_sparse_similarity(dtm, field_tfidf)
-    entity_sim = cosine_similarity(ent, field_entities)
-    scores = average_similarity(ft_sim, entity_sim, tfidf_sim)
-    return scores
-
-
-def rank(scores, offset=0):
-    """Rank the field scores within a level."""
-    # Fill any NaNs with 0.0 for ranking
-    scores = np.nan_to_num(scores, copy=False)
-    # Get the indices that would sort the scores ascending and keep the top 10
-    ranked_indices = np.argsort(scores, axis=1)[:, -10:]
-    # Get the corresponding top 10 scores ascending, matching the ranked_indices
-    ranked_scores = scores[np.arange(scores.shape[0])[:, None], ranked_indices]
-    # We passed into this function a slice of the full scores array for ranking within
-    # fields, so the indices found here are offset from those in the full scores array
-    # by where the field slice begins. To use these indices to reference elements in
-    # the full scores array, we need to adjust for that offset. Otherwise, the wrong
-    # field names will be associated with scores.
-    ranked_indices += offset
-    return ranked_indices, ranked_scores
-
-
-def check_constraints(top_l0, top_l1, constraints):
-    """Retrieve eligible L2/3s given top L0s and top L1s."""
-    eligible = []
-    constraint_keys = []
-    for (l0, l1), l23s in constraints.items():
-        if l0 in top_l0 and l1 in top_l1:
-            eligible.extend(l23s)
-            constraint_keys.append((l0, l1))
-    return eligible, constraint_keys
-
-
-def load_constraints() -> Dict[Tuple[int, int], List[int]]:
-    """Load constraints as a dict mapping L0 and L1 field indexes to their descendant
-     L2 and L3 field indexes.
-
-    There are 12 (L0, L1) field pairs that have L2/L3 descendants. After scoring papers
-    for L0/L1s, we only want to score them for L2s and L3s that they're eligible for. We
-    require a top three L0 score and a top three L1 score for a paper to be eligible for
-    the L2/L3 descendants of that L0 and L1.
-    """
-    # meta gives us the levels for each field, which don't appear in the children table
-    meta = load_meta()
-    # The children table gives us all parent-child pairs, so we start by selecting the
-    #  L0-L1 pairs.
-    children = pd.read_json(ASSETS_DIR / 'fields/field_children.jsonl', lines=True)
-    l0_l1 = children.loc[children['parent_name'].isin(meta.loc[meta.level == 0, 'name'])]. \
-        rename(columns={'parent_name': 'l0', 'child_name': 'l1'})
-    # Inner joining the L0-L1 pairs with the children table then gives us each L0,L1,L2/3 triple,
-    # because the L3s are descendants of L1s, and not children of specific L2s. (They're clearly
-    # lower-level than L2s, but placing them under particular L2s wasn't possible.)
-    constraints = pd.merge(l0_l1, children.rename(columns={'parent_name': 'l1'}), on='l1')
-    # Aggregating over L2/L3s we get a list of the L2s/L3s for each L0-L1 pair
-    constraints = constraints.groupby(['l0', 'l1'], as_index=False).agg(child_name=('child_name', list))
-
-    # For slicing field embedding matrices we need indexes, not field names
-    def to_indices(names):
-        return [meta['name'][meta['name'] == name].index[0] for name in names]
-
-    # Map the field names to indices
-    constraints['child_idx'] = constraints['child_name'].apply(to_indices)
-    constraints['l0_idx'] = to_indices(constraints['l0'])
-    constraints['l1_idx'] = to_indices(constraints['l1'])
-
-    # Return a mapping that looks like (8, 1) => [755, 756, 757]
-    constraints.set_index(['l0_idx', 'l1_idx'], inplace=True)
-    return constraints['child_idx'].to_dict()
-
-
-def to_score_records(indices, scores, index):
-    """Format field scores for a document for BigQuery ingest as an array of structs."""
-    records = []
-    # The indices and scores are sorted ascending
-    for field_id, score in zip(reversed(indices), reversed(scores)):
-        if np.isnan(score) or score == 0.0:
-            continue
-        records.append({
-            'name': index[field_id],
-            'score': round(float(score), 4),
-        })
-    return records
+    return tfidf_engine.embed(texts)
 
 
 def check_distinct(results):
@@ -167,115 +85,508 @@ def check_distinct(results):
         raise ValueError('Duplicate field names within the scores for a record')
 
 
-def main(chunk_size=100_000, limit=100_000, output_path=CORPUS_DIR / "en_scores.jsonl"):
-    print(f'[{dt.now().isoformat()}] Loading assets')
+class ConstrainedScorer:
+
+    def __init__(self, model: FieldModel = None, k=10, levels: Sequence[int] = (0, 1, 2, 3),
+                 cache: Optional[EmbeddingCache] = None, metrics: Optional[MetricsRecorder] = None,
+                 profiler: Optional[StackSampler] = None, preprocessor: Optional[BatchPreprocessor] = None,
+                 fasttext_engine: Optional[FastTextEngine] = None):
+        """Score batches of publication records against fields, subject to the L2/L3 constraints.
+
+        :param model: A FieldModel. If None, the default model is loaded.
+        :param k: Number of top fields to output per level.
+        :param levels: Levels for which to output top fields.
+        :param cache: Optionally, a cache of publication embeddings to consult before embedding texts.
+        :param metrics: Optionally, a recorder for stage timings and counts of empty embeddings.
+        :param profiler: Optionally, a stack sampler, to which we report stages.
+        :param preprocessor: Optionally, a preprocessor for batches of raw text. With a preprocessor, batches are
+            (merged IDs, titles, abstracts) rather than (merged IDs, preprocessed texts).
+        :param fasttext_engine: Optionally, an engine for FastText sentence vectors from a table of word vectors, to
+            use instead of the model's ``get_sentence_vector()``.
+        """
+        self.k = k
+        self.output_levels = list(levels)
+        self.cache = cache
+        self.metrics = metrics
+        self.profiler = profiler
+        self.preprocessor = preprocessor
+        self.fasttext_engine = fasttext_engine
+        # Columns to read from the corpus extract
+        self.columns = RAW_COLUMNS if preprocessor is not None else ('merged_id', 'text')
+        # Load vectors for fields + models for embedding publications
+        self.model = FieldModel() if model is None else model
+
+        # Pulling these arrays out of the model instance is slightly faster
+        self.field_fasttext = self.model.field_fasttext.index
+        self.field_tfidf = self.model.field_tfidf.index
+        self.field_entities = self.model.field_entities.index
+
+        # Embed batches with tf-idf as sparse matrices rather than gensim's lists of tuples. The cache holds float64
+        # weights, so with a cache we embed in float64 and cast to float32 for scoring
+        self.tfidf_engine = TfidfEngine.from_gensim(self.model.tfidf, self.model.dictionary,
+                                                    dtype=np.float32 if cache is None else np.float64)
+
+        # Count entity mentions with an entity ID trie, then embed them with one product against the entity vectors
+        self.entity_trie, _, self.entity_vectors = self.model.entity_index
+
+        # Load constraints for scoring L2/L3 fields
+        self.constraints = load_constraints()
+
+        # Field meta
+        meta = load_meta()
+        self.index = meta['name'].to_numpy()
+        self.levels = meta['level'].to_numpy()
+
+        # If levels isn't monotonic non-decreasing, the offset logic below will fail
+        assert np.all(np.diff(self.levels) >= 0)
+        self.l1_offset = np.argmax(self.levels == 1).astype(int)
+        self.l2_offset = np.argmax(self.levels == 2).astype(int)
+        self.l3_offset = np.argmax(self.levels == 3).astype(int)
+        assert 0 < self.l1_offset < self.l2_offset < self.l3_offset
+
+        # We use the L0-L1 slices of all the assets repeatedly on each batch, so copy them out
+        self.l0l1_levels = self.levels[self.levels <= 1]
+        self.l0l1_fasttext = self.field_fasttext[self.levels <= 1]
+        self.l0l1_tfidf = self.field_tfidf[self.levels <= 1]
+        self.l0l1_entity = self.field_entities[self.levels <= 1]
+        # We score a batch with one kernel at a time, and copy what we need out of a kernel's result before
+        # scoring with the next one, so the kernels can share work buffers
+        buffers = ScoringBuffers()
+        self.l0l1_kernel = ScoringKernel(self.l0l1_fasttext, self.l0l1_tfidf, self.l0l1_entity, buffers=buffers)
+
+        # Likewise copy out the field embeddings for each constraint's L2/L3 descendants. We index constraints by
+        # position, and their descendants by column in an N x (L2 + L3 fields) array of scores
+        self.constraint_l0 = np.array([l0 for l0, _ in self.constraints])
+        self.constraint_l1 = np.array([l1 for _, l1 in self.constraints])
+        self.constraint_columns = []
+        self.constraint_kernels = []
+        for descendants in self.constraints.values():
+            assert np.all(self.levels[descendants] >= 2)
+            self.constraint_columns.append(np.array(descendants) - self.l2_offset)
+            self.constraint_kernels.append(
+                ScoringKernel(self.field_fasttext[descendants], self.field_tfidf[descendants],
+                              self.field_entities[descendants], buffers=buffers))
+        self.l23_levels = self.levels[self.l2_offset:]
+
+    @contextlib.contextmanager
+    def stage(self, name: str, docs: int):
+        """Time a stage with the metrics recorder, and attribute samples to it with the profiler, if any."""
+        with self.metrics.stage(name, docs) if self.metrics is not None else contextlib.nullcontext(), \
+                profile_stage(self.profiler, name):
+            yield
+
+    def batch(self, batch: int):
+        """Mark this thread as working on the batch with this number (from zero, as read), for the profiler."""
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.batch(batch)
+
+    def texts(self, batch: Tuple[List[str], ...]) -> Tuple[List[str], List[str]]:
+        """Get the merged IDs and preprocessed texts of a batch, preprocessing raw text if we have a preprocessor."""
+        if self.preprocessor is None:
+            return batch
+        ids, titles, abstracts = batch
+        with self.stage('preprocess', len(ids)):
+            return ids, self.preprocessor.records(titles, abstracts)
+
+    def embed(self, batch: Tuple[List[str], ...]) -> Tuple[List[str], np.ndarray, csr_matrix, np.ndarray]:
+        """Embed a batch of (merged IDs, texts) three ways."""
+        ids, texts = self.texts(batch)
+        if self.cache is not None:
+            with self.stage('embed', len(texts)):
+                ft, dtm, ent = self.cache.embed(texts, self.embed_texts, self.tfidf_engine.n_terms)
+            return ids, ft, dtm.astype(np.float32), ent
+        return (ids, *self.embed_texts(texts))
+
+    def embed_texts(self, texts: List[str]) -> Tuple[np.ndarray, csr_matrix, np.ndarray]:
+        """Embed a batch of texts three ways, without the cache."""
+        with self.stage('fasttext', len(texts)):
+            ft = batch_fasttext(self.model.fasttext if self.fasttext_engine is None else self.fasttext_engine, texts)
+        with self.stage('tfidf', len(texts)):
+            dtm = batch_tfidf(self.tfidf_engine, texts)
+        with self.stage('entities', len(texts)):
+            ent = batch_entities(self.entity_trie, self.entity_vectors, texts)
+        return ft, dtm, ent
+
+    def score_embedded(self, ids, ft, dtm, ent) -> List[dict]:
+        """Score a batch of embedded records, returning a list of output records for BigQuery ingest."""
+        with self.stage('score', len(ids)):
+            return self._score_embedded(ids, ft, dtm, ent)
+
+    def _score_embedded(self, ids, ft, dtm, ent) -> List[dict]:
+        if self.metrics is not None:
+            self.metrics.count_empty(ft, dtm, ent)
+        scores = self.l0l1_kernel.score(ft, dtm, ent)
+
+        # We need at least the top 3 L0s and L1s to check constraints, even if we output fewer
+        top = top_k_by_level(scores, self.l0l1_levels, max(self.k, 3))
+
+        # Get what L2/3s docs are eligible for given their top 3 L0s and top 3 L1s
+        eligible = check_constraints(top[0][0][:, :3], top[1][0][:, :3], self.constraint_l0, self.constraint_l1)
+
+        # For each constraint, gather the eligible docs, score them against the constraint's L2/3s, and scatter the
+        # scores into an N x (L2 + L3 fields) array. Other L2/3 scores are NaN
+        l23_scores = np.full((len(ids), len(self.l23_levels)), np.nan, dtype=np.float32)
+        for constraint, rows in enumerate(eligible.T):
+            rows = np.flatnonzero(rows)
+            if not len(rows):
+                continue
+            descendant_scores = self.constraint_kernels[constraint].score(ft[rows], dtm[rows], ent[rows])
+            l23_scores[np.ix_(rows, self.constraint_columns[constraint])] = descendant_scores
+        top.update(top_k_by_level(l23_scores, self.l23_levels, self.k, offset=self.l2_offset))
+
+        # Format the top fields in each output level, in level order, for each doc
+        level_records = [to_score_records(*(result[:, :self.k] for result in top[level]), self.index)
+                         for level in self.output_levels]
+        output = []
+        for merged_id, *doc_level_records in zip(ids, *level_records):
+            results = [field for fields in doc_level_records for field in fields]
+            check_distinct(results)
+            output.append({
+                'merged_id': merged_id,
+                'fields': results,
+            })
+        return output
+
+    def score(self, batch: Tuple[List[str], ...]) -> List[dict]:
+        """Embed and score a batch of (merged IDs, texts), returning a list of output records for BigQuery ingest."""
+        return self.score_embedded(*self.embed(batch))
+
+
+def score_batches(scorer: ConstrainedScorer, batches, writer, pipeline=False, desc='') -> int:
+    """Score batches of records, writing output with a score writer.
+
+    :param scorer: Scorer.
+    :param batches: Iterable of batches of (merged IDs, texts), as from ``iter_bq_batches()``.
+    :param writer: Score writer (see ``fos.output``). Each batch is written in one call, e.g. as one Parquet row group.
+    :param pipeline: If true, read, embed, score and write batches in concurrent stages (see ``fos.pipeline``).
+    :param desc: Description of the input for progress messages.
+    :return: Count of scored records.
+    """
+    i = 0
+    metrics = scorer.metrics
+    if metrics is not None:
+        batches = metrics.iter_stage('read', batches, size=lambda batch: len(batch[0]))
+    if scorer.profiler is not None:
+        batches = scorer.profiler.iter_stage('read', batches)
+
+    def in_batch(n, fn, *args):
+        with scorer.batch(n):
+            return fn(*args)
+
+    def write(records, batch_start_time, queue_depths=None):
+        nonlocal i
+        with scorer.stage('write', len(records)):
+            i += writer.write(records)
+        print(f'[{dt.now().isoformat()}] Wrote {len(records):,} docs{desc} ({i:,} scored so far)')
+        if metrics is not None:
+            metrics.batch(len(records), timeit.default_timer() - batch_start_time, queue_depths=queue_depths,
+                          cache=scorer.cache)
+
+    if pipeline:
+        # Batches carry their number (for the profiler) and the time they were read (for batch latency)
+        stages = Pipeline(((n, timeit.default_timer(), batch) for n, batch in enumerate(batches)), [
+            ('embed', lambda item: (*item[:2], in_batch(item[0], scorer.embed, item[2]))),
+            ('score', lambda item: (*item[:2], in_batch(item[0], scorer.score_embedded, *item[2]))),
+            ('write', lambda item: in_batch(item[0], write, item[2], item[1], stages.queue_depths())),
+        ])
+        stages.run()
+        print(f'[{dt.now().isoformat()}] Pipeline stage occupancy{desc}:\n{stages.report()}')
+        return i
+
+    for n, batch in enumerate(batches):
+        with scorer.batch(n):
+            batch_start_time = timeit.default_timer()
+            records = scorer.score(batch)
+            batch_elapsed = round(timeit.default_timer() - batch_start_time, 1)
+            print(f'[{dt.now().isoformat()}] Scored {len(records):,} docs{desc} in {batch_elapsed}s')
+            write(records, batch_start_time)
+    return i
+
+
+# With --workers, the parent process loads the scorer before forking its worker pool, so each worker starts with the
+# model already in memory and shares the read-only field matrices with the parent copy-on-write
+_scorer: Optional[ConstrainedScorer] = None
+_chunk_size = 100_000
+_pipeline = False
+_output_format = 'jsonl'
+_stop: Optional[StopFlag] = None
+
+
+def _score_shard(shard_path: Path, part_path: Path) -> Tuple[Path, int]:
+    """Score an input shard in a worker process, writing output to a part file."""
+    with open_score_writer(part_path, _output_format) as writer:
+        i = score_batches(_scorer, iter_bq_file_batches(shard_path, _chunk_size, columns=_scorer.columns), writer,
+                          pipeline=_pipeline, desc=f' from {shard_path.name}')
+    if _scorer.cache is not None:
+        print(f'[{dt.now().isoformat()}] Embedding cache (worker {os.getpid()}): {_scorer.cache.stats.report()}')
+    return part_path, i
+
+
+def _score_shard_star(args):
+    return _score_shard(*args)
+
+
+def _score_checkpoint_shard(shard_path: Path, part_path: Path, skip=0, limit=0) \
+        -> Tuple[str, Optional[Path], int, bool]:
+    """Score an input shard in this or a worker process, writing output to a part file, until SIGTERM.
+
+    :param shard_path: Input shard.
+    :param part_path: Part file for the output.
+    :param skip: Number of the shard's records that were scored before, and should be skipped.
+    :param limit: If nonzero, stop after about this many records.
+    :return: The shard's name, the part path (None if we had already stopped), the count of records scored, and
+        whether the shard is complete.
+    """
+    if _stop:
+        return shard_path.name, None, 0, False
+    batches = skip_records(iter_bq_file_batches(shard_path, _chunk_size, columns=_scorer.columns), skip,
+                           size=lambda batch: len(batch[0]))
+    batches = until_stopped(limit_batches(batches, limit, size=lambda batch: len(batch[0])), _stop)
+    with open_score_writer(part_path, _output_format) as writer:
+        i = score_batches(_scorer, batches, writer, pipeline=_pipeline, desc=f' from {shard_path.name}')
+    return shard_path.name, part_path, i, not (_stop or (limit and i >= limit))
 
-    # Load vectors for fields + models for embedding publications
-    model = FieldModel()
 
-    # Pulling these arrays out of the model instance is slightly faster
-    field_fasttext = model.field_fasttext.index
-    field_tfidf = model.field_tfidf.index
-    dictionary = model.dictionary
-    field_entities = model.field_entities.index
+def _score_checkpoint_shard_star(args):
+    return _score_checkpoint_shard(*args)
 
-    # Load constraints for scoring L2/L3 fields
-    constraints = load_constraints()
 
-    # Field meta
-    meta = pd.read_json(ASSETS_DIR / 'fields/field_meta.jsonl', lines=True)
-    index = meta['name'].to_numpy()
-    levels = meta['level'].to_numpy()
+def score_serial(scorer, writer, chunk_size=100_000, limit=100_000, pipeline=False, input_format='jsonl') -> int:
+    """Score the corpus in this process, writing output with a score writer."""
+    batches = limit_batches(iter_bq_batches('en_', batch_size=chunk_size, extract_format=input_format,
+                                            columns=scorer.columns), limit, size=lambda batch: len(batch[0]))
+    i = score_batches(scorer, batches, writer, pipeline=pipeline)
+    if limit and (i >= limit):
+        print(f'[{dt.now().isoformat()}] Stopped (--limit was {limit:,})')
+    return i
 
-    # If levels isn't monotonic non-decreasing, the offset logic in rank() will fail
-    assert np.all(np.diff(levels) >= 0)
-    l1_offset = np.argmax(levels == 1).astype(int)
-    l2_offset = np.argmax(levels == 2).astype(int)
-    l3_offset = np.argmax(levels == 3).astype(int)
-    assert 0 < l1_offset < l2_offset < l3_offset
 
-    # We use the L0-L1 slices of all the assets repeatedly on each batch, so copy them out
-    l0l1_levels = levels[levels <= 1]
-    l0l1_fasttext = field_fasttext[levels <= 1]
-    l0l1_tfidf = field_tfidf[levels <= 1]
-    l0l1_entity = field_entities[levels <= 1]
+def score_parallel(scorer, writer, output_path, workers, chunk_size=100_000, limit=100_000, ordered=False,
+                   pipeline=False, output_format='jsonl', input_format='jsonl') -> int:
+    """Score the corpus's input shards in a pool of worker processes.
+
+    Each worker scores whole shards and writes their output to part files. This process is the single writer to the
+    output file: it appends each part as its shard completes, in input order if ``ordered`` is true. The limit is
+    checked between shards, so with workers, slightly more than ``limit`` docs may be scored.
+    """
+    global _scorer, _chunk_size, _pipeline, _output_format
+    _scorer = scorer
+    _chunk_size = chunk_size
+    _pipeline = pipeline
+    _output_format = output_format
+
+    parts_dir = Path(f'{output_path}.parts')
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    shards = list_bq_extract('en_', suffix=EXTRACT_SUFFIXES[input_format])
+    tasks = [(shard, parts_dir / f'{shard.name}.{output_format}') for shard in shards]
 
     i = 0
-    start_time = timeit.default_timer()
-    print(f'[{dt.now().isoformat()}] Starting job')
+    with mp.get_context('fork').Pool(workers) as pool:
+        results = pool.imap(_score_shard_star, tasks) if ordered else pool.imap_unordered(_score_shard_star, tasks)
+        for part_path, n in results:
+            writer.append_part(part_path)
+            part_path.unlink()
+            i += n
+            print(f'[{dt.now().isoformat()}] Wrote {n:,} docs from {part_path.name} ({i:,} scored so far)')
+            if limit and (i >= limit):
+                print(f'[{dt.now().isoformat()}] Stopping (--limit was {limit:,})')
+                pool.terminate()
+                break
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return i
 
-    with open(output_path, 'wt') as f:
-        for batch in chunked(iter_bq_extract('en_'), chunk_size):
-            batch_start_time = timeit.default_timer()
 
-            ft = batch_fasttext(model.fasttext, batch)
-            dtm = batch_tfidf(model.tfidf, dictionary, batch)
-            ent = batch_entities(model.entities, batch)
-            scores = batch_score(ft, dtm, ent, l0l1_fasttext, l0l1_tfidf, l0l1_entity)
-
-            top_l0_idx, top_l0_scores = rank(scores[:, l0l1_levels == 0])
-            top_l1_idx, top_l1_scores = rank(scores[:, l0l1_levels == 1], l1_offset)
-
-            # Iterate over docs to get what L2/3s they're eligible for given their
-            # top L0s and top L1s. The top_l{0,1}_idx arrays are sorted ascending, so to
-            # get the top 3 fields in each level by score, we slice into them with -3:
-            eligible, constraint_keys = zip(*[
-                check_constraints(top_l0, top_l1, constraints)
-                for (top_l0, top_l1) in zip(top_l0_idx[:, -3:], top_l1_idx[:, -3:])
-            ])
-
-            # We'll store L2/3 scores in an N x F array because the indexing is convenient
-            l23_scores = np.full((len(batch), len(index)), np.nan)
-            for constraint_key, descendants in constraints.items():
-                eligible_mask = np.array([constraint_key in row_keys for row_keys in constraint_keys])
-                if not any(eligible_mask):
-                    continue
-                descendant_scores = batch_score(
-                    ft[eligible_mask],
-                    [row for (row, mask) in zip(dtm, eligible_mask) if mask],
-                    ent[eligible_mask],
-                    field_fasttext[descendants],
-                    field_tfidf[descendants],
-                    field_entities[descendants],
-                )
-                row_indices = np.where(eligible_mask == True)[0]
-                l23_scores[np.ix_(row_indices, np.array(descendants))] = descendant_scores
-
-            l2_indices, l2_scores = rank(l23_scores[:, levels == 2], l2_offset)
-            l3_indices, l3_scores = rank(l23_scores[:, levels == 3], l3_offset)
-
-            for j, record in enumerate(batch):
-                results = []
-                results.extend(to_score_records(top_l0_idx[j], top_l0_scores[j], index))
-                results.extend(to_score_records(top_l1_idx[j], top_l1_scores[j], index))
-                results.extend(to_score_records(l2_indices[j], l2_scores[j], index))
-                results.extend(to_score_records(l3_indices[j], l3_scores[j], index))
-                check_distinct(results)
-                scores = {
-                    'merged_id': record['merged_id'],
-                    'fields': results,
-                }
-                f.write(json.dumps(scores) + '\n')
-
-            i += len(batch)
-
-            batch_stop_time = timeit.default_timer()
-            batch_elapsed = round(batch_stop_time - batch_start_time, 1)
-            print(f'[{dt.now().isoformat()}] Scored {len(batch):,} docs in {batch_elapsed}s ({i:,} scored so far)')
+def score_checkpointed(scorer, output_path, workers=1, chunk_size=100_000, limit=100_000, pipeline=False,
+                       output_format='jsonl', input_format='jsonl', resume=False) -> Tuple[int, bool]:
+    """Score the corpus shard by shard, checkpointing progress so that an interrupted run can resume.
+
+    Shards are scored in this process or, with more than one worker, in a pool of worker processes, and their output is
+    written to part files in ``{output_path}.parts``. On SIGTERM, we stop after the current batch and keep the parts for
+    ``resume``. Otherwise, the parts are concatenated into the output in input order. With workers, the limit is checked
+    between shards, as in ``score_parallel()``.
 
+    :return: Count of scored records (including any scored before resuming), and whether the run finished.
+    """
+    global _scorer, _chunk_size, _pipeline, _output_format, _stop
+    _scorer = scorer
+    _chunk_size = chunk_size
+    _pipeline = pipeline
+    _output_format = output_format
+
+    settings = {'output_format': output_format, 'input_format': input_format, 'chunk_size': chunk_size,
+                'k': scorer.k, 'levels': scorer.output_levels}
+    checkpoint = Checkpoint(f'{output_path}.parts', settings, resume=resume)
+    shards = list_bq_extract('en_', suffix=EXTRACT_SUFFIXES[input_format])
+    tasks = [(shard, checkpoint.next_part(shard.name, f'.{output_format}'), checkpoint.count(shard.name))
+             for shard in shards if not checkpoint.is_complete(shard.name)]
+    i = checkpoint.total()
+    if i:
+        print(f'[{dt.now().isoformat()}] Resuming after {i:,} docs; {len(tasks):,} of {len(shards):,} shards remain')
+
+    def score_in_process():
+        # i is read as each shard starts, so the limit applies across shards
+        for shard, part_path, skip in tasks:
+            if limit and (i >= limit):
+                break
+            yield _score_checkpoint_shard(shard, part_path, skip, limit - i if limit else 0)
+
+    # Workers see the flag set when this process is signaled, and stop between batches
+    _stop = StopFlag()
+    pool = None
+    try:
+        if workers > 1:
+            pool = mp.get_context('fork').Pool(workers, initializer=ignore_signals)
+            results = poll_results(pool.imap_unordered(_score_checkpoint_shard_star, tasks))
+        else:
+            results = score_in_process()
+        for shard_name, part_path, n, complete in results:
+            if part_path is None:
+                continue
+            checkpoint.record(shard_name, part_path, n, complete)
+            i += n
+            print(f'[{dt.now().isoformat()}] Checkpointed {n:,} docs from {shard_name} ({i:,} scored so far)')
             if limit and (i >= limit):
                 print(f'[{dt.now().isoformat()}] Stopping (--limit was {limit:,})')
                 break
+    finally:
+        stopped = bool(_stop)
+        if pool is not None:
+            # After the limit or an error, stop the workers too. They skip the shards left in the queue, and their
+            # unrecorded parts are removed with the parts directory or discarded on resume
+            _stop.set()
+            pool.close()
+            pool.join()
+        _stop.restore()
+
+    if stopped:
+        return i, False
+    with open_score_writer(output_path, output_format) as writer:
+        for part_path in checkpoint.parts(shard.name for shard in shards):
+            writer.append_part(part_path)
+    checkpoint.remove()
+    return i, True
+
+
+def main(chunk_size=100_000, limit=100_000, output_path=None, workers=1, ordered=False, bundle=None, pipeline=False,
+         k=10, levels=(0, 1, 2, 3), output_format='jsonl', input_format='jsonl', cache_path=None,
+         cache_max_age_days=None, cache_max_entries=None, checkpoint=False, resume=False, metrics_path=None,
+         prometheus_path=None, tracemalloc_top=0, profile_dir=None, profile_every=10, profile_interval=0.005,
+         raw_text=False, preprocess_workers=1, fasttext_table=None, compact_fasttext=None):
+    if output_path is None:
+        output_path = CORPUS_DIR / f'en_scores.{output_format}'
+    metrics = None
+    if metrics_path is not None or prometheus_path is not None:
+        metrics = MetricsRecorder(metrics_path, prometheus_path, tracemalloc_top=tracemalloc_top)
+    print(f'[{dt.now().isoformat()}] Loading assets')
+    cache = None
+    if cache_path is not None:
+        cache = EmbeddingCache(cache_path, asset_fingerprint(fasttext_table=compact_fasttext, bundle=bundle),
+                               max_age_days=cache_max_age_days, max_entries=cache_max_entries)
+    # With workers, each worker preprocesses its own batches; its pool processes can't have children
+    preprocessor = None
+    if raw_text:
+        preprocessor = BatchPreprocessor(workers=preprocess_workers if workers <= 1 else 1)
+    with metrics.stage('load', 0) if metrics is not None else contextlib.nullcontext():
+        model = FieldModel(bundle=bundle, fasttext_table=compact_fasttext)
+        # The table covers the model's vocabulary; the model itself embeds out-of-vocabulary words
+        fasttext_engine = None
+        if fasttext_table is not None:
+            fasttext_engine = FastTextEngine.from_table(fasttext_table, fasttext=model.fasttext)
+        scorer = ConstrainedScorer(model, k=k, levels=levels, cache=cache, metrics=metrics, preprocessor=preprocessor,
+                                   fasttext_engine=fasttext_engine)
+    if profile_dir is not None:
+        scorer.profiler = StackSampler(profile_dir, every=profile_every, interval=profile_interval).start()
+
+    start_time = timeit.default_timer()
+    print(f'[{dt.now().isoformat()}] Starting job')
+
+    finished = True
+    if checkpoint or resume:
+        i, finished = score_checkpointed(scorer, output_path, workers, chunk_size=chunk_size, limit=limit,
+                                         pipeline=pipeline, output_format=output_format, input_format=input_format,
+                                         resume=resume)
+    else:
+        with open_score_writer(output_path, output_format) as writer:
+            if workers > 1:
+                i = score_parallel(scorer, writer, output_path, workers, chunk_size=chunk_size, limit=limit,
+                                   ordered=ordered, pipeline=pipeline, output_format=output_format,
+                                   input_format=input_format)
+            else:
+                i = score_serial(scorer, writer, chunk_size=chunk_size, limit=limit, pipeline=pipeline,
+                                 input_format=input_format)
 
     stop_time = timeit.default_timer()
     elapsed = round(stop_time - start_time, 1)
     print(f'[{dt.now().isoformat()}] Scored {i:,} docs in {elapsed}s')
+    if preprocessor is not None:
+        preprocessor.close()
+    if cache is not None:
+        cache.close()
+        print(f'[{dt.now().isoformat()}] Embedding cache: {cache.stats.report()}')
+    if scorer.profiler is not None:
+        stacks = scorer.profiler.close()
+        print(f'[{dt.now().isoformat()}] Wrote sampled stacks to {profile_dir}:\n{format_profile(stacks)}')
+    if metrics is not None:
+        summary = metrics.close()
+        print(f"[{dt.now().isoformat()}] Batch latency: {summary['latency_percentiles']}; "
+              f"peak RSS {summary['peak_rss_mb']:,.0f} MB")
+    if not finished:
+        sys.exit(f'[{dt.now().isoformat()}] Stopped before finishing; rerun with --resume to continue')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Score merged corpus text')
     parser.add_argument('--batch', type=int, default=100_000, help='Batch size')
     parser.add_argument('--limit', type=int, default=100_000, help='Record limit')
-    parser.add_argument('--output', type=str, default=CORPUS_DIR / f'en_scores.jsonl', help='Output path')
+    parser.add_argument('--output', type=str, help='Output path (default: assets/corpus/en_scores.{jsonl,parquet})')
+    parser.add_argument('--input-format', choices=tuple(EXTRACT_SUFFIXES), default='jsonl',
+                        help='Format of the corpus extract in assets/corpus (see download_corpus.py --format)')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='jsonl', help='Output format')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes; with more than one, input shards are scored in parallel')
+    parser.add_argument('--ordered', action='store_true', help='With --workers, write output in input shard order')
+    parser.add_argument('--bundle', type=Path, help='Load assets from this compiled bundle directory')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Read, embed, score and write batches in concurrent stages, and report stage occupancy')
+    parser.add_argument('--top-k', type=int, default=10, help='Number of top fields to output per level')
+    parser.add_argument('--levels', type=int, nargs='+', default=[0, 1, 2, 3], choices=[0, 1, 2, 3],
+                        help='Levels for which to output top fields')
+    parser.add_argument('--cache', type=Path, help='Cache publication embeddings in this SQLite database')
+    parser.add_argument('--cache-max-age-days', type=float,
+                        help='Evict cached embeddings not used in this many days')
+    parser.add_argument('--cache-max-entries', type=int,
+                        help='Evict the least-recently-used cached embeddings beyond this many')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='Write output per input shard and record finished shards, so interrupted runs can resume')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume a checkpointed run, skipping finished work (implies --checkpoint)')
+    parser.add_argument('--metrics', type=Path, help='Write runtime metrics to this JSON lines file')
+    parser.add_argument('--prometheus', type=Path, help='Also write runtime metrics to this Prometheus textfile')
+    parser.add_argument('--tracemalloc', type=int, default=0,
+                        help='With --metrics, record this many top allocation sites per batch (slow)')
+    parser.add_argument('--raw-text', action='store_true',
+                        help='Read raw title and abstract columns from the extract, and preprocess them here')
+    parser.add_argument('--preprocess-workers', type=int, default=1,
+                        help='With --raw-text and one worker, preprocess batches in this many processes')
+    fasttext_group = parser.add_mutually_exclusive_group()
+    fasttext_group.add_argument('--fasttext-table', type=Path,
+                                help='Embed batches with FastText from this word vector table (see '
+                                     'build_fasttext_table.py)')
+    fasttext_group.add_argument('--compact-fasttext', type=Path,
+                                help='Replace the FastText model with this compact variant (see compact_fasttext.py)')
+    parser.add_argument('--profile', type=Path,
+                        help='Sample the stacks of some batches, writing collapsed stacks per stage to this directory')
+    parser.add_argument('--profile-every', type=int, default=10,
+                        help='With --profile, sample every Nth batch of each input (default: 10)')
+    parser.add_argument('--profile-interval', type=float, default=5,
+                        help='With --profile, milliseconds between samples (default: 5)')
     args = parser.parse_args()
-    main(chunk_size=args.batch, limit=args.limit, output_path=args.output)
+    main(chunk_size=args.batch, limit=args.limit, output_path=args.output, workers=args.workers, ordered=args.ordered,
+         bundle=args.bundle, pipeline=args.pipeline, k=args.top_k, levels=args.levels, output_format=args.output_format,
+         input_format=args.input_format, cache_path=args.cache, cache_max_age_days=args.cache_max_age_days,
+         cache_max_entries=args.cache_max_entries, checkpoint=args.checkpoint, resume=args.resume,
+         metrics_path=args.metrics, prometheus_path=args.prometheus, tracemalloc_top=args.tracemalloc,
+         profile_dir=args.profile, profile_every=args.profile_every, profile_interval=args.profile_interval / 1000,
+         raw_text=args.raw_text, preprocess_workers=args.preprocess_workers, fasttext_table=args.fasttext_table,
+         compact_fasttext=args.compact_fasttext)
@@ -1,40 +1,193 @@
+"""
+Benchmark the stages of scoring.
+
+``run`` times each stage of the scoring path separately, on batches of corpus text: asset loading, preprocessing,
+FastText sentence vectors (per text, and with ``--fasttext-table``, from a word vector table), doc2bow + tf-idf
+(gensim, and our batch engine), entity matching, the three similarity products, averaging, top-k ranking and
+serialization. It repeats these for each batch size, and then times end-to-end scoring with each worker count.
+Results are written as JSON (see ``fos.benchmark``). It also times importing the core scoring modules, and exits with
+an error if an import is over budget or loads a heavy library like gensim.
+
+``imports`` runs just the import checks, which need no assets.
+
+``compare`` compares results against a stored baseline, and exits with an error if any stage regressed.
+"""
 import argparse
 import json
-import timeit
-from itertools import zip_longest
+import multiprocessing as mp
+import sys
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pyarrow as pa
+from more_itertools import chunked
+
+from fos.benchmark import CORE_MODULES, BenchmarkSuite, check_imports, compare, format_comparison, load_results
+from fos.model import FieldModel
+from fos.output import FIELD_SCORES_SCHEMA
+from fos.pipeline import limit_batches
+from fos.preprocess import preprocess_batch
+from fos.settings import CORPUS_DIR
+from fos.topk import top_k_by_level, to_score_records
+from fos.util import iter_bq_batches, preprocess
+from fos.vectors import ScoringKernel, batch_sparse_similarity
+from fos.wordvectors import FastTextEngine
+from scripts.batch_score_corpus_constrained import ConstrainedScorer, batch_fasttext, batch_entities
+
+# Worker processes fork after the parent loads the scorer, as in batch_score_corpus_constrained.py
+_scorer = None
+
+
+def _score(batch):
+    return len(_scorer.score(batch))
+
+
+def read_texts(n_docs, corpus_dir=CORPUS_DIR, extract_format='jsonl'):
+    """Read up to n_docs (merged IDs, texts) from a corpus extract."""
+    ids, texts = [], []
+    for batch_ids, batch_texts in limit_batches(iter_bq_batches('en_', corpus_dir, extract_format=extract_format),
+                                                n_docs, size=lambda batch: len(batch[0])):
+        ids.extend(batch_ids)
+        texts.extend(batch_texts)
+    return ids[:n_docs], texts[:n_docs]
+
+
+def bench_stages(suite: BenchmarkSuite, scorer: ConstrainedScorer, ids, texts, batch_size):
+    """Time each stage of scoring on one batch."""
+    ids, texts = ids[:batch_size], texts[:batch_size]
+    n = len(texts)
+    model = scorer.model
+
+    def measure(stage, fn):
+        return suite.measure(stage, fn, docs=n, batch_size=batch_size)
+
+    measure('preprocess', lambda: [preprocess(text) for text in texts])
+    measure('preprocess_batch', lambda: preprocess_batch(texts))
+    ft = measure('fasttext', lambda: batch_fasttext(model.fasttext, texts))
+    if scorer.fasttext_engine is not None:
+        measure('fasttext_table', lambda: batch_fasttext(scorer.fasttext_engine, texts))
+    measure('tfidf_gensim', lambda: [model.tfidf.gensim_model[model.dictionary.doc2bow(text.split())]
+                                     for text in texts])
+    dtm = measure('tfidf', lambda: scorer.tfidf_engine.embed(texts))
+    ent = measure('entities', lambda: batch_entities(scorer.entity_trie, scorer.entity_vectors, texts))
+
+    # Similarities against every field
+    kernel = ScoringKernel(scorer.field_fasttext, scorer.field_tfidf, scorer.field_entities)
+    sims = [
+        measure('gemm_fasttext', lambda: ft @ kernel.field_fasttext.T),
+        measure('gemm_tfidf', lambda: batch_sparse_similarity(dtm, kernel.field_tfidf).astype(np.float32).toarray()),
+        measure('gemm_entity', lambda: ent @ kernel.field_entities.T),
+    ]
+    scores = measure('average', lambda: kernel.average(sims, out=np.empty_like(sims[0])))
+    top = measure('topk', lambda: top_k_by_level(scores, scorer.levels, scorer.k))
+
+    def records():
+        level_records = [to_score_records(*top[level], scorer.index) for level in scorer.output_levels]
+        return [{'merged_id': merged_id, 'fields': [field for fields in doc_records for field in fields]}
+                for merged_id, *doc_records in zip(ids, *level_records)]
+
+    output = measure('records', records)
+    measure('serialize_jsonl', lambda: ''.join(json.dumps(record) + '\n' for record in output))
+    measure('serialize_parquet', lambda: pa.Table.from_pylist(output, schema=FIELD_SCORES_SCHEMA))
+    measure('score', lambda: scorer.score((ids, texts)))
+
+
+def bench_workers(suite: BenchmarkSuite, scorer: ConstrainedScorer, ids, texts, batch_size, workers):
+    """Time end-to-end scoring of all the texts, in batches, with a pool of worker processes."""
+    global _scorer
+    _scorer = scorer
+    batches = [(list(batch_ids), list(batch_texts))
+               for batch_ids, batch_texts in zip(chunked(ids, batch_size), chunked(texts, batch_size))]
+
+    def run():
+        if workers == 1:
+            return sum(map(_score, batches))
+        with mp.get_context('fork').Pool(workers) as pool:
+            return sum(pool.map(_score, batches, chunksize=1))
 
-from fos.model import FieldModel  # noqa
-from fos.util import iter_bq_extract
+    suite.measure('end_to_end', run, docs=len(texts), batch_size=batch_size, workers=workers)
 
 
-def main():
-    print(timeit.timeit('embed(fields)', setup='fields = FieldModel("en")', globals=globals(), number=10))
+def bench_imports(suite: BenchmarkSuite, import_budget: float) -> List[str]:
+    """Time importing the core scoring modules, returning any problems with them."""
+    results = [suite.measure_import(module) for module in CORE_MODULES]
+    return check_imports(results, import_budget)
 
 
-def embed(fields, lang='en', limit=1000):
-    i = 0
-    start_time = timeit.default_timer()
-    with open('stream.json', 'wt') as f:
-        for record in iter_bq_extract(f'{lang}_'):
-            embedding = fields.embed(record['text'])
-            similarity = fields.score(embedding)
-            avg_sim_values = zip_longest(fields.index, similarity.average().astype(float))
-            f.write(json.dumps({'merged_id': record['merged_id'],
-                                'fields': [{'id': k, 'score': v} for k, v in avg_sim_values]}) + '\n')
-            i += 1
-            if i == limit:
-                break
-    stop_time = timeit.default_timer()
-    elapsed = round(stop_time - start_time, 1)
-    print(f'{limit} docs in {elapsed}s')
+def run_benchmarks(output_path, batch_sizes=(1_000, 10_000), workers=(1,), n_docs=None, bundle=None, repeat=3,
+                   corpus_dir=CORPUS_DIR, input_format='jsonl', import_budget=1.0, fasttext_table=None) -> List[str]:
+    if n_docs is None:
+        n_docs = max(batch_sizes) * max(workers)
+    suite = BenchmarkSuite(repeat=repeat, settings={
+        'batch_sizes': list(batch_sizes), 'workers': list(workers), 'docs': n_docs, 'bundle': str(bundle),
+        'corpus_dir': str(corpus_dir), 'input_format': input_format, 'import_budget': import_budget,
+        'fasttext_table': str(fasttext_table),
+    })
+    problems = bench_imports(suite, import_budget)
+    model = suite.measure('load_model', lambda: FieldModel(bundle=bundle), docs=0, repeat=1)
+    fasttext_engine = None
+    if fasttext_table is not None:
+        fasttext_engine = suite.measure('load_fasttext_table',
+                                        lambda: FastTextEngine.from_table(fasttext_table, fasttext=model.fasttext),
+                                        docs=0, repeat=1)
+    scorer = suite.measure('load_scorer', lambda: ConstrainedScorer(model, fasttext_engine=fasttext_engine), docs=0,
+                           repeat=1)
+    ids, texts = suite.measure('read', lambda: read_texts(n_docs, corpus_dir, input_format), docs=n_docs, repeat=1)
+    for batch_size in batch_sizes:
+        bench_stages(suite, scorer, ids, texts, batch_size)
+    for n_workers in workers:
+        for batch_size in batch_sizes:
+            bench_workers(suite, scorer, ids, texts, batch_size, n_workers)
+    suite.save(output_path)
+    print(f'Wrote {output_path}')
+    return problems
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--profile', action='store_true')
+    parser = argparse.ArgumentParser(description='Benchmark the stages of scoring')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--output', type=Path, default=Path('benchmark.json'), help='Results path')
+    run_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1_000, 10_000], help='Batch sizes')
+    run_parser.add_argument('--workers', type=int, nargs='+', default=[1], help='Worker counts for end-to-end runs')
+    run_parser.add_argument('--docs', type=int, help='Docs to read (default: the largest batch size x workers)')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Runs of each stage; the fastest is recorded')
+    run_parser.add_argument('--bundle', type=Path, help='Load assets from this compiled bundle directory')
+    run_parser.add_argument('--corpus-dir', type=Path, default=CORPUS_DIR, help='Directory of the corpus extract')
+    run_parser.add_argument('--input-format', choices=('jsonl', 'parquet'), default='jsonl',
+                            help='Format of the corpus extract')
+    run_parser.add_argument('--fasttext-table', type=Path,
+                            help='Also time FastText embedding from this word vector table')
+    run_parser.add_argument('--import-budget', type=float, default=1.0,
+                            help='Fail if importing a core scoring module takes longer than this many seconds')
+    imports_parser = subparsers.add_parser('imports', help='Check import times of the core scoring modules')
+    imports_parser.add_argument('--import-budget', type=float, default=1.0,
+                                help='Fail if importing a core scoring module takes longer than this many seconds')
+    imports_parser.add_argument('--repeat', type=int, default=3, help='Runs of each import; the fastest is recorded')
+    imports_parser.add_argument('--output', type=Path, help='Results path')
+    compare_parser = subparsers.add_parser('compare', help='Compare results against a baseline')
+    compare_parser.add_argument('baseline', type=Path, help='Baseline results')
+    compare_parser.add_argument('current', type=Path, help='Current results')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Flag stages whose throughput fell by more than this share')
     args = parser.parse_args()
-    if args.profile:
-        fields = FieldModel("en")
-        embed(fields)
+    if args.command in ('run', 'imports'):
+        if args.command == 'run':
+            import_problems = run_benchmarks(args.output, batch_sizes=args.batch_sizes, workers=args.workers,
+                                             n_docs=args.docs, bundle=args.bundle, repeat=args.repeat,
+                                             corpus_dir=args.corpus_dir, input_format=args.input_format,
+                                             import_budget=args.import_budget, fasttext_table=args.fasttext_table)
+        else:
+            import_suite = BenchmarkSuite(repeat=args.repeat, settings={'import_budget': args.import_budget})
+            import_problems = bench_imports(import_suite, args.import_budget)
+            if args.output is not None:
+                import_suite.save(args.output)
+        if import_problems:
+            sys.exit('Import check failed:\n' + '\n'.join(import_problems))
     else:
-        main()
+        rows = compare(load_results(args.baseline), load_results(args.current), threshold=args.threshold)
+        print(format_comparison(rows))
+        regressed = [row for row in rows if row['regressed']]
+        if regressed:
+            sys.exit(f'{len(regressed)} regression(s) against {args.baseline}')
@@ -0,0 +1,18 @@
+"""
+Build a memory-mappable table of the FastText model's normalized word vectors, for batch sentence embedding (see
+``fos.wordvectors``).
+"""
+import argparse
+from pathlib import Path
+
+from fos.wordvectors import build_word_table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a table of FastText word vectors')
+    parser.add_argument('lang', choices=('en',), help='Language')
+    parser.add_argument('--output', type=Path, help='Table directory (default: assets/{lang}_fasttext_table)')
+    parser.add_argument('--max-words', type=int, help='Include only this many of the most frequent words')
+    args = parser.parse_args()
+    output_dir = build_word_table(lang=args.lang, output_dir=args.output, max_words=args.max_words)
+    print(f'Wrote word vector table to {output_dir}')
@@ -0,0 +1,129 @@
+"""
+Build a compact variant of the FastText model, and check its field scores against the full model's.
+
+Loading the full FastText model dominates startup time and the memory of each worker. A compact variant (see
+``fos.wordvectors``) holds the normalized vectors of just the words in our corpus, quantized to int8 by default, and
+``FieldModel(fasttext_table=...)`` or ``batch_score_corpus_constrained.py --compact-fasttext`` loads it instead of the
+model. FastText's own quantization (``.ftz``) only supports supervised models, and ours is unsupervised, so we prune
+and quantize a table of its word vectors instead.
+
+After building the variant, we score a sample of the corpus against every field with both the full model and the
+variant, and report the agreement of their top-1 and top-3 fields per level and the max absolute score difference.
+We exit with an error if top-1 agreement in any level is below ``--min-top1``.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime as dt
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, List
+
+import numpy as np
+from more_itertools import chunked
+
+from fos.model import FieldModel
+from fos.settings import ASSETS_DIR, CORPUS_DIR, EN_FASTTEXT_PATH
+from fos.topk import field_agreement
+from fos.util import iter_bq_batches
+from fos.vectors import ScoringKernel
+from fos.wordvectors import TABLE_DTYPES, FastTextEngine, build_word_table, corpus_vocab
+from scripts.batch_score_corpus_constrained import ConstrainedScorer, batch_entities, batch_fasttext
+
+
+def iter_texts(n_docs=0, corpus_dir=CORPUS_DIR, extract_format='jsonl') -> Iterator[str]:
+    """Iterate over the first n_docs texts of a corpus extract, or all of them if n_docs is zero."""
+    texts = (text for _, batch_texts in iter_bq_batches('en_', corpus_dir, extract_format=extract_format)
+             for text in batch_texts)
+    return islice(texts, n_docs or None)
+
+
+def dir_size_mb(path: Path) -> float:
+    """Get the total size of the files in a directory, in MB."""
+    return sum(os.path.getsize(file) for file in path.iterdir() if file.is_file()) / 1024 ** 2
+
+
+def score_agreement(scorer: ConstrainedScorer, compact: FastTextEngine, texts: List[str], k=3,
+                    batch_size=10_000) -> dict:
+    """Score texts against every field with the scorer's FastText model and with a compact variant, and compare."""
+    kernel = ScoringKernel(scorer.field_fasttext, scorer.field_tfidf, scorer.field_entities)
+    scores = np.empty((len(texts), kernel.n_fields), dtype=np.float32)
+    compact_scores = np.empty_like(scores)
+    for start, batch in zip(range(0, len(texts), batch_size), chunked(texts, batch_size)):
+        stop = start + len(batch)
+        dtm = scorer.tfidf_engine.embed(batch)
+        ent = batch_entities(scorer.entity_trie, scorer.entity_vectors, batch)
+        kernel.score(batch_fasttext(scorer.model.fasttext, batch), dtm, ent, out=scores[start:stop])
+        kernel.score(batch_fasttext(compact, batch), dtm, ent, out=compact_scores[start:stop])
+    return field_agreement(scores, compact_scores, scorer.levels, k)
+
+
+def main(output_dir=None, vocab_docs=0, min_count=1, max_words=None, dtype='int8', sample=10_000, bundle=None,
+         corpus_dir=CORPUS_DIR, input_format='jsonl', report_path=None, min_top1=0.95) -> dict:
+    if output_dir is None:
+        output_dir = ASSETS_DIR / 'en_fasttext_compact'
+    output_dir = Path(output_dir)
+    # The rest of the model loads now, and the full FastText model when we first use it, so we can time it
+    model = FieldModel(bundle=bundle, lazy=True)
+    scorer = ConstrainedScorer(model)
+    start_time = timeit.default_timer()
+    fasttext = model.fasttext
+    full_load_seconds = timeit.default_timer() - start_time
+
+    print(f'[{dt.now().isoformat()}] Counting words in {f"{vocab_docs:,}" if vocab_docs else "all"} docs')
+    words = corpus_vocab(iter_texts(vocab_docs, corpus_dir, input_format), min_count=min_count, max_words=max_words)
+    print(f'[{dt.now().isoformat()}] Building a table of {len(words):,} words in {output_dir}')
+    build_word_table(output_dir=output_dir, model=fasttext, words=words, dtype=dtype)
+    start_time = timeit.default_timer()
+    compact = FastTextEngine.from_table(output_dir)
+    compact_load_seconds = timeit.default_timer() - start_time
+
+    print(f'[{dt.now().isoformat()}] Comparing field scores on {sample:,} docs')
+    texts = list(iter_texts(sample, corpus_dir, input_format))
+    report = {
+        'variant': str(output_dir),
+        'words': len(words),
+        'dtype': dtype,
+        'size_mb': {'full': os.path.getsize(EN_FASTTEXT_PATH) / 1024 ** 2, 'compact': dir_size_mb(output_dir)},
+        'load_seconds': {'full': full_load_seconds, 'compact': compact_load_seconds},
+        'agreement': score_agreement(scorer, compact, texts),
+    }
+    if report_path is not None:
+        with open(report_path, 'wt') as f:
+            json.dump(report, f, indent=2)
+
+    print(f"Size: {report['size_mb']['compact']:,.0f} MB (full model: {report['size_mb']['full']:,.0f} MB); "
+          f"load: {compact_load_seconds:.2f}s (full model: {full_load_seconds:.2f}s)")
+    agreement = report['agreement']
+    print(f"Max absolute score difference: {agreement['max_abs_diff']:.4f}")
+    for level, level_agreement in agreement['levels'].items():
+        print(f"L{level}: top-1 {level_agreement['top1']:.1%}, top-3 {level_agreement['top3']:.1%}, "
+              f"max difference {level_agreement['max_abs_diff']:.4f}")
+    failed = [level for level, level_agreement in agreement['levels'].items() if level_agreement['top1'] < min_top1]
+    if failed:
+        sys.exit(f'Top-1 agreement is below {min_top1:.0%} in levels {failed}')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a compact variant of the FastText model')
+    parser.add_argument('--output', type=Path, help='Variant directory (default: assets/en_fasttext_compact)')
+    parser.add_argument('--vocab-docs', type=int, default=0,
+                        help='Keep the words in this many docs of the corpus extract (default: all of them)')
+    parser.add_argument('--min-count', type=int, default=1, help='Keep words that appear at least this many times')
+    parser.add_argument('--max-words', type=int, help='Keep at most this many of the most frequent words')
+    parser.add_argument('--dtype', choices=TABLE_DTYPES, default='int8', help='Data type of the word vectors')
+    parser.add_argument('--sample', type=int, default=10_000, help='Docs on which to compare field scores')
+    parser.add_argument('--bundle', type=Path, help='Load the other assets from this compiled bundle directory')
+    parser.add_argument('--corpus-dir', type=Path, default=CORPUS_DIR, help='Directory of the corpus extract')
+    parser.add_argument('--input-format', choices=('jsonl', 'parquet'), default='jsonl',
+                        help='Format of the corpus extract')
+    parser.add_argument('--report', type=Path, help='Write the agreement report to this JSON file')
+    parser.add_argument('--min-top1', type=float, default=0.95,
+                        help='Fail if top-1 agreement in any level is below this share')
+    args = parser.parse_args()
+    main(output_dir=args.output, vocab_docs=args.vocab_docs, min_count=args.min_count, max_words=args.max_words,
+         dtype=args.dtype, sample=args.sample, bundle=args.bundle, corpus_dir=args.corpus_dir,
+         input_format=args.input_format, report_path=args.report, min_top1=args.min_top1)
@@ -0,0 +1,16 @@
+"""
+Compile the pickled field model assets into a memory-mappable bundle (see ``fos.bundle``).
+"""
+import argparse
+from pathlib import Path
+
+from fos.bundle import compile_bundle
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile field model assets into a bundle')
+    parser.add_argument('lang', choices=('en',), help='Language')
+    parser.add_argument('--output', type=Path, help='Bundle directory (default: assets/{lang}_bundle)')
+    args = parser.parse_args()
+    output_dir = compile_bundle(lang=args.lang, output_dir=args.output)
+    print(f'Wrote bundle to {output_dir}')
@@ -1,5 +1,8 @@
 """
 Create an entity keyword trie for fast entity-mention search, from the LanguageSimilarity's EntityMatcher.json asset.
+
+With ``--index``, also write the entities as an automaton of entity IDs, with the entity vectors as one ``.npy`` array
+(see ``fos.entity.write_entity_index()``), which loads much faster.
 """
 import argparse
 import pickle
@@ -8,11 +11,11 @@ import numpy as np
 
 from ahocorasick import Automaton
 
-from fos.entity import read_trie
+from fos.entity import read_trie, write_entity_index, index_entities, mag_entity
 from fos.settings import ASSETS_DIR
 
 
-def main(entity_path, output_path):
+def main(entity_path, output_path, index_path=None):
     trie = Automaton()
     # add entity string keys and corresponding values to the trie ...
     for k, v in read_trie(entity_path):
@@ -24,11 +27,15 @@ def main(entity_path, output_path):
     # write to disk
     with open(output_path, 'wb') as f:
         pickle.dump(trie, f)
+    if index_path is not None:
+        write_entity_index(*index_entities(trie, unpack=mag_entity), index_path)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('entity_path', type=Path)
     parser.add_argument('output_path', type=Path)
+    parser.add_argument('--index', type=Path,
+                        help='Also write an entity ID automaton to this path, with entity vectors and names alongside')
     args = parser.parse_args()
-    main(args.entity_path, args.output_path)
+    main(args.entity_path, args.output_path, args.index)
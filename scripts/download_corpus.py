@@ -6,6 +6,7 @@ import os
 from pathlib import Path
 
 from fos.corpus import CORPUS_DIR, download
+from fos.gcp import EXTRACT_FORMATS
 
 if Path.cwd().name == 'scripts':
     os.chdir('..')
@@ -21,7 +22,11 @@ if __name__ == '__main__':
     parser.add_argument('--extract_bucket', type=str, default='fields-of-study', help='Bucket in GCS where exported jsonl should be written')
     parser.add_argument('--extract_prefix', type=str,
                         help='GCS prefix where exported jsonl should be written within `extract_bucket`')
+    parser.add_argument('--format', choices=tuple(EXTRACT_FORMATS), default='jsonl',
+                        help='Extract as gzipped JSONL or as Parquet')
+    parser.add_argument('--raw-text', action='store_true',
+                        help='Extract raw titles and abstracts, for batch_score_corpus_constrained.py --raw-text')
     args = parser.parse_args()
     download(lang=args.lang, output_dir=args.output, limit=args.limit, skip_prev=args.skip_prev,
              use_default_clients=args.use_default_clients, bq_dest=args.bq_dest, extract_bucket=args.extract_bucket,
-             extract_prefix=args.extract_prefix)
+             extract_prefix=args.extract_prefix, extract_format=args.format, raw_text=args.raw_text)
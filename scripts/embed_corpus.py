@@ -8,7 +8,8 @@ For each input doc:
 - Entity-embed
 - Tfidf-embed -> probably need cython for speed
 
-Output: all three embeddings. (Desirable because embedding the corpus is presumably expensive?)
+Output: all three embeddings, as JSONL or in a binary embedding store. (Desirable because embedding the corpus is
+presumably expensive?)
 
 For each field L0-L1 + candidate fields:
 - Calculate similarity
@@ -24,14 +25,23 @@ from fos.settings import CORPUS_DIR
 from fos.util import iter_bq_extract
 
 
-def main(lang="en", limit=0):
-    fields = FieldModel(lang)
+def main(lang="en", limit=0, output_format='jsonl'):
+    # Embedding needs only the publication embedding models, not the field embeddings
+    fields = FieldModel(lang, components={'fasttext', 'tfidf', 'entities'})
     start_time = timeit.default_timer()
     i = 0
-    with open(CORPUS_DIR / 'en_embeddings.jsonl', 'wt') as f:
+    if output_format == 'jsonl':
+        output = open(CORPUS_DIR / 'en_embeddings.jsonl', 'wt')
+    else:
+        # Write a binary embedding store (see fos.store)
+        output = fields.store_writer(CORPUS_DIR / 'en_embeddings')
+    with output:
         for record in iter_bq_extract(f'{lang}_'):
             embedding = fields.embed(record['text'])
-            embedding.dump_jsonl(f, merged_id=record['merged_id'])
+            if output_format == 'jsonl':
+                embedding.dump_jsonl(output, merged_id=record['merged_id'])
+            else:
+                embedding.dump_store(output, merged_id=record['merged_id'])
             i += 1
             if i == limit:
                 break
@@ -42,5 +52,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Embed merged corpus text')
     parser.add_argument('lang', choices=('en',), help='Language')
     parser.add_argument('--limit', type=int, default=0, help='Record limit')
+    parser.add_argument('--format', choices=('jsonl', 'store'), default='jsonl',
+                        help="Write embeddings as JSONL, or to an embedding store in 'assets/corpus/en_embeddings'")
     args = parser.parse_args()
-    main(lang=args.lang, limit=args.limit)
+    main(lang=args.lang, limit=args.limit, output_format=args.format)
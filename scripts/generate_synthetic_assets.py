@@ -0,0 +1,25 @@
+"""
+Generate synthetic model assets and a corpus for offline benchmarking and tests (see ``fos.synthetic``).
+"""
+import argparse
+from pathlib import Path
+
+from fos.synthetic import generate_assets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic model assets and corpus')
+    parser.add_argument('output', type=Path, help='Output directory; use it with FOS_ASSETS_DIR')
+    parser.add_argument('--docs', type=int, default=10_000, help='Number of abstracts in the corpus')
+    parser.add_argument('--shards', type=int, default=4, help='Number of corpus extract shards')
+    parser.add_argument('--vocab-size', type=int, default=20_000, help='Number of generated words')
+    parser.add_argument('--doc-length', type=int, default=150, help='Mean abstract length in words')
+    parser.add_argument('--format', choices=('jsonl', 'parquet'), default='jsonl', help='Corpus extract format')
+    parser.add_argument('--epoch', type=int, default=1, help='FastText training epochs')
+    parser.add_argument('--bucket', type=int, default=20_000, help='FastText subword buckets')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    output_dir = generate_assets(args.output, n_docs=args.docs, n_shards=args.shards, vocab_size=args.vocab_size,
+                                 doc_length=args.doc_length, extract_format=args.format, epoch=args.epoch,
+                                 bucket=args.bucket, seed=args.seed)
+    print(f'Wrote synthetic assets to {output_dir}')
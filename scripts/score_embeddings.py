@@ -1,27 +1,78 @@
 """
 Calculate field scores for merged corpus embeddings.
+
+With ``--batch``, we score large blocks of embeddings at once with the matrix kernel the batch scorers use, loading only
+the field embeddings (not the FastText or tf-idf models). Scores are plain averages of the three similarities, as from
+``FieldModel.score()``.
 """
 import json
 import timeit
 import argparse
+from datetime import datetime as dt
 from itertools import zip_longest
 
 from fos.model import FieldModel, Embedding
 from fos.settings import CORPUS_DIR
+from fos.store import EmbeddingStore, read_embedding_batches
+from fos.vectors import load_field_fasttext, load_field_tfidf, load_field_entities, load_field_keys, ScoringKernel
+
+
+def read_jsonl_embeddings(path):
+    """Read (merged ID, Embedding) pairs from JSONL."""
+    with open(path, 'rt') as f:
+        for line in f:
+            record = json.loads(line)
+            yield record['merged_id'], Embedding(fasttext=record['fasttext'], tfidf=record['tfidf'],
+                                                 entity=record['entity'])
 
 
-def main(lang="en", digits=6, limit=0):
-    fields = FieldModel(lang)
+def read_store_embeddings(path):
+    """Read (merged ID, Embedding) pairs from an embedding store."""
+    for merged_id, fasttext, tfidf, entity in EmbeddingStore(path).iter_rows():
+        yield merged_id, Embedding(fasttext=fasttext, tfidf=tfidf, entity=entity)
+
+
+def score_batches(lang="en", digits=6, limit=0, input_format='jsonl', batch_size=100_000):
+    """Score embeddings in blocks, writing the same output as ``main()``."""
+    field_fasttext = load_field_fasttext(lang)
+    field_tfidf = load_field_tfidf(lang)
+    field_entities = load_field_entities(lang)
+    index = load_field_keys(lang)
+    kernel = ScoringKernel(field_fasttext.index, field_tfidf.index, field_entities.index, keep_all=True)
+    print(f'[{dt.now().isoformat()}] Loaded {len(index):,} fields')
+
     start_time = timeit.default_timer()
+    batches = read_embedding_batches(lang, input_format, field_tfidf.index.shape[1], batch_size)
     i = 0
-    with open(CORPUS_DIR / f'{lang}_embeddings.jsonl', 'rt') as fin, \
-            open(CORPUS_DIR / f'{lang}_scores.jsonl', 'wt') as fout:
-        for line in fin:
-            record = json.loads(line)
-            embedding = Embedding(fasttext=record['fasttext'], tfidf=record['tfidf'], entity=record['entity'])
+    with open(CORPUS_DIR / f'{lang}_scores.jsonl', 'wt') as fout:
+        for ids, ft, dtm, ent in batches:
+            if limit:
+                ids = ids[:limit - i]
+            scores = kernel.score(ft[:len(ids)], dtm[:len(ids)], ent[:len(ids)])
+            for merged_id, row in zip(ids, scores.astype(float).tolist()):
+                avg_sim = {k: round(v, digits) for k, v in zip(index, row)}
+                fout.write(json.dumps({'merged_id': merged_id, **avg_sim}) + '\n')
+            i += len(ids)
+            print(f'[{dt.now().isoformat()}] Scored {i:,} documents')
+            if i == limit:
+                break
+    print(round(timeit.default_timer() - start_time))
+
+
+def main(lang="en", digits=6, limit=0, input_format='jsonl'):
+    # Scoring stored embeddings needs only the field embeddings
+    fields = FieldModel(lang, components={'field_matrices'})
+    start_time = timeit.default_timer()
+    i = 0
+    if input_format == 'jsonl':
+        embeddings = read_jsonl_embeddings(CORPUS_DIR / f'{lang}_embeddings.jsonl')
+    else:
+        embeddings = read_store_embeddings(CORPUS_DIR / f'{lang}_embeddings')
+    with open(CORPUS_DIR / f'{lang}_scores.jsonl', 'wt') as fout:
+        for merged_id, embedding in embeddings:
             sim = fields.score(embedding)
             avg_sim = {k: round(v, digits) for k, v in zip_longest(fields.index, sim.average().astype(float))}
-            fout.write(json.dumps({'merged_id': record['merged_id'], **avg_sim}) + '\n')
+            fout.write(json.dumps({'merged_id': merged_id, **avg_sim}) + '\n')
             i += 1
             if i == limit:
                 break
@@ -32,5 +83,16 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Score merged corpus text')
     parser.add_argument('lang', choices=('en', 'zh'), help='Language')
     parser.add_argument('--digits', type=int, default=6, help='Float precision when serializing')
+    parser.add_argument('--format', choices=('jsonl', 'store'), default='jsonl',
+                        help='Read embeddings from JSONL or from a binary embedding store (see embed_corpus.py)')
+    parser.add_argument('--batch', action='store_true',
+                        help='Score blocks of embeddings at once, loading only the field embeddings')
+    parser.add_argument('--batch-size', type=int, default=100_000,
+                        help='Block size when reading JSONL with --batch (stores are read a shard at a time)')
+    parser.add_argument('--limit', type=int, default=0, help='Stop after scoring this many documents')
     args = parser.parse_args()
-    main(lang=args.lang, digits=args.digits)
+    if args.batch:
+        score_batches(lang=args.lang, digits=args.digits, limit=args.limit, input_format=args.format,
+                      batch_size=args.batch_size)
+    else:
+        main(lang=args.lang, digits=args.digits, limit=args.limit, input_format=args.format)
@@ -0,0 +1,140 @@
+"""
+Score publications against a few new or revised fields, from stored publication embeddings.
+
+When we add or revise fields in ``assets/fields/field_meta.jsonl`` (and update the field embeddings), rescoring every
+publication against every field is wasteful. Here we compute only the score columns of the named fields, reading the
+publication embeddings written by ``embed_corpus.py``, and write them as a patch: JSONL records of a ``merged_id`` and a
+score for each field, keyed by field ID as in the ``score_embeddings.py`` output. Scores are plain averages of the three
+similarities, as from ``score_embeddings.py``.
+
+L2/L3 fields are scored only for the publications eligible for them given their top three L0 and L1 fields (see
+``fos.constraints``), and their scores are null otherwise. If the changed fields include L0/L1 fields, eligibility for
+other L2/L3 fields may change too, which a patch doesn't capture.
+
+Merge a patch into the prior output with ``--merge``, which replaces the patched columns by ``merged_id``. Only
+``score_embeddings.py`` output, with a score for every field, can be patched. The top fields per level from
+``batch_score_corpus_constrained.py`` can't: a revised field may leave a publication's top fields, and the output
+doesn't have the score of the field that would replace it.
+"""
+import argparse
+import timeit
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from fos.constraints import load_meta, load_constraints, check_constraints
+from fos.model import FieldModel
+from fos.output import JsonlScoreWriter, merge_score_patch, score_patch_records
+from fos.settings import CORPUS_DIR
+from fos.store import read_embedding_batches
+from fos.topk import top_k_by_level
+from fos.vectors import ScoringKernel
+
+
+class ColumnScorer:
+
+    def __init__(self, model: FieldModel, levels: np.ndarray, columns: Sequence[int],
+                 constraints: Optional[Dict[Tuple[int, int], List[int]]] = None):
+        """Score batches of publication embeddings against a subset of fields.
+
+        :param model: A FieldModel, which needs only its field embeddings (the 'field_matrices' component).
+        :param levels: Level of each of the F fields.
+        :param columns: Indexes of the C fields to score.
+        :param constraints: Constraints, as from ``load_constraints()``. If given, L2/L3 fields are only scored for
+            eligible publications.
+        """
+        field_fasttext = model.field_fasttext.index
+        field_tfidf = model.field_tfidf.index
+        field_entities = model.field_entities.index
+        self.columns = np.asarray(columns)
+        self.kernel = ScoringKernel(field_fasttext[self.columns], field_tfidf[self.columns],
+                                    field_entities[self.columns], keep_all=True)
+        self.constrained = constraints is not None and bool((levels[self.columns] >= 2).any())
+        if self.constrained:
+            # Eligibility depends on the top L0/L1 fields, as scored by ConstrainedScorer
+            l0l1 = levels <= 1
+            self.l0l1_levels = levels[l0l1]
+            self.l0l1_kernel = ScoringKernel(field_fasttext[l0l1], field_tfidf[l0l1], field_entities[l0l1])
+            self.constraint_l0 = np.array([l0 for l0, _ in constraints])
+            self.constraint_l1 = np.array([l1 for _, l1 in constraints])
+            # G x C, true where a column is a descendant of a constraint's L0 and L1
+            self.descendants = np.array([np.isin(self.columns, descendants) for descendants in constraints.values()])
+            self.unconstrained = levels[self.columns] < 2
+
+    def eligible(self, ft, dtm, ent) -> np.ndarray:
+        """Find the columns for which each publication in a batch is eligible, as an N x C boolean array."""
+        top = top_k_by_level(self.l0l1_kernel.score(ft, dtm, ent), self.l0l1_levels, 3)
+        eligible = check_constraints(top[0][0], top[1][0], self.constraint_l0, self.constraint_l1)
+        return (eligible.astype(np.int32) @ self.descendants.astype(np.int32) > 0) | self.unconstrained
+
+    def score(self, ft, dtm, ent) -> np.ndarray:
+        """Score a batch of publication embeddings, returning an N x C array of scores, NaN where ineligible."""
+        scores = self.kernel.score(ft, dtm, ent, out=np.empty((len(ft), len(self.columns)), dtype=np.float32))
+        if self.constrained:
+            scores[~self.eligible(ft, dtm, ent)] = np.nan
+        return scores
+
+
+def main(fields: Sequence[str], lang="en", digits=6, limit=0, input_format='store', output_path=None,
+         batch_size=100_000, constrained=True, bundle=None):
+    if output_path is None:
+        output_path = CORPUS_DIR / f'{lang}_scores.patch.jsonl'
+    # Scoring stored embeddings needs only the field embeddings
+    model = FieldModel(lang, bundle=bundle, components={'field_matrices'})
+    meta = load_meta()
+    keys = model.index
+    assert len(keys) == len(meta), (len(keys), len(meta))
+    names = meta['name'].tolist()
+    unknown = [name for name in fields if name not in names]
+    if unknown:
+        raise ValueError(f'Unknown fields: {unknown}')
+    columns = [names.index(name) for name in fields]
+    column_keys = [keys[column] for column in columns]
+
+    scorer = ColumnScorer(model, meta['level'].to_numpy(), columns,
+                          constraints=load_constraints() if constrained else None)
+    print(f'[{dt.now().isoformat()}] Scoring {len(columns):,} fields: {", ".join(fields)}')
+
+    start_time = timeit.default_timer()
+    batches = read_embedding_batches(lang, input_format, model.field_tfidf.index.shape[1], batch_size)
+    i = 0
+    with JsonlScoreWriter(output_path) as writer:
+        for ids, ft, dtm, ent in batches:
+            if limit:
+                ids = ids[:limit - i]
+            scores = scorer.score(ft[:len(ids)], dtm[:len(ids)], ent[:len(ids)])
+            i += writer.write(score_patch_records(ids, scores, column_keys, digits))
+            print(f'[{dt.now().isoformat()}] Scored {i:,} documents')
+            if i == limit:
+                break
+    print(round(timeit.default_timer() - start_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score stored publication embeddings against new or revised fields')
+    parser.add_argument('lang', choices=('en',), help='Language')
+    parser.add_argument('fields', nargs='*', help='Names of the new or revised fields, as in field_meta.jsonl')
+    parser.add_argument('--digits', type=int, default=6, help='Float precision when serializing')
+    parser.add_argument('--format', choices=('jsonl', 'store'), default='store',
+                        help='Read embeddings from JSONL or from a binary embedding store (see embed_corpus.py)')
+    parser.add_argument('--batch-size', type=int, default=100_000,
+                        help='Block size when reading JSONL (stores are read a shard at a time)')
+    parser.add_argument('--limit', type=int, default=0, help='Stop after scoring this many documents')
+    parser.add_argument('--output', type=Path, help='Patch path (default: assets/corpus/{lang}_scores.patch.jsonl)')
+    parser.add_argument('--bundle', type=Path, help='Load field embeddings from this compiled bundle directory')
+    parser.add_argument('--unconstrained', action='store_true',
+                        help='Score L2/L3 fields for every publication, ignoring the L0/L1 constraints')
+    parser.add_argument('--merge', nargs=3, type=Path, metavar=('SCORES', 'PATCH', 'OUTPUT'),
+                        help='Instead of scoring, merge a patch into prior score_embeddings.py output')
+    args = parser.parse_args()
+    if args.merge:
+        n = merge_score_patch(*args.merge)
+        print(f'[{dt.now().isoformat()}] Patched {n:,} documents')
+    else:
+        if not args.fields:
+            parser.error('Name at least one field to score')
+        main(args.fields, lang=args.lang, digits=args.digits, limit=args.limit, input_format=args.format,
+             output_path=args.output, batch_size=args.batch_size, constrained=not args.unconstrained,
+             bundle=args.bundle)
@@ -17,7 +17,7 @@ from fos.settings import EN_FIELD_FASTTEXT_PATH
 
 def main():
     for lang in ["en"]:
-        model = FieldModel(lang)
+        model = FieldModel(lang, components={'field_matrices'})
 
         norms = norm(model.field_fasttext.index, 2, axis=1)
         normalized_index = model.field_fasttext.index / norms[:, None]
@@ -11,6 +11,7 @@ import pytest
 
 from fos.model import FieldModel
 from fos.settings import ASSETS_DIR
+from fos.synthetic import generate_assets
 from fos.util import read_go_output, run
 
 TEST_ASSETS_DIR = Path(__file__).parent.absolute() / 'assets'
@@ -22,6 +23,13 @@ def en_model() -> FieldModel:
     return FieldModel("en")
 
 
+@pytest.fixture(scope='session')
+def synthetic_assets_dir(tmp_path_factory) -> Path:
+    """Generate small synthetic assets and corpus (see ``fos.synthetic``), which need no DVC or network access."""
+    return generate_assets(tmp_path_factory.mktemp('synthetic_assets'), n_docs=200, n_shards=2, vocab_size=2_000,
+                           bucket=2_000)
+
+
 @pytest.fixture
 def texts():
     """Load example texts."""
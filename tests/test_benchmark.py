@@ -0,0 +1,53 @@
+"""
+Test timing scoring stages and comparing benchmark results.
+"""
+from fos.benchmark import CORE_MODULES, BenchmarkSuite, check_imports, compare, import_time, load_results
+
+
+def test_benchmark_suite(tmp_path):
+    suite = BenchmarkSuite(repeat=2, settings={'docs': 100})
+    calls = []
+    assert suite.measure('stage', lambda: calls.append(1) or len(calls), docs=100, batch_size=10) == 2
+    assert len(calls) == 2
+    suite.measure('load', lambda: None, docs=0)
+    suite.save(tmp_path / 'results.json')
+
+    results = load_results(tmp_path / 'results.json')
+    assert results['settings'] == {'docs': 100}
+    stage, load = results['results']
+    assert (stage['stage'], stage['batch_size'], stage['workers'], stage['docs']) == ('stage', 10, 1, 100)
+    assert stage['docs_per_sec'] > 0 and stage['peak_rss_mb'] > 0
+    assert load['docs_per_sec'] is None
+
+
+def test_compare():
+    def result(stage, docs_per_sec, seconds=1.0, batch_size=10):
+        return {'stage': stage, 'batch_size': batch_size, 'workers': 1, 'docs': 10, 'seconds': seconds,
+                'docs_per_sec': docs_per_sec}
+
+    baseline = {'results': [result('fasttext', 100.0), result('tfidf', 100.0), result('load', None, seconds=2.0),
+                            result('topk', 100.0, batch_size=100)]}
+    current = {'results': [result('fasttext', 95.0), result('tfidf', 50.0), result('load', None, seconds=4.0),
+                           result('topk', 10.0)]}
+    rows = compare(baseline, current, threshold=0.1)
+    # Results are compared by stage, batch size and worker count
+    assert [(row['stage'], row['regressed']) for row in rows] == [('fasttext', False), ('tfidf', True),
+                                                                   ('load', True)]
+    assert rows[2]['ratio'] == 0.5
+
+
+def test_measure_import():
+    suite = BenchmarkSuite(repeat=1)
+    result = suite.measure_import('fos.pipeline')
+    assert result['stage'] == 'import fos.pipeline' and result['seconds'] > 0
+    assert result['heavy_modules'] == []
+    assert check_imports([result], budget=60.0) == []
+    assert check_imports([{**result, 'heavy_modules': ['gensim']}], budget=0.0) == [
+        f"import fos.pipeline took {result['seconds']:.3f}s (budget 0.000s)", 'import fos.pipeline imported gensim']
+
+
+def test_core_imports_are_light():
+    # Importing the scoring path shouldn't load FastText, gensim, scikit-learn or pandas until a model is loaded
+    for module in CORE_MODULES:
+        _, modules = import_time(module)
+        assert not {'fasttext', 'gensim', 'sklearn', 'pandas'} & set(modules), module
@@ -0,0 +1,54 @@
+"""
+Test that a compiled asset bundle loads the same assets as the pickles.
+"""
+import numpy as np
+import pytest
+
+from fos.bundle import compile_bundle, Bundle
+from fos.entity import load_entities, embed_entities
+from fos.vectors import load_field_fasttext, load_field_tfidf, load_field_entities, load_field_keys, load_tfidf, \
+    embed_tfidf
+
+
+@pytest.fixture(scope='module')
+def bundle(tmp_path_factory):
+    return Bundle(compile_bundle('en', tmp_path_factory.mktemp('bundle')))
+
+
+def is_memory_mapped(array: np.ndarray) -> bool:
+    # Some scipy versions wrap the arrays of a sparse matrix in views, so look for a memmap among their bases
+    while array is not None and not isinstance(array, np.memmap):
+        array = array.base
+    return array is not None
+
+
+def test_field_matrices(bundle):
+    assert np.array_equal(bundle.field_fasttext().index, load_field_fasttext().index)
+    assert np.array_equal(bundle.field_entities().index, load_field_entities().index)
+    assert (bundle.field_tfidf().index != load_field_tfidf().index).nnz == 0
+    assert bundle.field_keys() == load_field_keys()
+
+
+def test_memory_mapped(bundle):
+    assert is_memory_mapped(bundle.field_fasttext().index)
+    assert is_memory_mapped(bundle.field_tfidf().index.data)
+
+
+def test_tfidf(bundle, texts):
+    # The recreated tf-idf model and dictionary should give the same embeddings as the originals
+    tfidf, dictionary = load_tfidf()
+    bundle_tfidf, bundle_dictionary = bundle.tfidf()
+    for text in texts.values():
+        assert embed_tfidf(text.split(), bundle_tfidf, bundle_dictionary) == \
+               embed_tfidf(text.split(), tfidf, dictionary)
+
+
+def test_entities(bundle, texts):
+    entities = load_entities()
+    bundle_entities = bundle.entities()
+    for text in texts.values():
+        assert np.array_equal(embed_entities(text, bundle_entities), embed_entities(text, entities))
+
+
+def test_not_stale(bundle):
+    assert not bundle.is_stale()
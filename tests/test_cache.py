@@ -0,0 +1,111 @@
+"""
+Test caching publication embeddings by text hash.
+"""
+import os
+
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+import fos.cache
+from fos.bundle import MANIFEST
+from fos.cache import EmbeddingCache, asset_fingerprint, text_key
+
+N_TERMS = 5
+
+
+class CountingEmbedder:
+    """Embed texts trivially, recording which texts we embed."""
+
+    def __init__(self):
+        self.embedded = []
+
+    def __call__(self, texts):
+        self.embedded.extend(texts)
+        ft = np.array([[len(text), 1.0] for text in texts], dtype=np.float32)
+        dtm = csr_matrix(np.array([[len(text) % 2, 0, 0.5 * len(text), 0, 1 / 3] for text in texts]))
+        return ft, dtm, -ft
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(tmp_path / 'cache.db', fingerprint='a')
+
+
+def assert_embeddings_equal(actual, expected):
+    ft, dtm, ent = actual
+    expected_ft, expected_dtm, expected_ent = expected
+    assert np.array_equal(ft, expected_ft)
+    assert np.array_equal(ent, expected_ent)
+    assert np.array_equal(dtm.toarray(), expected_dtm.toarray())
+
+
+def test_cache_hits(cache):
+    embedder = CountingEmbedder()
+    texts = ['a', 'bb', '', 'ccc']
+    assert_embeddings_equal(cache.embed(texts, embedder, N_TERMS), CountingEmbedder()(texts))
+    assert cache.stats.misses == 4
+    assert len(cache) == 4
+
+    # Only new texts are embedded again, and the output is in input order
+    texts = ['ccc', 'dddd', 'a']
+    assert_embeddings_equal(cache.embed(texts, embedder, N_TERMS), CountingEmbedder()(texts))
+    assert embedder.embedded == ['a', 'bb', '', 'ccc', 'dddd']
+    assert cache.stats.hits == 2
+    assert cache.stats.misses == 5
+    assert cache.stats.hit_rate() == pytest.approx(2 / 7)
+
+
+def test_cache_fingerprint(tmp_path, cache):
+    cache.embed(['a', 'bb'], CountingEmbedder(), N_TERMS)
+    cache.close()
+    assert len(EmbeddingCache(tmp_path / 'cache.db', fingerprint='a')) == 2
+    # A different fingerprint means the embedding models changed, so the cache is cleared
+    assert len(EmbeddingCache(tmp_path / 'cache.db', fingerprint='b')) == 0
+
+
+def test_asset_fingerprint(tmp_path, monkeypatch):
+    # Rewriting the entity index or recompiling a bundle changes the fingerprint
+    index_path = tmp_path / 'entity_index.pkl'
+    monkeypatch.setattr(fos.cache, 'EN_ENTITY_INDEX_PATH', index_path)
+    fingerprint = asset_fingerprint()
+    index_path.write_bytes(b'index')
+    assert asset_fingerprint() != fingerprint
+    fingerprint = asset_fingerprint()
+    os.utime(index_path, (0, 0))
+    assert asset_fingerprint() != fingerprint
+
+    (tmp_path / MANIFEST).write_text('{}')
+    fingerprint = asset_fingerprint(bundle=tmp_path)
+    assert fingerprint != asset_fingerprint()
+    os.utime(tmp_path / MANIFEST, (0, 0))
+    assert asset_fingerprint(bundle=tmp_path) != fingerprint
+
+
+def test_cache_eviction(tmp_path):
+    cache = EmbeddingCache(tmp_path / 'cache.db', max_entries=2)
+    cache.embed(['a', 'bb', 'ccc'], CountingEmbedder(), N_TERMS)
+    cache.embed(['a'], CountingEmbedder(), N_TERMS)
+    # 'a' was used most recently, and then one of the others
+    assert cache.evict() == 1
+    assert len(cache) == 2
+    assert text_key('a') in cache.get_many([text_key('a')])
+
+    cache = EmbeddingCache(tmp_path / 'cache.db', max_age_days=0)
+    assert cache.evict() == 2
+    assert len(cache) == 0
+
+
+def test_field_model_cache(en_model, texts, tmp_path):
+    expected = [en_model.embed(text) for text in texts]
+    en_model.cache = EmbeddingCache(tmp_path / 'cache.db')
+    try:
+        for _ in range(2):
+            for text, embedding in zip(texts, expected):
+                cached = en_model.embed(text)
+                assert np.array_equal(cached.fasttext, embedding.fasttext)
+                assert np.array_equal(cached.entity, embedding.entity)
+                assert cached.tfidf == [(term_id, weight) for term_id, weight in embedding.tfidf]
+        assert en_model.cache.stats.hits >= len(texts)
+    finally:
+        en_model.cache = None
@@ -0,0 +1,109 @@
+"""
+Test checkpointing batch scoring runs.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from fos.checkpoint import Checkpoint, StopFlag, skip_records, until_stopped
+
+SCRIPT = Path(__file__).parent.parent / 'scripts/batch_score_corpus_constrained.py'
+
+
+def test_checkpoint_resume(tmp_path):
+    parts_dir = tmp_path / 'scores.jsonl.parts'
+    checkpoint = Checkpoint(parts_dir, {'output_format': 'jsonl'})
+    part = checkpoint.next_part('en_corpus-0.jsonl.gz', '.jsonl')
+    part.write_text('a\nb\n')
+    checkpoint.record('en_corpus-0.jsonl.gz', part, 2, complete=False)
+    # A part that was still open when the run stopped isn't recorded
+    checkpoint.next_part('en_corpus-1.jsonl.gz', '.jsonl').write_text('c\n')
+
+    resumed = Checkpoint(parts_dir, {'output_format': 'jsonl'}, resume=True)
+    assert resumed.count('en_corpus-0.jsonl.gz') == 2
+    assert not resumed.is_complete('en_corpus-0.jsonl.gz')
+    assert sorted(path.name for path in parts_dir.iterdir()) == ['en_corpus-0.jsonl.gz.000.jsonl', 'manifest.json']
+    part = resumed.next_part('en_corpus-0.jsonl.gz', '.jsonl')
+    assert part.name == 'en_corpus-0.jsonl.gz.001.jsonl'
+    part.write_text('c\n')
+    resumed.record('en_corpus-0.jsonl.gz', part, 1, complete=True)
+    assert resumed.is_complete('en_corpus-0.jsonl.gz')
+    assert resumed.total() == 3
+    assert [path.name for path in resumed.parts(['en_corpus-0.jsonl.gz', 'en_corpus-1.jsonl.gz'])] == \
+           ['en_corpus-0.jsonl.gz.000.jsonl', 'en_corpus-0.jsonl.gz.001.jsonl']
+
+    # Settings must match to resume
+    with pytest.raises(ValueError):
+        Checkpoint(parts_dir, {'output_format': 'parquet'}, resume=True)
+    # Without resume, we start over
+    assert Checkpoint(parts_dir, {'output_format': 'jsonl'}).total() == 0
+    assert [path.name for path in parts_dir.iterdir()] == []
+
+
+def test_skip_records():
+    batches = [(['a', 'b', 'c'], [1, 2, 3]), (['d', 'e'], [4, 5]), (['f'], [6])]
+    assert list(skip_records(batches, 0, size=lambda batch: len(batch[0]))) == batches
+    assert list(skip_records(batches, 4, size=lambda batch: len(batch[0]))) == [(['e'], [5]), (['f'], [6])]
+    assert list(skip_records(batches, 3, size=lambda batch: len(batch[0]))) == batches[1:]
+
+
+def test_stop_flag():
+    stop = StopFlag(signals=(signal.SIGUSR1,))
+    try:
+        assert not stop
+        output = []
+        for batch in until_stopped(range(10), stop):
+            output.append(batch)
+            if batch == 2:
+                os.kill(os.getpid(), signal.SIGUSR1)
+        # The batch in progress finishes, and no more start
+        assert output == [0, 1, 2]
+        assert stop
+    finally:
+        stop.restore()
+
+
+def read_ids(path):
+    with open(path, 'rt') as f:
+        return sorted(json.loads(line)['merged_id'] for line in f)
+
+
+def test_checkpoint_workers(synthetic_assets_dir, tmp_path):
+    env = {**os.environ, 'FOS_ASSETS_DIR': str(synthetic_assets_dir), 'PYTHONPATH': str(SCRIPT.parent.parent),
+           'PYTHONUNBUFFERED': '1'}
+    args = [sys.executable, str(SCRIPT), '--checkpoint', '--workers', '3', '--batch', '1', '--limit', '0']
+
+    # A run with workers finishes, and doesn't wait on them afterwards
+    subprocess.run(args + ['--output', str(tmp_path / 'scores.jsonl')], env=env, check=True, timeout=300,
+                   stdout=subprocess.DEVNULL)
+    assert len(read_ids(tmp_path / 'scores.jsonl')) == 200
+    assert not (tmp_path / 'scores.jsonl.parts').exists()
+
+    # Stop a run by signaling its process group, as a VM shutdown would. The workers ignore the signal and stop when
+    # the main process does
+    output_path = tmp_path / 'stopped.jsonl'
+    process = subprocess.Popen(args + ['--output', str(output_path)], env=env, stdout=subprocess.PIPE, text=True,
+                               start_new_session=True)
+    # Output is unbuffered, so we see the first batch as it's written
+    for line in process.stdout:
+        if 'Wrote' in line:
+            break
+    # Pause the group, so the signal arrives before the run can finish
+    os.killpg(process.pid, signal.SIGSTOP)
+    os.killpg(process.pid, signal.SIGTERM)
+    os.killpg(process.pid, signal.SIGCONT)
+    process.stdout.read()
+    assert process.wait(timeout=300) != 0
+    assert not output_path.exists()
+    with open(f'{output_path}.parts/manifest.json', 'rt') as f:
+        shards = json.load(f)['shards']
+    assert 0 < sum(part['count'] for shard in shards.values() for part in shard['parts']) < 200
+
+    subprocess.run(args + ['--output', str(output_path), '--resume'], env=env, check=True, timeout=300,
+                   stdout=subprocess.DEVNULL)
+    assert read_ids(output_path) == read_ids(tmp_path / 'scores.jsonl')
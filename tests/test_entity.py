@@ -1,10 +1,17 @@
 """
 Test that entity embeddings and the underlying entity trie work as expected.
 """
+import json
+import os
+
+import ahocorasick
 import numpy as np
 
-from fos.entity import load_entities, find_keywords, embed_entities, create_automaton
+from fos.entity import load_entities, find_keywords, embed_entities, create_automaton, index_entities, \
+    count_entities, batch_embed_entities, write_entity_index, read_entity_index, mag_entity
 from fos.settings import FASTTEXT_DIM
+from fos.vectors import row_norm
+from scripts.create_mag_entity_trie import main as create_mag_entity_trie
 
 
 def test_embed_entities():
@@ -33,7 +40,10 @@ def test_find_entities():
     entities = list(find_keywords('engineering management', trie))
     assert len(entities) == 1
     mention, (field_name, embedding) = entities[0]
-    assert field_name == 'Engineering management'
+    assert mention == 'engineering management'
+    # Synthetic assets (see fos.synthetic) name entities as in the field metadata, not as in Wikipedia
+    if 'FOS_ASSETS_DIR' not in os.environ:
+        assert field_name == 'Engineering management'
     assert isinstance(embedding, np.ndarray)
     assert embedding.shape == (FASTTEXT_DIM,)
     assert embedding.dtype in (np.dtype('float32'), np.dtype('float64'))
@@ -52,4 +62,78 @@ def test_create_automaton():
     trie = create_automaton(entities)
     assert 'a' in trie and 'b' in trie
     result = {k: v for _, (k, v) in trie.iter_long('ab')}
-    assert result == entities
\ No newline at end of file
+    assert result == entities
+
+
+def test_index_entities():
+    # The entity ID trie has the same keys, and each ID indexes the entity's name and vector
+    trie = load_entities()
+    id_trie, names, vectors = index_entities(trie)
+    assert len(id_trie) == len(trie) == len(names) == len(vectors)
+    key, (_, (name, vector)) = next(trie.items())
+    entity_id = id_trie.get(key)
+    assert names[entity_id] == name
+    assert np.array_equal(vectors[entity_id], vector)
+
+
+def test_index_mag_entities():
+    # MAG entity trie values are (entity, vector) tuples, of any dimension
+    trie = ahocorasick.Automaton()
+    for entity, vector in [('biology', [0.3, 0.4]), ('art', [0.1, 0.2])]:
+        trie.add_word(entity, (entity, np.array(vector, dtype=np.float32)))
+    trie.make_automaton()
+    id_trie, names, vectors = index_entities(trie, unpack=mag_entity)
+    assert vectors.dtype == np.float32 and vectors.shape == (2, 2)
+    assert names[id_trie.get('art')] == 'art'
+    assert np.allclose(vectors[id_trie.get('biology')], [0.3, 0.4])
+    # An empty trie has no vectors
+    assert index_entities(create_automaton({}))[2].shape == (0, FASTTEXT_DIM)
+
+
+def test_count_entities():
+    id_trie, names, vectors = index_entities(load_entities())
+    counts = count_entities(['engineering management and engineering management', '', 'engineering'], id_trie,
+                            len(names))
+    assert counts.shape == (3, len(names))
+    assert counts[0, id_trie.get('engineering management')] == 2
+    assert counts[1].nnz == 0
+    assert counts[2, id_trie.get('engineering')] == 1
+
+
+def test_batch_embed_entities(texts):
+    # Batch entity embeddings should be the same as embedding texts one at a time, up to float32 rounding
+    trie = load_entities()
+    id_trie, _, vectors = index_entities(trie)
+    texts = list(texts.values()) + ['']
+    expected = row_norm([embed_entities(text, trie) for text in texts])
+    assert np.allclose(batch_embed_entities(texts, id_trie, vectors), expected, atol=1e-6)
+
+
+def test_entity_index(texts, tmp_path):
+    # An entity ID trie written with its vectors reads back with the same entities, and embeds text the same way
+    trie = load_entities()
+    path = write_entity_index(*index_entities(trie), tmp_path / 'entity_index.pkl')
+    id_trie, names, vectors = read_entity_index(path)
+    assert isinstance(vectors, np.memmap)
+    assert vectors.dtype == np.float32 and vectors.shape == (len(trie), FASTTEXT_DIM)
+    assert len(id_trie) == len(names) == len(trie)
+    key, (_, (name, _)) = next(trie.items())
+    entity_id = id_trie.get(key)
+    assert names[entity_id] == name
+    assert [entity_id for entity_id, _ in find_keywords(key, id_trie, vectors)] == [entity_id]
+    for text in list(texts.values()) + ['']:
+        assert np.allclose(embed_entities(text, id_trie, vectors), embed_entities(text, trie), atol=1e-6)
+
+
+def test_mag_entity_index(tmp_path):
+    # The MAG script's entity ID trie indexes each entity's name and vector from a LanguageSimilarity trie
+    entity_path = tmp_path / 'entityMatcher.json'
+    with open(entity_path, 'wt') as f:
+        json.dump({'machine': {'IsWordEnd': False, 'Children': {'learning': {'IsWordEnd': True, 'Value': [0.1, 0.2]}}},
+                   'biology': {'IsWordEnd': True, 'Value': [0.3, 0.4]}}, f)
+    create_mag_entity_trie(entity_path, tmp_path / 'entity_trie.pkl', tmp_path / 'entity_index.pkl')
+    id_trie, names, vectors = read_entity_index(tmp_path / 'entity_index.pkl')
+    assert sorted(names) == ['biology', 'machine learning']
+    assert vectors.shape == (2, 2)
+    assert np.allclose(vectors[id_trie.get('machine learning')], [0.1, 0.2])
+    assert np.allclose(vectors[id_trie.get('biology')], [0.3, 0.4])
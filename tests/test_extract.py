@@ -0,0 +1,45 @@
+"""
+Test reading batches of IDs and texts from BQ extracts, as gzipped JSONL and as Parquet.
+"""
+import gzip
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from fos.util import iter_bq_batches, iter_bq_file_batches
+
+RECORDS = [{'merged_id': f'id-{i}', 'text': f'text {i}', 'other': i} for i in range(25)]
+
+
+@pytest.fixture
+def extract_dir(tmp_path):
+    # Write the records to two files of each format, like a sharded BQ extract
+    for shard, records in enumerate([RECORDS[:15], RECORDS[15:]]):
+        with gzip.open(tmp_path / f'en_corpus-{shard:012}.jsonl.gz', 'wt') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+        pq.write_table(pa.Table.from_pylist(records), tmp_path / f'en_corpus-{shard:012}.parquet', row_group_size=4)
+    return tmp_path
+
+
+def test_iter_bq_batches_jsonl(extract_dir):
+    batches = list(iter_bq_batches('en_', extract_dir, batch_size=10))
+    # JSONL batches can span files
+    assert [len(ids) for ids, _ in batches] == [10, 10, 5]
+    assert [merged_id for ids, _ in batches for merged_id in ids] == [record['merged_id'] for record in RECORDS]
+    assert [text for _, texts in batches for text in texts] == [record['text'] for record in RECORDS]
+
+
+def test_iter_bq_batches_parquet(extract_dir):
+    batches = list(iter_bq_batches('en_', extract_dir, batch_size=10, extract_format='parquet'))
+    # Parquet batches don't span files
+    assert [len(ids) for ids, _ in batches] == [10, 5, 10]
+    assert [merged_id for ids, _ in batches for merged_id in ids] == [record['merged_id'] for record in RECORDS]
+    assert [text for _, texts in batches for text in texts] == [record['text'] for record in RECORDS]
+
+
+def test_iter_bq_file_batches(extract_dir):
+    for suffix in ['jsonl.gz', 'parquet']:
+        batches = list(iter_bq_file_batches(extract_dir / f'en_corpus-{1:012}.{suffix}', 100, columns=('other',)))
+        assert batches == [([record['other'] for record in RECORDS[15:]],)]
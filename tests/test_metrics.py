@@ -0,0 +1,50 @@
+"""
+Test recording runtime metrics.
+"""
+import json
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from fos.metrics import MetricsRecorder, format_prometheus
+
+
+def test_metrics_recorder(tmp_path):
+    metrics = MetricsRecorder(tmp_path / 'metrics.jsonl', tmp_path / 'fos.prom')
+    batches = list(metrics.iter_stage('read', iter([[1, 2], [3]])))
+    assert batches == [[1, 2], [3]]
+    with metrics.stage('score', 3):
+        pass
+    # Rows without an embedding are counted as empty
+    ft = np.array([[0, 0], [1, 0]], dtype=np.float32)
+    ent = np.zeros((2, 2), dtype=np.float32)
+    metrics.count_empty(ft, csr_matrix(ft), ent)
+    metrics.batch(2, 0.5, queue_depths={'score': 1}, shard='a')
+    metrics.batch(1, 1.5)
+    summary = metrics.close()
+
+    with open(tmp_path / 'metrics.jsonl', 'rt') as f:
+        records = [json.loads(line) for line in f]
+    assert [record['event'] for record in records] == ['batch', 'batch', 'summary']
+    first = records[0]
+    assert (first['docs'], first['latency'], first['shard'], first['queue_depths']) == (2, 0.5, 'a', {'score': 1})
+    assert first['counters'] == {'empty_fasttext': 1, 'empty_tfidf': 1, 'empty_entity': 2}
+    assert set(first['docs_per_sec']) == {'read', 'score'}
+    assert summary['total_docs'] == 3 and summary['batches'] == 2
+    assert summary['latency_percentiles']['p50'] == 1.0
+
+    prometheus = (tmp_path / 'fos.prom').read_text()
+    assert 'fos_docs_total{job="fos"} 3' in prometheus
+    assert 'fos_events_total{job="fos",event="empty_entity"} 2' in prometheus
+
+
+def test_format_prometheus():
+    record = {'total_docs': 10, 'stage_seconds': {'score': 2.0}, 'docs_per_sec': {'score': 5.0}, 'counters': {},
+              'peak_rss_mb': 1.0, 'queue_depths': {'write': 2}, 'cache': {'hit_rate': 0.25}}
+    lines = format_prometheus(record, {'p50': 0.1, 'p99': 0.3}, job='test').splitlines()
+    assert '# TYPE fos_stage_seconds_total counter' in lines
+    assert 'fos_stage_seconds_total{job="test",stage="score"} 2.0' in lines
+    assert 'fos_batch_latency_seconds{job="test",quantile="0.99"} 0.3' in lines
+    assert 'fos_peak_rss_bytes{job="test"} 1048576' in lines
+    assert 'fos_queue_depth{job="test",stage="write"} 2' in lines
+    assert 'fos_cache_hit_ratio{job="test"} 0.25' in lines
@@ -5,6 +5,7 @@ import json
 
 import numpy as np
 import pandas as pd
+import pytest
 from ahocorasick import Automaton
 from fasttext.FastText import _FastText
 from gensim.corpora import Dictionary
@@ -28,6 +29,20 @@ def test_create_field_model():
         assert isinstance(fields.index, list)
 
 
+def test_field_model_components():
+    fields = FieldModel('en', components={'field_matrices'}, lazy=True)
+    # Nothing is loaded until it's used
+    assert fields._loaded == {}
+    assert isinstance(fields.field_tfidf, SparseMatrixSimilarity)
+    assert set(fields._loaded) == {'field_matrices'}
+    assert len(fields.index) == fields.field_fasttext.index.shape[0]
+    # Other components aren't loaded at all
+    with pytest.raises(ValueError):
+        fields.fasttext
+    with pytest.raises(ValueError):
+        FieldModel('en', components={'fields'})
+
+
 def test_create_embedding():
     embedding = Embedding(
         fasttext=np.zeros((250,), dtype=np.float32),
@@ -0,0 +1,110 @@
+"""
+Test writing field scores as JSONL and Parquet.
+"""
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from fos.output import FIELD_SCORES_SCHEMA, ALL_FIELD_SCORES_SCHEMA, open_score_writer, all_field_scores_table, \
+    merge_score_patch, score_patch_records
+from fos.settings import PIPELINES_DIR
+
+RECORDS = [
+    {'merged_id': 'a', 'fields': [{'name': 'Biology', 'score': 0.5}, {'name': 'Chemistry', 'score': 0.25}]},
+    {'merged_id': 'b', 'fields': []},
+]
+
+BQ_TYPES = {'STRING': pa.string(), 'FLOAT': pa.float64()}
+
+
+def test_schema_matches_bq():
+    with open(PIPELINES_DIR / 'schemas/field_scores.json', 'rt') as f:
+        bq_schema = {field['name']: field for field in json.load(f)}
+    assert bq_schema['merged_id']['mode'] == 'REQUIRED'
+    assert not FIELD_SCORES_SCHEMA.field('merged_id').nullable
+    bq_fields = bq_schema['fields']['fields']
+    struct_type = FIELD_SCORES_SCHEMA.field('fields').type.value_type
+    assert [field.name for field in struct_type] == [field['name'] for field in bq_fields]
+    for arrow_field, bq_field in zip(struct_type, bq_fields):
+        assert arrow_field.type == BQ_TYPES[bq_field['type']]
+        assert arrow_field.nullable == (bq_field['mode'] != 'REQUIRED')
+
+
+def test_parquet_writer(tmp_path):
+    with open_score_writer(tmp_path / 'part.parquet', 'parquet') as writer:
+        assert writer.write(RECORDS) == 2
+        assert writer.write([]) == 0
+        assert writer.write(RECORDS) == 2
+    part = pq.ParquetFile(tmp_path / 'part.parquet')
+    # One row group per non-empty batch
+    assert part.metadata.num_row_groups == 2
+    assert part.read().to_pylist() == RECORDS * 2
+
+    # Merging parts keeps their row groups
+    with open_score_writer(tmp_path / 'scores.parquet', 'parquet') as writer:
+        writer.append_part(tmp_path / 'part.parquet')
+        writer.append_part(tmp_path / 'part.parquet')
+    assert pq.ParquetFile(tmp_path / 'scores.parquet').metadata.num_row_groups == 4
+    assert pq.read_table(tmp_path / 'scores.parquet').to_pylist() == RECORDS * 4
+
+
+def test_jsonl_writer(tmp_path):
+    with open_score_writer(tmp_path / 'part.jsonl', 'jsonl') as writer:
+        assert writer.write(RECORDS) == 2
+    with open_score_writer(tmp_path / 'scores.jsonl', 'jsonl') as writer:
+        writer.append_part(tmp_path / 'part.jsonl')
+        writer.write(RECORDS)
+    with open(tmp_path / 'scores.jsonl', 'rt') as f:
+        assert [json.loads(line) for line in f] == RECORDS * 2
+
+
+def test_all_field_scores_table():
+    scores = np.array([[0.5, np.nan], [0.0, 0.25]], dtype=np.float32)
+    table = all_field_scores_table(['a', 'b'], scores, ['f1', 'f2'])
+    assert table.schema == ALL_FIELD_SCORES_SCHEMA
+    assert table.to_pylist() == [
+        {'merged_id': 'a', 'fields': [{'id': 'f1', 'score': 0.5}, {'id': 'f2', 'score': None}]},
+        {'merged_id': 'b', 'fields': [{'id': 'f1', 'score': 0.0}, {'id': 'f2', 'score': 0.25}]},
+    ]
+
+
+def test_score_patch_records():
+    scores = np.array([[0.1234567, np.nan], [0.0, 0.25]], dtype=np.float32)
+    assert score_patch_records(['a', 'b'], scores, ['1', '2'], digits=3) == [
+        {'merged_id': 'a', '1': 0.123, '2': None},
+        {'merged_id': 'b', '1': 0.0, '2': 0.25},
+    ]
+
+
+def test_merge_score_patch(tmp_path):
+    scores = [{'merged_id': 'a', '1': 0.5, '2': 0.1}, {'merged_id': 'b', '1': 0.25, '2': 0.2},
+              {'merged_id': 'c', '1': 0.0, '2': 0.3}]
+    with open(tmp_path / 'scores.jsonl', 'wt') as f:
+        f.writelines(json.dumps(record) + '\n' for record in scores)
+    # A patch can revise columns, add columns, and cover only some of the scores
+    with open(tmp_path / 'patch.jsonl', 'wt') as f:
+        f.writelines(json.dumps(record) + '\n' for record in [
+            {'merged_id': 'a', '2': 0.4, '3': 0.6},
+            {'merged_id': 'b', '2': None, '3': 0.7},
+        ])
+    assert merge_score_patch(tmp_path / 'scores.jsonl', tmp_path / 'patch.jsonl', tmp_path / 'merged.jsonl') == 2
+    with open(tmp_path / 'merged.jsonl', 'rt') as f:
+        assert [json.loads(line) for line in f] == [
+            {'merged_id': 'a', '1': 0.5, '2': 0.4, '3': 0.6},
+            {'merged_id': 'b', '1': 0.25, '2': None, '3': 0.7},
+            {'merged_id': 'c', '1': 0.0, '2': 0.3},
+        ]
+
+    # Patch records can be in any order, but must be for docs in the scores
+    with open(tmp_path / 'patch.jsonl', 'wt') as f:
+        f.writelines(json.dumps({'merged_id': merged_id, '3': 0.5}) + '\n' for merged_id in ['c', 'a'])
+    assert merge_score_patch(tmp_path / 'scores.jsonl', tmp_path / 'patch.jsonl', tmp_path / 'merged.jsonl') == 2
+    with open(tmp_path / 'merged.jsonl', 'rt') as f:
+        assert [json.loads(line).get('3') for line in f] == [0.5, None, 0.5]
+    with open(tmp_path / 'patch.jsonl', 'at') as f:
+        f.write(json.dumps({'merged_id': 'd', '3': 0.5}) + '\n')
+    with pytest.raises(ValueError):
+        merge_score_patch(tmp_path / 'scores.jsonl', tmp_path / 'patch.jsonl', tmp_path / 'merged.jsonl')
@@ -0,0 +1,43 @@
+"""
+Test running batches through a pipeline of threaded stages.
+"""
+import time
+
+import pytest
+
+from fos.pipeline import Pipeline, limit_batches
+
+
+def test_pipeline_order():
+    # Items should pass through every stage, in order
+    output = []
+    pipeline = Pipeline(range(10), [('double', lambda x: x * 2), ('write', output.append)])
+    pipeline.run()
+    assert output == [x * 2 for x in range(10)]
+    assert [stats.items for stats in pipeline.stats] == [10, 10, 10]
+
+
+def test_pipeline_error():
+    # An error in any stage should stop the pipeline and be re-raised
+    def fail(x):
+        if x == 3:
+            raise ValueError(x)
+        return x
+
+    pipeline = Pipeline(range(100), [('fail', fail), ('write', lambda x: None)])
+    with pytest.raises(ValueError):
+        pipeline.run()
+
+
+def test_pipeline_bottleneck():
+    # The slowest stage should be reported as the bottleneck
+    pipeline = Pipeline(range(5), [('fast', lambda x: x), ('slow', lambda x: time.sleep(0.05))], maxsize=1)
+    pipeline.run()
+    assert pipeline.bottleneck().name == 'slow'
+    assert 'Bottleneck: slow' in pipeline.report()
+
+
+def test_limit_batches():
+    batches = [[1, 2], [3, 4], [5, 6]]
+    assert list(limit_batches(batches, 3)) == [[1, 2], [3, 4]]
+    assert list(limit_batches(batches, 0)) == batches
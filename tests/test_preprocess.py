@@ -1,4 +1,8 @@
-from fos.util import preprocess, TO_CLEAN_LOWER, LONE_NUMBERS, case_field_name, clean_field_name
+import random
+import string
+
+from fos.preprocess import BatchPreprocessor, preprocess_batch, preprocess_records
+from fos.util import preprocess, preprocess_text, TO_CLEAN_LOWER, LONE_NUMBERS, case_field_name, clean_field_name
 
 
 def test_replace():
@@ -33,3 +37,30 @@ def test_clean_field_name():
     assert clean_field_name('Computer  science') == 'Computer science'
     assert clean_field_name(' Computer  science ') == 'Computer science'
     assert clean_field_name(' text–to–speech') == 'text-to-speech'
+
+
+def test_preprocess_batch():
+    texts = [
+        ' QUICK BROWN FOX?', '', '11 X11 11', 'Café, naïve résumé; ÉCOLE 42', '​zero⁠width﻿',
+        '́combining first', 'tabs\tand\nnewlines\r\n\x0b\x0cand\x1cothers', 'nul\x00inside 12', '产业组织理论 2020',
+        'ﬁnal ligature ① ², Σίσυφος', '   ', '...!?',
+    ]
+    # Random texts mixing ASCII, punctuation, digits, whitespace and non-ASCII characters
+    rng = random.Random(0)
+    alphabet = string.printable + 'éÉñßﬁΣς①²́  ​　产业'
+    texts += [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 80))) for _ in range(500)]
+    expected = [preprocess(text) for text in texts]
+    assert preprocess_batch(texts) == expected
+    with BatchPreprocessor(workers=2, chunk_size=50) as preprocessor:
+        assert preprocessor(texts) == expected
+
+
+def test_preprocess_records():
+    records = [{'title': 'A Title', 'abstract': 'An abstract.'}, {'title': None, 'abstract': 'Só abstract'},
+               {'title': 'Só title', 'abstract': float('nan')}, {'title': None, 'abstract': None}]
+    titles = [record['title'] for record in records]
+    abstracts = [record['abstract'] for record in records]
+    expected = [preprocess_text(record) for record in records]
+    assert preprocess_records(titles, abstracts) == expected == ['a title an abstract', 'so abstract', 'so title', '']
+    with BatchPreprocessor(workers=2, chunk_size=1) as preprocessor:
+        assert preprocessor.records(titles, abstracts) == expected
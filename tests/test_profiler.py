@@ -0,0 +1,58 @@
+"""
+Test sampling stacks per stage.
+"""
+import threading
+from collections import Counter
+
+from fos.profiler import StackSampler, format_profile, read_stacks, top_frames
+
+
+def busy(n=300_000):
+    return sum(i * i for i in range(n))
+
+
+def test_stack_sampler(tmp_path):
+    profiler = StackSampler(tmp_path, every=2, interval=0.001).start()
+    for n, _ in enumerate(profiler.iter_stage('read', range(4))):
+        with profiler.batch(n):
+            with profiler.stage('score'):
+                busy()
+            busy(10_000)
+    stacks = profiler.close()
+
+    # Only the sampled batches (0 and 2) are sampled, under the innermost stage
+    assert stacks['score'] and set(stacks) <= {'read', 'score', 'other'}
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(f'{stage}.folded' for stage in stacks)
+    assert read_stacks(tmp_path / 'score.folded') == stacks['score']
+    assert any(stack.endswith(')') and ';busy (' in stack for stack in stacks['score'])
+    assert format_profile(stacks).startswith('score: ')
+
+    # Unsampled batches aren't
+    profiler = StackSampler(tmp_path / 'unsampled', every=2, interval=0.001).start()
+    with profiler.batch(1), profiler.stage('score'):
+        busy()
+    assert profiler.close() == {}
+
+
+def test_stack_sampler_threads(tmp_path):
+    # As in pipeline mode, stages run in threads while the main thread waits
+    profiler = StackSampler(tmp_path, every=1, interval=0.001).start()
+
+    def work():
+        with profiler.batch(0), profiler.stage('embed'):
+            busy()
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    assert list(profiler.close()) == ['embed']
+
+
+def test_top_frames():
+    stacks = Counter({
+        'main (score.py:1);get_sentence_vector (fasttext/FastText.py:10)': 3,
+        'main (score.py:1);embed (fos/tfidf.py:5)': 1,
+        'main (score.py:1)': 1,
+    })
+    assert top_frames(stacks) == [('fasttext', 3), ('fos', 1), ('score', 1)]
+    assert top_frames(stacks, n=1, package=False) == [('get_sentence_vector (fasttext/FastText.py:10)', 3)]
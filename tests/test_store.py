@@ -0,0 +1,85 @@
+"""
+Test writing and reading publication embeddings in a binary embedding store.
+"""
+import json
+
+import numpy as np
+import pytest
+from scipy.sparse import random as sparse_random, vstack
+
+from fos.model import Embedding
+from fos.store import EmbeddingStoreWriter, EmbeddingStore, read_embedding_batches
+
+
+def test_store_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    fasttext = rng.random((25, 250), dtype=np.float32)
+    entity = rng.random((25, 250), dtype=np.float32)
+    dtm = sparse_random(25, 1000, density=0.05, format='csr', dtype=np.float32, random_state=0)
+    ids = [f'id-{i}' for i in range(25)]
+    with EmbeddingStoreWriter(tmp_path, n_terms=1000, dtype=np.float32, shard_size=10) as writer:
+        # Batches and single embeddings can be mixed, and shards needn't align with batches
+        writer.add_batch(ids[:7], fasttext[:7], dtm[:7], entity[:7])
+        for i in range(7, 25):
+            writer.add(ids[i], fasttext[i], list(zip(dtm[i].indices.tolist(), dtm[i].data.tolist())), entity[i])
+
+    store = EmbeddingStore(tmp_path)
+    assert len(store) == 25
+    assert len(store.shards) == 3
+    batches = list(store.iter_batches())
+    assert [merged_id for batch_ids, _, _, _ in batches for merged_id in batch_ids] == ids
+    assert np.array_equal(np.concatenate([batch[1] for batch in batches]), fasttext)
+    assert np.array_equal(np.concatenate([batch[3] for batch in batches]), entity)
+    assert (vstack([batch[2] for batch in batches]) != dtm).nnz == 0
+
+    stored_fasttext, stored_tfidf, stored_entity = store.get('id-12')
+    assert np.array_equal(stored_fasttext, fasttext[12])
+    assert stored_tfidf == list(zip(dtm[12].indices.tolist(), dtm[12].data.tolist()))
+
+
+def test_store_float16(tmp_path):
+    fasttext = np.random.default_rng(0).random((3, 250), dtype=np.float32)
+    with EmbeddingStoreWriter(tmp_path, n_terms=10) as writer:
+        writer.add_batch(['a', 'b', 'c'], fasttext, sparse_random(3, 10, format='csr'), fasttext)
+        # Missing embeddings are stored as zeros
+        writer.add('d', None, None, [])
+    ids, stored_fasttext, dtm, entity = EmbeddingStore(tmp_path).load_shard(0)
+    assert stored_fasttext.dtype == np.float32
+    assert np.allclose(stored_fasttext[:3], fasttext, atol=1e-3)
+    assert not stored_fasttext[3].any() and not entity[3].any() and not dtm[3].nnz
+
+
+def test_read_embedding_batches(tmp_path):
+    fasttext = np.random.default_rng(0).random((3, 4), dtype=np.float32)
+    dtm = sparse_random(3, 10, density=0.3, format='csr', dtype=np.float32, random_state=0)
+    with EmbeddingStoreWriter(tmp_path / 'en_embeddings', n_terms=10, dtype=np.float32) as writer:
+        writer.add_batch(['a', 'b', 'c'], fasttext, dtm, fasttext)
+    with open(tmp_path / 'en_embeddings.jsonl', 'wt') as f:
+        for i, merged_id in enumerate(['a', 'b', 'c']):
+            f.write(json.dumps({'merged_id': merged_id, 'fasttext': fasttext[i].tolist(),
+                                'tfidf': list(zip(dtm[i].indices.tolist(), dtm[i].data.tolist())),
+                                'entity': fasttext[i].tolist()}) + '\n')
+
+    # Both formats give the same embeddings, though JSONL batches are of batch_size
+    for input_format, n_batches in [('store', 1), ('jsonl', 2)]:
+        batches = list(read_embedding_batches('en', input_format, n_terms=10, batch_size=2, corpus_dir=tmp_path))
+        assert len(batches) == n_batches
+        assert [merged_id for batch in batches for merged_id in batch[0]] == ['a', 'b', 'c']
+        assert np.array_equal(np.concatenate([batch[1] for batch in batches]), fasttext)
+        assert (vstack([batch[2] for batch in batches]) != dtm).nnz == 0
+    with pytest.raises(ValueError):
+        next(read_embedding_batches('en', 'parquet', corpus_dir=tmp_path))
+
+
+def test_embedding_store(en_model, texts, tmp_path):
+    embeddings = [en_model.embed(text) for text in texts]
+    with en_model.store_writer(tmp_path, dtype=np.float32) as writer:
+        for i, embedding in enumerate(embeddings):
+            embedding.dump_store(writer, merged_id=str(i))
+    store = EmbeddingStore(tmp_path)
+    for i, embedding in enumerate(embeddings):
+        stored = Embedding.load_store(store, str(i))
+        assert np.array_equal(stored.fasttext, embedding.fasttext)
+        assert np.array_equal(stored.entity, embedding.entity)
+        assert [term_id for term_id, _ in stored.tfidf] == [term_id for term_id, _ in embedding.tfidf]
+        assert np.allclose([weight for _, weight in stored.tfidf], [weight for _, weight in embedding.tfidf])
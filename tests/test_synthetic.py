@@ -0,0 +1,57 @@
+"""
+Test generating synthetic model assets and corpus.
+"""
+import pickle
+
+import numpy as np
+from fasttext.FastText import _FastText
+from gensim.corpora import Dictionary
+
+from fos.entity import batch_embed_entities, index_entities, read_entity_index
+from fos.settings import FASTTEXT_DIM, EN_FASTTEXT_PATH, EN_TFIDF_PATH, EN_DICT_PATH, EN_ENTITY_PATH, \
+    EN_ENTITY_INDEX_PATH, EN_FIELD_FASTTEXT_PATH, EN_FIELD_TFIDF_PATH, EN_FIELD_ENTITY_PATH, EN_FIELD_KEY_PATH
+from fos.tfidf import TfidfEngine
+from fos.util import iter_bq_batches
+from fos.vectors import ScoringKernel, row_norm
+
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def test_synthetic_assets(synthetic_assets_dir):
+    fasttext = _FastText(model_path=str(synthetic_assets_dir / EN_FASTTEXT_PATH.name))
+    assert fasttext.get_dimension() == FASTTEXT_DIM
+    tfidf = load_pickle(synthetic_assets_dir / EN_TFIDF_PATH.name)
+    dictionary = Dictionary.load_from_text(str(synthetic_assets_dir / EN_DICT_PATH.name))
+    entities = load_pickle(synthetic_assets_dir / EN_ENTITY_PATH.name)
+    field_fasttext = load_pickle(synthetic_assets_dir / EN_FIELD_FASTTEXT_PATH.name).index
+    field_tfidf = load_pickle(synthetic_assets_dir / EN_FIELD_TFIDF_PATH.name).index
+    field_entities = load_pickle(synthetic_assets_dir / EN_FIELD_ENTITY_PATH.name).index
+    with open(synthetic_assets_dir / EN_FIELD_KEY_PATH.name, 'rt') as f:
+        keys = f.read().splitlines()
+
+    # Field matrices have a row for every field in the metadata, as the real ones do
+    with open(synthetic_assets_dir / 'fields/field_meta.jsonl', 'rt') as f:
+        n_fields = len(f.readlines())
+    assert len(keys) == n_fields == 1108
+    assert field_fasttext.shape == field_entities.shape == (n_fields, FASTTEXT_DIM)
+    assert field_tfidf.shape == (n_fields, len(dictionary))
+
+    # The corpus is sharded like a BQ extract, and embeds and scores like the real thing
+    batches = list(iter_bq_batches('en_', synthetic_assets_dir / 'corpus', batch_size=100))
+    assert sum(len(ids) for ids, _ in batches) == 200
+    ids, texts = batches[0]
+    ft = row_norm([fasttext.get_sentence_vector(text) for text in texts])
+    dtm = TfidfEngine.from_gensim(tfidf, dictionary).embed(texts)
+    entity_trie, entity_names, entity_vectors = index_entities(entities)
+    # The entity ID automaton is written alongside the entity vector automaton
+    _, index_names, index_vectors = read_entity_index(synthetic_assets_dir / EN_ENTITY_INDEX_PATH.name)
+    assert index_names == entity_names and np.array_equal(index_vectors, entity_vectors)
+    ent = batch_embed_entities(texts, entity_trie, entity_vectors)
+    # Some abstracts mention fields
+    assert ent.any(axis=1).sum() > 0
+    scores = ScoringKernel(field_fasttext, field_tfidf, field_entities).score(ft, dtm, ent)
+    assert scores.shape == (len(texts), n_fields)
+    assert np.isfinite(scores).all()
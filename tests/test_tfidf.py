@@ -0,0 +1,38 @@
+"""
+Test that the batch tf-idf engine gives the same results as gensim.
+"""
+import numpy as np
+from gensim import matutils
+
+from fos.tfidf import TfidfEngine, sequential_row_sums
+from fos.vectors import load_tfidf, load_field_tfidf, sparse_norm, batch_sparse_similarity
+
+
+def test_engine_parity(texts):
+    # The engine should give bit-for-bit the same sparse matrix as gensim's doc2bow, TfidfModel and corpus2csc
+    tfidf, dictionary = load_tfidf()
+    engine = TfidfEngine.from_gensim(tfidf, dictionary)
+    texts = list(texts.values()) + ['', 'notarealtoken', 'the the the']
+    dtm = engine.embed(texts)
+    bow = [dictionary.doc2bow(text.split()) for text in texts]
+    gensim_dtm = [doc for doc in tfidf.gensim_model[bow]]
+    expected = matutils.corpus2csc([sparse_norm(doc) for doc in gensim_dtm], len(dictionary), dtype=np.float32).T
+    assert dtm.shape == expected.shape
+    assert np.array_equal(dtm.indptr, expected.indptr)
+    assert np.array_equal(dtm.indices, expected.indices)
+    assert np.array_equal(dtm.data, expected.data)
+
+    # So field similarities should be the same too
+    field_tfidf = load_field_tfidf()
+    assert np.array_equal(batch_sparse_similarity(dtm, field_tfidf.index).A,
+                          batch_sparse_similarity(gensim_dtm, field_tfidf.index).A)
+
+
+def test_sequential_row_sums():
+    # Row sums should be the same as Python's sum() over each row, which adds elements in order
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(0, 50, 100)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    values = rng.random(indptr[-1]) * 10.0 ** rng.integers(-8, 8, indptr[-1])
+    expected = [sum(values[start:stop].tolist()) for start, stop in zip(indptr[:-1], indptr[1:])]
+    assert sequential_row_sums(values, indptr).tolist() == expected
@@ -0,0 +1,74 @@
+"""
+Test selecting the top-scoring fields for each document.
+"""
+import numpy as np
+
+from fos.topk import field_agreement, top_k, top_k_by_level, to_score_records
+
+
+def argsort_top_k(scores, k=10, offset=0):
+    # The full sort that top_k() replaces, giving the top k scores ascending
+    scores = np.nan_to_num(scores)
+    indices = np.argsort(scores, axis=1)[:, -k:]
+    return indices + offset, np.take_along_axis(scores, indices, axis=1)
+
+
+def test_top_k():
+    rng = np.random.default_rng(0)
+    scores = rng.normal(size=(50, 300)).astype(np.float32)
+    scores[rng.random(scores.shape) < 0.5] = np.nan
+    scores[0] = np.nan
+    indices, top_scores, valid = top_k(scores, 10, offset=7)
+    expected_indices, expected_scores = argsort_top_k(scores, 10, offset=7)
+    # Results are descending
+    assert np.array_equal(top_scores, expected_scores[:, ::-1])
+    # Ties between NaN and zero scores can be broken either way, but they're masked
+    assert np.all((indices == expected_indices[:, ::-1]) | ~valid)
+    assert not valid[0].any()
+    assert np.all(valid[1:] == (top_scores[1:] != 0.0))
+
+
+def test_top_k_few_fields():
+    scores = np.array([[0.1, np.nan, 0.3]])
+    indices, top_scores, valid = top_k(scores, 10)
+    assert indices.tolist() == [[2, 0, 1]]
+    assert valid.tolist() == [[True, True, False]]
+
+
+def test_top_k_by_level():
+    rng = np.random.default_rng(0)
+    scores = rng.random((20, 30))
+    levels = np.repeat([0, 1, 2], 10)
+    results = top_k_by_level(scores, levels, {0: 3, 1: 5, 2: 10}, offset=100)
+    assert sorted(results) == [0, 1, 2]
+    assert results[0][0].shape == (20, 3)
+    assert results[1][0].shape == (20, 5)
+    assert np.array_equal(results[1][0], top_k(scores[:, 10:20], 5, offset=110)[0])
+    # Levels needn't be contiguous
+    levels = np.tile([0, 1], 15)
+    results = top_k_by_level(scores, levels, 4, include=[1])
+    assert list(results) == [1]
+    level_indices = np.flatnonzero(levels == 1)
+    assert np.array_equal(results[1][0], level_indices[top_k(scores[:, level_indices], 4)[0]])
+
+
+def test_to_score_records():
+    scores = np.array([[0.5, np.nan, 0.123456], [0.0, 0.0, 0.0]], dtype=np.float32)
+    records = to_score_records(*top_k(scores, 2), ['a', 'b', 'c'])
+    assert records == [[{'name': 'a', 'score': 0.5}, {'name': 'c', 'score': 0.1235}], []]
+
+
+def test_field_agreement():
+    levels = np.array([0, 0, 0, 0, 1, 1, 1, 1])
+    scores = np.array([[0.9, 0.8, 0.7, 0.1, 0.5, 0.4, 0.3, 0.2],
+                       [0.1, 0.2, 0.3, 0.4, 0.2, 0.3, 0.4, 0.5]], dtype=np.float32)
+    other = scores.copy()
+    # Swap the first document's top two L0 fields, and replace the second document's third L1 field
+    other[0, :2] = [0.8, 0.9]
+    other[1, 5] = 0.0
+    report = field_agreement(scores, other, levels, k=3)
+    assert report['docs'] == 2
+    assert np.isclose(report['max_abs_diff'], 0.3)
+    assert report['levels'][0]['top1'] == 0.5 and report['levels'][0]['top3'] == 1.0
+    assert report['levels'][1]['top1'] == 1.0 and np.isclose(report['levels'][1]['top3'], 5 / 6)
+    assert np.isclose(report['levels'][0]['max_abs_diff'], 0.1)
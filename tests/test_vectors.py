@@ -3,12 +3,15 @@ Test that fasttext, tf-idf and entity vectors can be loaded, and validate them.
 """
 import ahocorasick
 import gensim.similarities
+import numpy as np
 from fasttext.FastText import _FastText
 from gensim.corpora import Dictionary
 from gensim.sklearn_api import TfIdfTransformer
+from scipy.sparse import csr_matrix
 
 from fos.entity import load_entities
-from fos.vectors import load_fasttext, load_tfidf, load_field_fasttext, load_field_tfidf, load_field_entities
+from fos.vectors import load_fasttext, load_tfidf, load_field_fasttext, load_field_tfidf, load_field_entities, \
+    row_norm, ScoringKernel, batch_sparse_similarity
 
 
 def test_load_fasttext():
@@ -52,3 +55,45 @@ def test_batch_embed_tfidf(texts):
     bow = [dictionary.doc2bow(text.split()) for text in texts.values()]
     # __iter__ applies the transform
     dtm = [doc for doc in tfidf.gensim_model[bow]]
+
+
+def test_scoring_kernel():
+    # The kernel should give the same average over valid similarities as stacking and masking them
+    rng = np.random.default_rng(0)
+    ft = row_norm(rng.normal(0.1, 1, (50, 25)))
+    ent = row_norm(rng.normal(0.1, 1, (50, 25)))
+    # Some publications have no entity mentions
+    ent[::3] = 0
+    field_ft = row_norm(rng.normal(0.1, 1, (20, 25)))
+    field_ent = row_norm(rng.normal(0.1, 1, (20, 25)))
+    field_tfidf = csr_matrix(row_norm(rng.random((20, 100)) * (rng.random((20, 100)) < 0.2)))
+    dtm = rng.random((50, 100)) * (rng.random((50, 100)) < 0.05)
+    dtm = [[(j, float(x)) for j, x in enumerate(row) if x] for row in dtm]
+
+    sims = np.array((ft @ field_ft.T, batch_sparse_similarity(dtm, field_tfidf).A, ent @ field_ent.T))
+    for positive_only in [False, True]:
+        valid = (sims > 0) if positive_only else ((sims >= 0) & (sims <= 1))
+        counts = valid.sum(axis=0)
+        expected = np.divide((sims * valid).sum(axis=0), counts, out=np.zeros(counts.shape), where=counts > 0)
+        kernel = ScoringKernel(field_ft, field_tfidf, field_ent, positive_only=positive_only)
+        assert np.allclose(kernel.score(ft, dtm, ent), expected, atol=1e-6)
+        # Buffers are reused for smaller batches
+        assert np.allclose(kernel.score(ft[:10], dtm[:10], ent[:10]), expected[:10], atol=1e-6)
+        # Averaging precomputed similarities gives the same scores
+        assert np.allclose(kernel.average(sims.astype(np.float32)), expected, atol=1e-6)
+
+
+def test_scoring_kernel_keep_all():
+    # With keep_all, scores are plain averages of the three similarities, as from FieldModel.score()
+    rng = np.random.default_rng(0)
+    ft = row_norm(rng.normal(0, 1, (30, 25)))
+    ent = row_norm(rng.normal(0, 1, (30, 25)))
+    ent[::4] = 0
+    field_ft = row_norm(rng.normal(0, 1, (12, 25)))
+    field_ent = row_norm(rng.normal(0, 1, (12, 25)))
+    field_tfidf = csr_matrix(row_norm(rng.random((12, 80)) * (rng.random((12, 80)) < 0.3)))
+    dtm = csr_matrix(row_norm(rng.random((30, 80)) * (rng.random((30, 80)) < 0.1)))
+
+    expected = np.mean([ft @ field_ft.T, (dtm @ field_tfidf.T).toarray(), ent @ field_ent.T], axis=0)
+    kernel = ScoringKernel(field_ft, field_tfidf, field_ent, positive_only=True, keep_all=True)
+    assert np.allclose(kernel.score(ft, dtm, ent), expected, atol=1e-6)
@@ -0,0 +1,63 @@
+"""
+Test that batch FastText embedding from a word vector table matches get_sentence_vector().
+"""
+import numpy as np
+from fasttext.FastText import _FastText
+
+from fos.settings import EN_FASTTEXT_PATH
+from fos.util import iter_bq_batches
+from fos.wordvectors import FastTextEngine, build_word_table, corpus_vocab, quantize_rows
+
+
+def test_engine_parity(synthetic_assets_dir, tmp_path):
+    model = _FastText(model_path=str(synthetic_assets_dir / EN_FASTTEXT_PATH.name))
+    _, texts = next(iter_bq_batches('en_', synthetic_assets_dir / 'corpus', batch_size=100))
+    # Include out-of-vocabulary words, repeated words, and texts without any words
+    texts = list(texts) + ['', '   ', 'notarealword', 'notarealword notarealword the', 'x', texts[0] + ' ' + texts[0]]
+    expected = np.array([model.get_sentence_vector(text) for text in texts])
+
+    # Limiting the table to the most frequent words sends the rest through the out-of-vocabulary path
+    for max_words in [None, 100]:
+        engine = FastTextEngine.from_fasttext(model, max_words=max_words)
+        vectors = engine.embed(texts)
+        assert vectors.shape == expected.shape and vectors.dtype == np.float32
+        assert np.allclose(vectors, expected, atol=1e-6)
+
+    # A built table should give the same vectors, memory-mapped
+    build_word_table(output_dir=tmp_path, model=model, max_words=500, chunk_size=128)
+    engine = FastTextEngine.from_table(tmp_path, fasttext=model)
+    assert isinstance(engine.vectors, np.memmap) and engine.n_words == 500
+    assert np.allclose(engine.embed(texts), expected, atol=1e-6)
+    assert not engine.embed([]).size
+
+
+def test_quantize_rows():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(20, 250)).astype(np.float32)
+    vectors[0] = 0.0
+    values, scales = quantize_rows(vectors, 'int8')
+    assert values.dtype == np.int8 and scales.shape == (20,)
+    # Rounding to the nearest step loses at most half a step per element, and zero rows stay zero
+    assert np.all(np.abs(values * scales[:, None] - vectors) <= scales[:, None] * 0.501)
+    assert not values[0].any()
+    values, scales = quantize_rows(vectors, 'float16')
+    assert values.dtype == np.float16 and scales is None
+
+
+def test_compact_table(synthetic_assets_dir, tmp_path):
+    model = _FastText(model_path=str(synthetic_assets_dir / EN_FASTTEXT_PATH.name))
+    _, texts = next(iter_bq_batches('en_', synthetic_assets_dir / 'corpus', batch_size=100))
+    expected = np.array([model.get_sentence_vector(text) for text in texts])
+
+    # A compact variant of the corpus vocabulary doesn't need the model, and its vectors are close to the model's
+    words = corpus_vocab(texts)
+    assert len(words) == len(set(' '.join(texts).split()))
+    for dtype, atol in [('float16', 1e-3), ('int8', 1e-2)]:
+        build_word_table(output_dir=tmp_path / dtype, model=model, words=words, dtype=dtype)
+        engine = FastTextEngine.from_table(tmp_path / dtype)
+        assert engine.fasttext is None and engine.vectors.dtype == np.dtype(dtype)
+        vectors = engine.embed(texts)
+        assert np.allclose(vectors, expected, atol=atol)
+        assert np.allclose(engine.get_sentence_vector(texts[0]), vectors[0])
+        # Words outside the table are skipped
+        assert np.allclose(engine.embed([texts[0] + ' notarealword']), vectors[:1])
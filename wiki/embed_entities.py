@@ -2,8 +2,9 @@
 Use FastText, the tfidf transformer, and field text to create entity embeddings.
 
 We have two outputs: (1) an entity matcher that will efficiently find entity mentions in publication text and yield
-the corresponding entity vectors, for creation of an entity-based publication embedding; and (2) a matrix of entity
-vectors for fields (via `gensim.similarities.docsim.MatrixSimilarity`), for scoring purposes: comparison of
+the corresponding entity vectors, for creation of an entity-based publication embedding, which we also write as an
+entity ID matcher with a separate matrix of entity vectors (see ``fos.entity.write_entity_index()``); and (2) a matrix
+of entity vectors for fields (via `gensim.similarities.docsim.MatrixSimilarity`), for scoring purposes: comparison of
 entity-based publication embeddings against entity-based field embeddings
 """
 import pickle
@@ -15,8 +16,8 @@ import numpy as np
 import pandas as pd
 from gensim.similarities import MatrixSimilarity
 
-from fos.entity import create_automaton, find_keywords
-from fos.settings import ASSETS_DIR, EN_ENTITY_PATH, EN_FIELD_ENTITY_PATH
+from fos.entity import create_automaton, find_keywords, index_entities, write_entity_index
+from fos.settings import ASSETS_DIR, EN_ENTITY_PATH, EN_ENTITY_INDEX_PATH, EN_FIELD_ENTITY_PATH
 from fos.util import format_field_name
 from fos.vectors import load_field_fasttext, load_field_keys
 
@@ -130,11 +131,15 @@ def write_entity_matcher(entity_vectors, id_to_title, lang):
     })
     if lang == 'en':
         output_path = EN_ENTITY_PATH
+        index_path = EN_ENTITY_INDEX_PATH
     else:
         raise ValueError(lang)
     with open(output_path, 'wb') as f:
         pickle.dump(entity_matcher, f)
     print(f'Wrote {lang} matcher to {output_path}')
+    # The same entities as an entity ID matcher and a matrix of entity vectors, which load faster
+    write_entity_index(*index_entities(entity_matcher), index_path)
+    print(f'Wrote {lang} entity ID matcher to {index_path}')
 
 
 def write_entity_similarity(entity_vectors, field_index, lang):